@@ -0,0 +1,80 @@
+"""
+The memory taken by the server's records of the users and the houses
+
+    python benchmarks/memory.py [users] [houses]
+
+builds the records the server keeps for every user that ever logged in
+and for every house (each with a few members, ranks and rooms) and
+prints the bytes taken by each and the peak RSS of the process
+"""
+
+import os
+import resource
+import sys
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "gupshup"))
+
+from src.houses import LocalHouses  # noqa: E402
+from src.utils import House, User  # noqa: E402
+
+USERS = 100_000
+HOUSES = 10_000
+
+# the members of a house other than its king
+MEMBERS = 20
+
+
+def build_users(count: int) -> tuple:
+    users = dict()
+    for index in range(count):
+        user = User(f"user{index}")
+        user.join(f"house{index % HOUSES}", {f"house{index % HOUSES}/general": 0})
+        users[user.username] = user
+
+    local = LocalHouses(dict(), lambda messages: None, workers=1)
+    for username in users:
+        local.add_user(username)
+
+    return users, local
+
+
+def build_houses(count: int) -> dict:
+    houses = dict()
+    for index in range(count):
+        king = f"user{index}"
+        house = House(f"house{index}", king)
+        for member in range(MEMBERS):
+            house.add_member(f"user{(index + member + 1) % USERS}")
+        house.add_rank("mod")
+        house.add_room("random")
+        if index % 10 == 0:
+            house.ban_user(f"user{(index + MEMBERS + 1) % USERS}")
+        houses[house.name] = house
+
+    return houses
+
+
+def measure(label: str, build, count: int):
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    kept = build(count)
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+
+    print(
+        f"{label}: {count} in {(after - before) / 2**20:.1f} MiB, {(after - before) / count:.0f} bytes each"
+    )
+    return kept
+
+
+if __name__ == "__main__":
+    USERS = int(sys.argv[1]) if len(sys.argv) > 1 else USERS
+    HOUSES = int(sys.argv[2]) if len(sys.argv) > 2 else HOUSES
+
+    users = measure("users", build_users, USERS)
+    houses = measure("houses", build_houses, HOUSES)
+
+    # kilobytes on linux, bytes on macos
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    print(f"peak rss: {rss / (2**20 if sys.platform == 'darwin' else 2**10):.1f} MiB")
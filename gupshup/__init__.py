@@ -1,5 +1,7 @@
 from .ui import Tui
 from .src.server import Server
+from .src.bots import load_bot
+from .src.utils import PubSubBroker, SocketPubSub
 import socket
 
 import argparse
@@ -8,26 +10,99 @@ parser = argparse.ArgumentParser()
 parser.add_argument(
     "-q", "--quiet", default=0, action="store_true", help="Supress notification sounds"
 )
+parser.add_argument(
+    "--slow-policy",
+    default="defer",
+    choices=["drop", "defer", "disconnect"],
+    help="What the server does with users that can't keep up with their messages",
+)
+parser.add_argument(
+    "--shards",
+    default=0,
+    type=int,
+    help="Number of worker processes the server partitions the houses across",
+)
+parser.add_argument(
+    "-p", "--port", default=5500, type=int, help="Port of the server (node)"
+)
+parser.add_argument(
+    "--cluster",
+    type=str,
+    help="Comma separated names of all the nodes of the cluster this server is a part of",
+)
+parser.add_argument("--node", type=str, default="", help="Name of this cluster node")
+parser.add_argument(
+    "--broker-address",
+    default="localhost:5600",
+    help="Address of the pubsub broker connecting the cluster nodes",
+)
+parser.add_argument(
+    "--heartbeat-interval",
+    default=10,
+    type=float,
+    help="Seconds between the pings the server sends to the users",
+)
+parser.add_argument(
+    "--heartbeat-timeout",
+    default=30,
+    type=float,
+    help="Seconds of silence after which the other side is considered disconnected",
+)
+parser.add_argument(
+    "--storage",
+    default="file",
+    choices=["file", "sqlite"],
+    help="Where the server keeps its data, the data files are moved into a new database",
+)
+parser.add_argument(
+    "--bot",
+    action="append",
+    default=[],
+    help="A bot the server runs, `package.module:Class` (can be given more than once)",
+)
 group = parser.add_mutually_exclusive_group(required=True)
 group.add_argument("--server", action="store_true", help="Spins up a server")
+group.add_argument(
+    "--broker", action="store_true", help="Spins up a pubsub broker for a cluster"
+)
 group.add_argument("-u", "--user", type=str, help="Connects a user to the server")
 
 args = parser.parse_args()
 
 
 def main():
-    if args.server:
-        server = Server()
+    host, port = args.broker_address.rsplit(":", 1)
+    if args.broker:
+        PubSubBroker(host, int(port)).start()
+    elif args.server:
+        cluster = {}
+        if args.cluster:
+            cluster = {
+                "node": args.node,
+                "nodes": args.cluster.split(","),
+                "pubsub": SocketPubSub(host, int(port)),
+            }
+
+        server = Server(
+            slow_policy=args.slow_policy,
+            shards=args.shards,
+            port=args.port,
+            heartbeat_interval=args.heartbeat_interval,
+            heartbeat_timeout=args.heartbeat_timeout,
+            storage=args.storage,
+            bots=[load_bot(spec) for spec in args.bot],
+            **cluster,
+        )
         server.start_connection()
     else:
         conn = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         try:
-            conn.bind(("localhost", 5500))
+            conn.bind(("localhost", args.port))
             print("Can't connect to the server. Is it running?")
             exit()
 
         except OSError:
-            Tui.run(args.user, args.quiet)
+            Tui.run(args.user, args.quiet, args.port, args.heartbeat_timeout)
 
         finally:
             conn.close()
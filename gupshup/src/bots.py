@@ -0,0 +1,221 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from fnmatch import fnmatchcase
+from functools import partial
+from importlib import import_module
+from threading import Lock, Thread
+from typing import (
+    TYPE_CHECKING,
+    Callable,
+    Dict,
+    FrozenSet,
+    List,
+    Optional,
+    Sequence,
+    Union,
+)
+
+from .utils import House, Message, warn, err
+
+if TYPE_CHECKING:
+    from .server import Server
+
+# seconds a bot has to answer a text, it's cancelled after
+BOT_TIMEOUT = 5
+
+# texts a single bot handles at once, the ones after wait for their turn
+BOT_CONCURRENCY = 4
+
+# texts waiting for the bots, the ones after are dropped (and counted)
+MAX_PENDING = 10_000
+
+# what a bot answers with, the texts it sends to the room
+Reply = Union[None, str, List[str]]
+
+
+class Bot:
+    """
+    A bot, it answers the slash commands (and, if it listens, the texts)
+    sent to the rooms of the houses it was added to with `/add_bot`
+
+    The handlers can be coroutines or plain functions, the plain ones run on
+    threads of the bot's own, and either is cancelled after a timeout so a slow
+    or broken bot only ever holds up itself, never the houses or the others
+    """
+
+    # the name its texts are sent with, no user can log in with it
+    name: str = ""
+    # the rooms (patterns like `dev-*`) it's in, in every house it's added to
+    rooms: Sequence[str] = ("*",)
+    # the slash commands it answers, `weather` for `/weather berlin`
+    commands: Sequence[str] = ()
+    # if it gets every text of its rooms too
+    listens: bool = False
+
+    def on_command(self, command: str, args: str, message: Message) -> Reply:
+        return None
+
+    def on_message(self, message: Message) -> Reply:
+        return None
+
+
+def load_bot(spec: str) -> Bot:
+    """
+    A bot made from its class, `package.module:Class`
+    """
+
+    module, _, name = spec.partition(":")
+    return getattr(import_module(module), name)()
+
+
+class Bots:
+    """
+    Runs the bots on an event loop in a thread of its own
+
+    The broadcasting thread only hands the texts over (or drops them
+    if too many are waiting), the bots answer by sending texts to the
+    house like a member would
+    """
+
+    def __init__(
+        self,
+        server: "Server",
+        bots: Sequence[Bot] = (),
+        houses: Dict[str, House] = {},
+        timeout: float = BOT_TIMEOUT,
+        concurrency: int = BOT_CONCURRENCY,
+    ) -> None:
+        self.server = server
+        self.bots: Dict[str, Bot] = {bot.name: bot for bot in bots}
+        self.timeout = timeout
+
+        # house -> the bots added to it
+        self.binds: Dict[str, FrozenSet[str]] = {
+            name: house.bot_binds for name, house in houses.items() if house.bot_binds
+        }
+
+        # the async handlers wait for a slot, the plain ones for a thread
+        self.slots = {name: asyncio.Semaphore(concurrency) for name in self.bots}
+        self.threads = {
+            name: ThreadPoolExecutor(concurrency, thread_name_prefix=f"bot-{name}")
+            for name in self.bots
+        }
+
+        # metrics
+        self.pending = 0
+        self.dropped = 0
+        self.handled = {name: 0 for name in self.bots}
+        self.timeouts = {name: 0 for name in self.bots}
+        self.errors = {name: 0 for name in self.bots}
+        self.lock = Lock()
+
+        self.loop = asyncio.new_event_loop()
+        if self.bots:
+            Thread(target=self.loop.run_forever, daemon=True).start()
+
+    def track(self, message: Message) -> None:
+        """
+        Keeps the bots of the houses up to date
+        """
+
+        match message.action:
+            case "add_house":
+                house = message.data["house"]
+                self.binds[house.name] = frozenset(house.bots)
+            case "change_bots":
+                self.binds[message.house] = frozenset(message.data["bots"])
+
+    def _handler(self, bot: Bot, message: Message) -> Optional[Callable[[], Reply]]:
+        """
+        The bot's handler of the text, `None` if it's not for the bot
+        """
+
+        if not any(fnmatchcase(message.room, pattern) for pattern in bot.rooms):
+            return None
+
+        if message.text.startswith("/"):
+            command, _, args = message.text[1:].partition(" ")
+            if command in bot.commands:
+                return partial(bot.on_command, command, args.strip(), message)
+            return None
+
+        return partial(bot.on_message, message) if bot.listens else None
+
+    def dispatch(self, message: Message) -> None:
+        """
+        Hands a text sent to a house over to its bots, never blocks
+        """
+
+        if (
+            message.action != "push_text"
+            or message.sender in self.bots
+            or not self.binds.get(message.house)
+        ):
+            return
+
+        handlers = []
+        for name in self.binds[message.house]:
+            bot = self.bots.get(name)
+            # NOTE: every bot gets a copy of its own to do as it likes with
+            handler = bot and self._handler(bot, message.clone())
+            if handler is not None:
+                handlers.append((bot, handler))
+
+        with self.lock:
+            if self.pending + len(handlers) > MAX_PENDING:
+                self.dropped += len(handlers)
+                return
+            self.pending += len(handlers)
+
+        for bot, handler in handlers:
+            asyncio.run_coroutine_threadsafe(
+                self._run(bot, handler, message), self.loop
+            )
+
+    async def _call(self, bot: Bot, handler: Callable[[], Reply]) -> Reply:
+        if asyncio.iscoroutinefunction(handler.func):
+            async with self.slots[bot.name]:
+                return await handler()
+
+        # NOTE: a thread can't be cancelled, one that never returns
+        # keeps its slot and the bot has one thread less
+        return await self.loop.run_in_executor(self.threads[bot.name], handler)
+
+    async def _run(
+        self, bot: Bot, handler: Callable[[], Reply], message: Message
+    ) -> None:
+        try:
+            reply = await asyncio.wait_for(self._call(bot, handler), self.timeout)
+        except asyncio.TimeoutError:
+            warn(f"bot {bot.name} didn't answer in {self.timeout}s")
+            self.timeouts[bot.name] += 1
+            return
+        except Exception as e:
+            err(f"bot {bot.name} failed: {e!r}")
+            self.errors[bot.name] += 1
+            return
+        finally:
+            with self.lock:
+                self.pending -= 1
+
+        self.handled[bot.name] += 1
+        for text in [reply] if isinstance(reply, str) else reply or []:
+            if isinstance(text, str) and text.strip():
+                self.server.router.submit(
+                    Message(
+                        sender=bot.name,
+                        house=message.house,
+                        room=message.room,
+                        text=text,
+                    )
+                )
+
+    def stats(self) -> Dict[str, Dict[str, int]]:
+        return {
+            name: {
+                "handled": self.handled[name],
+                "timeouts": self.timeouts[name],
+                "errors": self.errors[name],
+            }
+            for name in self.bots
+        }
@@ -1,23 +1,75 @@
 import os
 import socket
-from threading import Thread
-from queue import Queue
-from time import sleep
+from collections import deque
+from random import uniform
+from threading import Thread, Lock
+from queue import Empty, Queue
+from time import sleep, time
 from pickle import load, dump
+from typing import Deque, Dict, Iterator, List, Optional, Tuple
 
 from .utils import Message, Channel
+from .utils.attachments import CHUNK_SIZE, PARTIAL_SUFFIX, describe_size, file_digest
+from .utils.message import CAPABILITIES, PAGES, LIVE
+from .utils.retention import Policy, expired, room_policy
 
 HOST = "localhost"
 PORT = 5500
 HOME = os.path.expanduser("~")
+DOWNLOADS = os.path.join(HOME, "Downloads")
+
+# the server pings every few seconds, a silence longer than this means it's gone
+HEARTBEAT_TIMEOUT = 30
+
+# seconds to wait between reconnect attempts, the first one is fast and then
+# they grow exponentially (with jitter so that all the clients don't hit a
+# restarted server at once) till the cap
+RECONNECT_FIRST = 0.1
+RECONNECT_BASE = 0.5
+RECONNECT_CAP = 30
+
+# the chats are pruned to the retention policies every so many messages
+PRUNE_EVERY = 500
+
+# chunks of a file sent (or asked for) before waiting for the server's answers
+TRANSFER_WINDOW = 4
+# seconds without an answer after which a transfer asks where to go on from
+TRANSFER_TIMEOUT = 10
+# ..and the times it does so before giving up
+TRANSFER_RETRIES = 5
+
+
+def reconnect_delays() -> Iterator[float]:
+    yield uniform(0, RECONNECT_FIRST)
+
+    delay = RECONNECT_BASE
+    while True:
+        yield uniform(delay / 2, delay)
+        delay = min(delay * 2, RECONNECT_CAP)
 
 
 class Client:
-    def __init__(self, name: str, message_queue: Queue = Queue()) -> None:
+    def __init__(
+        self,
+        name: str,
+        message_queue: Queue = Queue(),
+        port: int = PORT,
+        heartbeat_timeout: float = HEARTBEAT_TIMEOUT,
+    ) -> None:
         self.name = name
+        self.port = port
+        self.heartbeat_timeout = heartbeat_timeout
+        self.send_lock = Lock()
+        # messages sent while the server is unreachable, flushed on reconnect
+        self.pending: Deque[Message] = deque()
         self.queue = message_queue
         self.conn = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.online = True
+        # `online` or `away`, what the other users see
+        self.status = "online"
+        self.received = 0
+        # (upload|download, digest) -> the answers of the server to the transfer
+        self.transfers: Dict[Tuple[str, str], Queue] = dict()
         self.GUPSHUP_FOLDER = os.path.join(HOME, ".config", "gupshup")
         self.CHAT_DATA = os.path.join(self.GUPSHUP_FOLDER, self.name)
         self.setup_db()
@@ -41,7 +93,85 @@ class Client:
             with open(self.CHAT_DATA, "wb") as f:
                 dump(self.chats, f)
 
-        self.start = len(self.chats)
+        # the version of every house's state the app has seen
+        self.versions: Dict[str, int] = dict()
+        # the retention policies of the houses, the chats are pruned to match
+        self.retention: Dict[str, Dict[str, Policy]] = dict()
+        for message in self.chats:
+            self.track_version(message)
+            self.track_retention(message)
+
+        self.prune()
+
+    def track_version(self, message: Message) -> bool:
+        """
+        Keeps the versions of the houses up to date
+        returns `False` for the changes that are already applied
+        """
+
+        match message.action:
+            case "add_house" | "sync_house":
+                house = message.data["house"]
+                self.versions[house.name] = house.version
+                return True
+            case "del_house":
+                self.versions.pop(message.house, None)
+                return True
+
+        version = message.data.get("version")
+        known = self.versions.get(message.house)
+        if version is None or known is None:
+            return True
+
+        if version == known + 1:
+            self.versions[message.house] = version
+            return True
+
+        if version > known + 1:
+            # missed some of the changes, they come with the sync
+            self.sync_house(message.house)
+
+        return False
+
+    def track_retention(self, message: Message) -> None:
+        match message.action:
+            case "add_house" | "sync_house":
+                house = message.data["house"]
+                self.retention[house.name] = dict(house.retention)
+            case "del_house":
+                self.retention.pop(message.house, None)
+            case "change_retention":
+                policies = self.retention.setdefault(message.house, dict())
+                if message.data["policy"]:
+                    policies[message.data["room"]] = message.data["policy"]
+                else:
+                    policies.pop(message.data["room"], None)
+
+    def prune(self) -> None:
+        """
+        Drops the texts the retention policies of their houses don't keep
+        """
+
+        rooms: Dict[Tuple[str, str], List[Message]] = dict()
+        for message in self.chats:
+            if message.action == "push_text" and self.retention.get(message.house):
+                rooms.setdefault((message.house, message.room), []).append(message)
+
+        now = time()
+        gone = set()
+        for (house, room), messages in rooms.items():
+            policy = room_policy(self.retention[house], room)
+            gone.update(id(message) for message in expired(messages, policy, now))
+
+        if gone:
+            self.chats = [message for message in self.chats if id(message) not in gone]
+
+    def last_id(self) -> int:
+        """
+        The id of the newest message recieved, the server sends the ones after it
+        """
+
+        return max([0, *(message.id for message in self.chats)])
 
     def save_chats(self) -> None:
         """
@@ -51,10 +181,263 @@ class Client:
             dump(self.chats, f)
 
     def send(self, message: Message) -> None:
+        # NOTE: the listening thread sends too (pongs)
+        with self.send_lock:
+            if not self.online:
+                if message.action != "pong":
+                    self.pending.append(message)
+                return
+
+            try:
+                self.channel.send(message)
+            except OSError:
+                # the listening thread notices it too and reconnects
+                self.online = False
+                self.pending.append(message)
+                self.channel.close()
+
+    def flush_pending(self) -> None:
+        """
+        Sends the messages queued while offline, in order
+        """
+
+        with self.send_lock:
+            while self.pending:
+                try:
+                    self.channel.send(self.pending[0])
+                except OSError:
+                    return
+
+                self.pending.popleft()
+
+            self.online = True
+
+    def request(self, action: str, house: str, room: str = "", **data) -> None:
+        """
+        Sends a request, the server answers it with a message for this client only
+        """
+
+        self.send(
+            Message(
+                sender=self.name,
+                house=house,
+                room=room,
+                action=action,
+                data=data,
+            )
+        )
+
+    def fetch_history(self, house: str, room: str, before: int = -1) -> None:
+        """
+        Asks for a page of the room's messages older than the message id `before`
+        """
+
+        self.request("fetch_history", house, room, before=before)
+
+    def fetch_members(
+        self, house: str, rank: str, after: str = "", prefix: str = ""
+    ) -> None:
+        """
+        Asks for a page of the rank's members (starting with the prefix)
+        after the name `after`
+        """
+
+        self.request("fetch_members", house, rank=rank, after=after, prefix=prefix)
+
+    def set_status(self, status: str) -> None:
+        self.status = status
+        self.request("set_status", "HOME", status=status)
+
+    def typing(self, house: str, room: str) -> None:
+        """
+        Lets the others in the room know the user is typing
+        """
+
+        self.request("typing", house, room)
+
+    def fetch_presence(self, house: str, users: List[str]) -> None:
+        """
+        Asks for the current status of the users
+        """
+
+        self.request("fetch_presence", house, users=users)
+
+    def sync_house(self, house: str) -> None:
+        """
+        Asks for the changes to the house since the version the app has
+        """
+
+        self.request("sync_house", house, version=self.versions.get(house, 0))
+
+    def sync_houses(self) -> None:
+        for house in list(self.versions):
+            self.sync_house(house)
+
+    def notice(self, house: str, room: str, text: str) -> None:
+        """
+        Shows a text to the user, only in the app
+        """
+
+        self.queue.put(Message(house=house, room=room, text=text, action="push_text"))
+
+    def upload(self, path: str, house: str, room: str) -> None:
+        """
+        Uploads the file in the background and sends it to the room once done
+        an upload cut short (even by closing the app) goes on from where it stopped
+        """
+
+        Thread(target=self._upload, args=(path, house, room), daemon=True).start()
+
+    def _upload(self, path: str, house: str, room: str) -> None:
+        name = os.path.basename(path)
+        try:
+            size = os.path.getsize(path)
+            digest = file_digest(path)
+            with open(path, "rb") as f:
+                self._send_chunks(f, digest, size, name)
+        except (OSError, ValueError) as e:
+            self.notice(house, room, f"Couldn't upload `{name}`: {e}")
+            return
+
+        self.send(
+            Message(
+                sender=self.name,
+                house=house,
+                room=room,
+                text=f"[attachment] {name} ({describe_size(size)}), /download {digest[:8]}",
+                data={"attachment": {"digest": digest, "name": name, "size": size}},
+            )
+        )
+
+    def _send_chunks(self, f, digest: str, size: int, name: str) -> None:
+        """
+        Sends the chunks after the ones the server has, a few at a time
+        raises a `ValueError` for an upload the server refused
+        """
+
+        answers: Queue = Queue()
+        self.transfers[("upload", digest)] = answers
+        try:
+            answer: Dict = {}
+            sent = in_flight = retries = 0
+            while not answer.get("done"):
+                if "error" in answer:
+                    raise ValueError(answer["error"])
+
+                if in_flight == 0:
+                    if answer:
+                        sent = answer["received"]
+                    else:
+                        # asks where to go on from, all of it for a file it has
+                        self.request(
+                            "upload", "HOME", digest=digest, size=size, name=name
+                        )
+                        in_flight = 1
+
+                while answer and in_flight < TRANSFER_WINDOW and sent < size:
+                    f.seek(sent)
+                    chunk = f.read(CHUNK_SIZE)
+                    self.request(
+                        "upload_chunk", "HOME", digest=digest, offset=sent, chunk=chunk
+                    )
+                    sent += len(chunk)
+                    in_flight += 1
+
+                try:
+                    answer = answers.get(timeout=TRANSFER_TIMEOUT)
+                    in_flight, retries = max(in_flight - 1, 0), 0
+                except Empty:
+                    # lost along with the connection, asks again
+                    retries += 1
+                    if retries > TRANSFER_RETRIES:
+                        raise ValueError("the server doesn't answer")
+                    answer, in_flight = {}, 0
+        finally:
+            del self.transfers[("upload", digest)]
+
+    def find_attachment(self, code: str) -> Optional[Dict]:
+        """
+        The newest attachment of the chats whose digest starts with the code
+        """
+
+        for message in reversed(self.chats):
+            attachment = message.data.get("attachment") if message.data else None
+            if attachment and code and attachment["digest"].startswith(code):
+                return attachment
+
+        return None
+
+    def download(self, code: str, house: str, room: str) -> None:
+        """
+        Downloads an attachment of the chats in the background into `~/Downloads`
+        a download cut short goes on from where it stopped
+        """
+
+        attachment = self.find_attachment(code)
+        if attachment is None:
+            self.notice(house, room, f"There is no file `{code}` in the chats")
+            return
+
+        Thread(
+            target=self._download, args=(attachment, house, room), daemon=True
+        ).start()
+
+    def _download(self, attachment: Dict, house: str, room: str) -> None:
+        digest, name = attachment["digest"], os.path.basename(attachment["name"])
+        path = os.path.join(DOWNLOADS, name)
         try:
-            self.channel.send(message)
-        except BrokenPipeError:
-            self.try_reconnect()
+            os.makedirs(DOWNLOADS, exist_ok=True)
+            with open(path + PARTIAL_SUFFIX, "ab") as f:
+                self._receive_chunks(f, digest, attachment["size"])
+
+            if file_digest(path + PARTIAL_SUFFIX) != digest:
+                os.remove(path + PARTIAL_SUFFIX)
+                raise ValueError("the file got corrupted, download it again")
+            os.replace(path + PARTIAL_SUFFIX, path)
+        except (OSError, ValueError) as e:
+            self.notice(house, room, f"Couldn't download `{name}`: {e}")
+            return
+
+        self.notice(house, room, f"Downloaded `{name}` to {path}")
+
+    def _receive_chunks(self, f, digest: str, size: int) -> None:
+        """
+        Asks for the chunks after the ones in the file, a few at a time
+        raises a `ValueError` for a file the server doesn't have
+        """
+
+        answers: Queue = Queue()
+        self.transfers[("download", digest)] = answers
+        try:
+            received = asked = f.tell()
+            in_flight = retries = 0
+            while received < size:
+                while in_flight < TRANSFER_WINDOW and asked < size:
+                    self.request("download", "HOME", digest=digest, offset=asked)
+                    asked += CHUNK_SIZE
+                    in_flight += 1
+
+                try:
+                    answer = answers.get(timeout=TRANSFER_TIMEOUT)
+                    in_flight, retries = max(in_flight - 1, 0), 0
+                except Empty:
+                    # lost along with the connection, asks again
+                    retries += 1
+                    if retries > TRANSFER_RETRIES:
+                        raise ValueError("the server doesn't answer")
+                    asked, in_flight = received, 0
+                    continue
+
+                if "error" in answer:
+                    raise ValueError(answer["error"])
+                # NOTE: the chunks come in order, the ones asked again are skipped
+                if answer["offset"] == received:
+                    if not answer["chunk"]:
+                        raise ValueError("the file is shorter than it should be")
+                    f.write(answer["chunk"])
+                    received += len(answer["chunk"])
+        finally:
+            del self.transfers[("download", digest)]
 
     def close_connection(self):
         self.conn.close()
@@ -67,47 +450,111 @@ class Client:
         while 1:
             try:
                 data = self.channel.recv()
-                self.queue.put(data)
-                self.chats += (data,)
-            except EOFError:
+                match data.action:
+                    case "ping":
+                        self.send(Message(sender=self.name, action="pong"))
+                    case "catch_up":
+                        # the missed messages come in batches when connecting
+                        for message in data.data["messages"]:
+                            self.receive(message)
+                    case "caught_up":
+                        # NOTE: the house changes past what the server held are missed
+                        self.sync_houses()
+                        self.receive(data)
+                    case "upload" | "download":
+                        answers = self.transfers.get((data.action, data.data["digest"]))
+                        if answers is not None:
+                            answers.put(data.data)
+                    case _:
+                        self.receive(data)
+            except (EOFError, OSError):
+                # closed, reset or silent for longer than the heartbeat timeout
+                self.online = False
                 self.queue.put(Message(action="connection_disable"))
-                while not self.try_reconnect():
-                    pass
+                self.reconnect()
                 self.queue.put(Message(action="connection_enable"))
 
-    def try_reconnect(self):
+    def receive(self, data: Message) -> None:
+        if not self.track_version(data):
+            return
+
+        if data.action == "add_house":
+            # the house may have changed since the snapshot was taken
+            self.sync_house(data.data["house"].name)
+
+        self.track_retention(data)
+        self.received += 1
+        if data.action == "change_retention" or self.received % PRUNE_EVERY == 0:
+            self.prune()
+
+        self.queue.put(data)
+        # NOTE: the pages asked for and the live state are not a part of the chats
+        if data.action not in PAGES and data.action not in LIVE:
+            self.chats += (data,)
+
+    def reconnect(self) -> None:
         """
-        Try reconnect on a connection failure
+        Keeps trying to reconnect with an exponential backoff
         """
 
-        try:
-            self.conn.connect((HOST, PORT))
-            self.conn.sendall(self.name.encode())
-            self.channel.close()
+        for delay in reconnect_delays():
+            sleep(delay)
+            if self.try_reconnect():
+                self.sync_houses()
+                if self.status != "online":
+                    self.set_status(self.status)
+                self.flush_pending()
+                if self.online:
+                    return
 
-            self.channel = Channel(self.conn)
-            sleep(0.01)
-            self.conn.sendall("-1".encode())
-            return True
+    def handshake(self, conn: socket.socket) -> Channel:
+        """
+        Says hello with the newest message id the app has, the server
+        sends the messages after it, and waits for the server's welcome
+        """
 
-        except ConnectionRefusedError:
-            return False
+        conn.settimeout(self.heartbeat_timeout)
+        channel = Channel(conn)
+        channel.send(
+            Message(
+                sender=self.name,
+                action="hello",
+                data={"capabilities": sorted(CAPABILITIES), "cursor": self.last_id()},
+            )
+        )
+
+        welcome = channel.recv()
+        if welcome.action != "welcome":
+            raise ConnectionError(f"unexpected answer to hello: {welcome.action}")
+
+        channel.capabilities = set(welcome.data["capabilities"])
+        return channel
 
-        except OSError:
-            self.conn.close()
-            self.conn = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    def try_reconnect(self) -> bool:
+        """
+        Try reconnect on a connection failure
+        """
+
+        conn = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        try:
+            conn.connect((HOST, self.port))
+            channel = self.handshake(conn)
+        except (EOFError, OSError):
+            conn.close()
             return False
 
+        self.channel.close()
+        self.conn = conn
+        self.channel = channel
+        return True
+
     def start_connection(self):
         try:
-            self.conn.connect((HOST, PORT))
-            self.conn.sendall(self.name.encode())
-            sleep(0.01)  # A mild delay for non-mangled recieve
-
-            self.conn.sendall(str(self.start).encode())
-            self.channel = Channel(self.conn)
+            self.conn.connect((HOST, self.port))
+            self.channel = self.handshake(self.conn)
             Thread(target=self.listen_from_server, daemon=True).start()
+            self.sync_houses()
 
-        except ConnectionRefusedError:
+        except (EOFError, OSError):
             print("Looks like the server is down :(")
             exit()
@@ -0,0 +1,180 @@
+from collections import defaultdict
+from typing import TYPE_CHECKING, Dict, List, Tuple, Union
+
+from .houses import LocalHouses, target_house
+from .shards import ShardedHouses
+from .utils import House, HashRing, Message, PubSub, User, debug
+
+if TYPE_CHECKING:
+    from .server import Server
+
+
+class Cluster:
+    """
+    Connects the server to the other nodes of a cluster through a pubsub backbone
+
+    Every house (and user name reservation) is owned by one node picked by a
+    consistent hash ring of the node names, the messages for houses owned by
+    other nodes are forwarded to them. Presence is shared so that every node
+    knows where a user is connected and forwards the messages accordingly
+
+    Topics:
+        node/<name>: ("process", message), ("add_user", name), ("deliver", message, users)
+        presence: ("hello", node), ("online", user, node), ("offline", user, node)
+        users: (node, user)
+    """
+
+    def __init__(
+        self,
+        server: "Server",
+        node: str,
+        nodes: List[str],
+        pubsub: PubSub,
+        local: Union[LocalHouses, ShardedHouses],
+    ) -> None:
+        self.server = server
+        self.node = node
+        self.ring: HashRing[str] = HashRing(nodes)
+        self.pubsub = pubsub
+        self.local = local
+
+        # user -> (node, online)
+        self.presence: Dict[str, Tuple[str, bool]] = dict()
+
+        pubsub.subscribe(f"node/{node}", self._on_node_message)
+        pubsub.subscribe("presence", self._on_presence)
+        pubsub.subscribe("users", self._on_user)
+        pubsub.publish("presence", ("hello", node))
+
+    def _owner(self, key: str) -> str:
+        return self.ring.get(key)
+
+    def _send(self, node: str, *payload) -> None:
+        self.pubsub.publish(f"node/{node}", payload)
+
+    # +------------------------------------+
+    # | The router interface for houses    |
+    # +------------------------------------+
+
+    def submit(self, message: Message) -> None:
+        owner = self._owner(target_house(message))
+        if owner == self.node:
+            self.local.submit(message)
+        else:
+            self._send(owner, "process", message)
+
+    def add_user(self, username: str) -> None:
+        owner = self._owner(username)
+        if owner == self.node:
+            self.local.add_user(username)
+        else:
+            self._send(owner, "add_user", username)
+
+    def snapshot(self) -> Dict[str, House]:
+        return self.local.snapshot()
+
+    def close(self) -> None:
+        self.local.close()
+        self.pubsub.close()
+
+    # +------------------------------------+
+    # | Presence and delivery              |
+    # +------------------------------------+
+
+    def is_online(self, user: str) -> bool:
+        return user in self.server.users or self.presence.get(user, ("", False))[1]
+
+    def node_of(self, user: str) -> str:
+        """
+        The node the user is (or was last) connected to
+        """
+
+        if user in self.server.users:
+            return self.node
+
+        return self.presence.get(user, (self.node, False))[0]
+
+    def route(self, message: Message, reciepents: List[str]) -> List[str]:
+        """
+        Forwards the message to the nodes of the remote reciepents
+        and returns the ones to be delivered by this node
+        """
+
+        local: List[str] = []
+        remote: Dict[str, List[str]] = defaultdict(list)
+        for user in reciepents:
+            node = self.node_of(user)
+            if node == self.node:
+                local.append(user)
+            else:
+                remote[node].append(user)
+
+        for node, users in remote.items():
+            self._send(node, "deliver", message, users)
+
+        return local
+
+    def online(self, user: str) -> None:
+        self.presence[user] = (self.node, True)
+        self.pubsub.publish("presence", ("online", user, self.node))
+
+    def offline(self, user: str) -> None:
+        self.presence[user] = (self.node, False)
+        self.pubsub.publish("presence", ("offline", user, self.node))
+
+    def publish_user(self, user: User) -> None:
+        """
+        Replicates a user record (like its ban list) to the other nodes
+        """
+
+        self.pubsub.publish("users", (self.node, user))
+
+    # +------------------------------------+
+    # | Pubsub callbacks                   |
+    # +------------------------------------+
+
+    def _on_node_message(self, payload: tuple) -> None:
+        op, *args = payload
+        match op:
+            case "process":
+                self.local.submit(*args)
+            case "add_user":
+                self.local.add_user(*args)
+            case "deliver":
+                message, users = args
+                self.server.worker_queue.put((message, users, False))
+
+    def _on_presence(self, payload: tuple) -> None:
+        op, *args = payload
+        if op == "hello":
+            (node,) = args
+            if node == self.node:
+                return
+
+            debug(f"node {node} joined the cluster")
+            # let the new node know about our users
+            for user in list(self.server.users):
+                self.pubsub.publish("presence", ("online", user, self.node))
+
+            for name, user in list(self.server.user_db.items()):
+                if self._owner(name) == self.node:
+                    self.publish_user(user)
+
+            return
+
+        user, node = args
+        if node != self.node:
+            self.presence[user] = (node, op == "online")
+
+    def _on_user(self, payload: Tuple[str, User]) -> None:
+        node, user = payload
+        if node != self.node:
+            with self.server.login_lock:
+                previous = self.server.user_db.get(user.username)
+                self.server.user_db[user.username] = user
+                self.server.blocks.replace(
+                    user.username,
+                    previous.banned if previous else frozenset(),
+                    user.banned,
+                )
+                self.server.storage.put_user(user)
@@ -0,0 +1,279 @@
+from collections import deque
+from copy import deepcopy
+from queue import Queue
+from threading import Lock, RLock, Thread
+from typing import Callable, Deque, Dict, FrozenSet, Iterable, List, Optional, Set
+from .utils import Message, House, err
+from .utils.house import is_valid_name
+
+Deliver = Callable[[List[Message]], None]
+Store = Callable[[House], None]
+
+# threads running the houses and how many messages a house processes
+# before making way for the others waiting
+ACTOR_WORKERS = 4
+ACTOR_BATCH = 32
+
+
+def decorate(message: Message, house: Optional[House] = None) -> Message:
+    """
+    Sets how the sender's name is shown, with the sender's rank color
+    and icon when sent inside a house, the clients add the markup
+    """
+
+    if message.sender == "SERVER":
+        message.color = "red"
+    elif house is not None and message.house == house.name:
+        message.color, message.icon = house.sender_style(message.sender)
+    else:
+        message.color = "magenta"
+
+    return message
+
+
+def is_reservation(house: House) -> bool:
+    """
+    If it's one of the empty houses the older servers made to reserve the user names
+    """
+
+    return (
+        house.name == house.king
+        and house.members == {house.king}
+        and house.rooms == {"general"}
+        and house.version == 0
+    )
+
+
+def added_bot(message: Message) -> str:
+    """
+    The name of the bot `/add_bot (name)` adds, empty for the other texts
+    """
+
+    action, _, name = message.text.partition(" ")
+    return name.strip() if action == "/add_bot" else ""
+
+
+def target_house(message: Message) -> str:
+    """
+    The name of the house a message has to be processed by
+    """
+
+    if message.house != "HOME":
+        return message.house
+
+    # `/join (name)` and `/add_house (name)` sent from `HOME/general`
+    _, _, name = message.text.partition(" ")
+    return name.strip()
+
+
+class LocalHouses:
+    """
+    Owns the houses of this process and processes the messages sent to them
+
+    Every house is an actor with its own mailbox, the submitted messages
+    wait in it and are processed strictly in order by one of a pool of
+    workers, a few at a time so that a busy house doesn't hold up the quiet
+    ones. The readers from outside get a copy of the houses taken under
+    their locks
+    """
+
+    def __init__(
+        self,
+        houses: Dict[str, House],
+        deliver: Optional[Deliver] = None,
+        store: Optional[Store] = None,
+        reserved: Iterable[str] = (),
+        bots: Iterable[str] = (),
+        workers: int = ACTOR_WORKERS,
+    ) -> None:
+        self.houses = houses
+        self.deliver = deliver
+        # writes a changed house through to the storage
+        self.store = store
+
+        # the user names, no house can take one of them
+        self.reserved: Set[str] = set(reserved)
+        for name in [name for name, house in houses.items() if is_reservation(house)]:
+            del houses[name]
+            self.reserved.add(name)
+        # the bots the server runs, only those can be added to a house
+        self.bots: FrozenSet[str] = frozenset(bots)
+
+        # house name -> its lock, the names of no house share the one for creating them
+        # NOTE: only the houses have one, the names are sent by the users
+        self.locks: Dict[str, RLock] = {name: RLock() for name in houses}
+        self.create_lock = RLock()
+        self.locks_lock = Lock()
+
+        # house name -> its waiting messages, the houses with a worker
+        # on them (or waiting for one) are scheduled
+        self.mailboxes: Dict[str, Deque[Message]] = dict()
+        self.scheduled: Set[str] = set()
+        self.ready: Queue = Queue()
+        self.mailbox_lock = Lock()
+
+        # NOTE: the shards process the messages themselves, with no deliver
+        if deliver is not None:
+            for _ in range(workers):
+                Thread(target=self._work, daemon=True).start()
+
+    def _lock(self, name: str) -> RLock:
+        with self.locks_lock:
+            return self.locks.get(name, self.create_lock)
+
+    def submit(self, message: Message) -> None:
+        """
+        Puts the message in its house's mailbox, the results
+        are handed over for delivery once processed
+        """
+
+        name = target_house(message)
+        with self.mailbox_lock:
+            self.mailboxes.setdefault(name, deque()).append(message)
+            if name not in self.scheduled:
+                self.scheduled.add(name)
+                self.ready.put(name)
+
+    def _work(self) -> None:
+        while True:
+            self._run(self.ready.get())
+
+    def _run(self, name: str) -> None:
+        """
+        Processes a batch of the house's messages
+        """
+
+        for _ in range(ACTOR_BATCH):
+            with self.mailbox_lock:
+                mailbox = self.mailboxes[name]
+                if not mailbox:
+                    del self.mailboxes[name]
+                    self.scheduled.discard(name)
+                    return
+
+                message = mailbox.popleft()
+
+            try:
+                self.deliver(self.process(message))
+            except Exception as e:
+                err(f"house {name}: {e}")
+
+        # more to go, after the other houses waiting
+        self.ready.put(name)
+
+    def process(self, message: Message) -> List[Message]:
+        name = target_house(message)
+        with self._lock(name):
+            message_list = self._process(message)
+
+            # NOTE: only the commands change a house, the texts and requests don't
+            if (
+                self.store is not None
+                and not message.action
+                and message.text.startswith("/")
+                and name in self.houses
+            ):
+                self.store(self.houses[name])
+
+            return message_list
+
+    def _process(self, message: Message) -> List[Message]:
+        if message.house == "HOME":
+            action, *_ = message.text[1:].split(" ", 1)
+            message_list = (
+                self.join(message) if action == "join" else self.add_house(message)
+            )
+        elif message.house not in self.houses:
+            return []
+        elif message.action == "presence" and message.sender == "SERVER":
+            message_list = self.houses[message.house].share_presence(message)
+        elif message.action:
+            message_list = self.houses[message.house].process_request(message)
+        elif added_bot(message) not in self.bots | {""}:
+            message_list = [
+                message.convert(
+                    text=f"there is no bot with the name {added_bot(message)}"
+                )
+            ]
+        else:
+            message_list = self.houses[message.house].process_message(message)
+
+        for m in message_list:
+            house = self.houses.get(m.house)
+            if house is not None and m.action == "push_text":
+                m.room_wide = set(m.reciepents) == house.members
+
+            decorate(m, house)
+
+        return message_list
+
+    def join(self, message: Message) -> List[Message]:
+        """
+        Join a house
+        """
+
+        house = target_house(message)
+        if house not in self.houses:
+            return [message.convert(text="No such house")]
+
+        return self.houses[house].process_message(message)
+
+    def add_house(self, message: Message) -> List[Message]:
+        """
+        Create your brand new house
+        """
+
+        param = target_house(message)
+        if not param:
+            return [
+                message.convert(
+                    text="The house must have a name",
+                )
+            ]
+        elif not is_valid_name(param):
+            return [
+                message.convert(
+                    text=f"A house can't be named {param}",
+                )
+            ]
+        elif param in self.houses or param in self.reserved:
+            return [
+                message.convert(
+                    text="There is already a house with same name",
+                )
+            ]
+        else:
+            message.house = param
+            with self.locks_lock:
+                self.locks[param] = RLock()
+            self.houses[param] = House(param, message.sender)
+            return [
+                message.convert(
+                    action="add_house",
+                    data={"house": self.houses[param]._generate_house_data()},
+                )
+            ]
+
+    def add_user(self, username: str) -> None:
+        """
+        Reserves the user's name so that no house can take it
+        """
+
+        # NOTE: along with the houses being created, a house can't take it meanwhile
+        with self.create_lock:
+            self.reserved.add(username)
+
+    def snapshot(self) -> Dict[str, House]:
+        """
+        A copy of the houses, each one copied in a consistent state
+        """
+
+        snapshot = dict()
+        for name in list(self.houses):
+            with self._lock(name):
+                snapshot[name] = deepcopy(self.houses[name])
+
+        return snapshot
+
+    def close(self) -> None:
+        pass
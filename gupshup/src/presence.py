@@ -0,0 +1,132 @@
+from threading import Lock, Thread
+from time import sleep
+from typing import TYPE_CHECKING, Dict, List
+
+from .utils import Message, house_key, key_room
+
+if TYPE_CHECKING:
+    from .server import Server
+
+# seconds between the batches of presence changes sent out
+PRESENCE_TICK = 0.5
+
+# what a user can set its own status to, `offline` is set on disconnect
+STATUSES = ("online", "away")
+
+
+def _new_batch() -> dict:
+    return {"status": dict(), "typing": dict()}
+
+
+class Presence:
+    """
+    Keeps track of who is online, away or typing and shares the changes
+
+    The changes are not sent as they happen, they are collected and sent once
+    per tick as a single `presence` message for every house (and every contact
+    of the direct chats) that changed, so a house full of members coming and
+    going gets a message per tick instead of one per member for every member
+
+    The data of a `presence` message:
+        status: user -> `online`, `away` or `offline`
+        typing: room -> the users typing in it
+    """
+
+    def __init__(self, server: "Server", tick: float = PRESENCE_TICK) -> None:
+        self.server = server
+        self.tick = tick
+
+        # the users not online have no status
+        self.status: Dict[str, str] = dict()
+
+        # the batches being collected for the houses and for the contacts
+        self.houses: Dict[str, dict] = dict()
+        self.contacts: Dict[str, dict] = dict()
+        self.lock = Lock()
+
+        Thread(target=self._flush_loop, daemon=True).start()
+
+    def _contacts(self, user: str) -> List[str]:
+        """
+        The users with a direct chat with the user
+        """
+
+        return [
+            key_room(key)
+            for key in self.server.history.rooms(house_key(user, "HOME"))
+            if key_room(key) != "general"
+        ]
+
+    def set_status(self, user: str, status: str) -> None:
+        with self.lock:
+            if self.status.get(user, "offline") == status:
+                return
+
+            if status == "offline":
+                self.status.pop(user, None)
+            else:
+                self.status[user] = status
+
+            record = self.server.user_db.get(user)
+            for house in record.houses if record else ():
+                self.houses.setdefault(house, _new_batch())["status"][user] = status
+
+            for contact in self._contacts(user):
+                self.contacts.setdefault(contact, _new_batch())["status"][user] = status
+
+    def typing(self, user: str, house: str, room: str) -> None:
+        record = self.server.user_db.get(user)
+        if record is None:
+            return
+
+        with self.lock:
+            if house == "HOME":
+                if room not in self.server.user_db or self.server.blocks.has_blocked(
+                    room, user
+                ):
+                    return
+
+                # the contact sees the direct chat as the room named after the user
+                batch = self.contacts.setdefault(room, _new_batch())
+                batch["typing"][user] = [user]
+            elif record.has_joined(house):
+                batch = self.houses.setdefault(house, _new_batch())
+                users = batch["typing"].setdefault(room, [])
+                if user not in users:
+                    users.append(user)
+
+    def of(self, users: List[str]) -> Dict[str, str]:
+        """
+        The current status of the users
+        """
+
+        return {
+            user: self.status.get(user)
+            or ("online" if self.server.is_online(user) else "offline")
+            for user in users
+        }
+
+    def _flush_loop(self) -> None:
+        while True:
+            sleep(self.tick)
+            with self.lock:
+                houses, self.houses = self.houses, dict()
+                contacts, self.contacts = self.contacts, dict()
+
+            # the houses send it to all of their members
+            for house, batch in houses.items():
+                self.server.router.submit(
+                    Message(house=house, action="presence", data=batch)
+                )
+
+            self.server.deliver(
+                [
+                    Message(
+                        house="HOME",
+                        action="presence",
+                        data=batch,
+                        reciepents=[contact],
+                    )
+                    for contact, batch in contacts.items()
+                ]
+            )
@@ -1,26 +1,98 @@
 import socket
 import os
-from pickle import dump, load
-from time import sleep
+from collections import deque
+from heapq import merge
+from itertools import islice
 from queue import Queue
-from threading import Thread
-from typing import Dict, List
+from threading import BoundedSemaphore, Event, Thread, Lock, Timer
+from time import monotonic, sleep, time
+from typing import (
+    Deque,
+    Dict,
+    FrozenSet,
+    Iterator,
+    List,
+    Optional,
+    Sequence,
+    Set,
+    Tuple,
+)
 from .utils import (
     Message,
     House,
     User,
+    BlockIndex,
     Channel,
+    Outbox,
+    PubSub,
+    SearchIndex,
+    Storage,
+    FileStorage,
+    SqliteStorage,
+    house_key,
+    room_key,
+    key_room,
     warn,
     info,
     debug,
     err,
 )
+from .houses import LocalHouses, decorate
+from .shards import ShardedHouses
+from .cluster import Cluster
+from .presence import Presence, STATUSES
+from .bots import Bot, Bots
+from .utils.history import PAGE_SIZE, MAX_PAGE_SIZE
+from .utils.attachments import CHUNK_SIZE, AttachmentStore
+from .utils.channel import Frames
+from .utils.message import CAPABILITIES, PAGES, LIVE
+from .utils.retention import Policy, room_policy
+from .utils.search import MAX_PAGES as MAX_SEARCH_PAGES
 
 HOST = "localhost"
 PORT = 5500
 
 HOME = os.path.expanduser("~")
 SERVER_DATA = os.path.join(HOME, ".config", "gupshup", "server_data")
+ROOMS_FOLDER = os.path.join(HOME, ".config", "gupshup", "rooms")
+INBOXES_FOLDER = os.path.join(HOME, ".config", "gupshup", "inboxes")
+SEARCH_FOLDER = os.path.join(HOME, ".config", "gupshup", "search")
+IDS_DATA = os.path.join(HOME, ".config", "gupshup", "ids")
+SQLITE_DATA = os.path.join(HOME, ".config", "gupshup", "server.db")
+ATTACHMENTS_FOLDER = os.path.join(HOME, ".config", "gupshup", "attachments")
+
+# ids reserved on disk at a time
+ID_BLOCK = 10_000
+
+# seconds between the pings sent to the users
+# and of silence after which a user is considered gone
+HEARTBEAT_INTERVAL = 10
+HEARTBEAT_TIMEOUT = 30
+
+# missed messages sent in a single frame when a user catches up
+CATCHUP_BATCH = 500
+# the messages not in the store (like the house changes and the pages asked for)
+# kept for a deferred user, the house changes past it are caught up with `sync_house`
+HELD_SIZE = 1024
+
+# seconds a new connection has to say hello, and how many can be saying it at once
+HANDSHAKE_TIMEOUT = 5
+MAX_PENDING_HANDSHAKES = 64
+MAX_HELLO_SIZE = 4096
+
+# the largest frame a user can send, an upload chunk with the message around it
+MAX_FRAME_SIZE = CHUNK_SIZE + 4096
+
+# the longest name of a file shared in a chat
+MAX_FILE_NAME = 255
+
+# connections waiting to be accepted, a restart brings all the users back at once
+LISTEN_BACKLOG = 1024
+
+# seconds between the sweeps dropping the messages outside the retention policies
+SWEEP_INTERVAL = 10 * 60
+# the texts of the inboxes are kept for a month, their state changes for good
+INBOX_RETENTION: Policy = {"age": 30 * 24 * 60 * 60, "count": 1000}
 
 
 class Server:
@@ -28,75 +100,768 @@ class Server:
     A server class for processing the server work
     """
 
-    def __init__(self) -> None:
+    def __init__(
+        self,
+        slow_policy: str = "defer",
+        shards: int = 0,
+        port: int = PORT,
+        node: str = "",
+        nodes: Optional[List[str]] = None,
+        pubsub: Optional[PubSub] = None,
+        heartbeat_interval: float = HEARTBEAT_INTERVAL,
+        heartbeat_timeout: float = HEARTBEAT_TIMEOUT,
+        handshake_timeout: float = HANDSHAKE_TIMEOUT,
+        max_pending_handshakes: int = MAX_PENDING_HANDSHAKES,
+        sweep_interval: float = SWEEP_INTERVAL,
+        storage: str = "file",
+        bots: Sequence[Bot] = (),
+    ) -> None:
         self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        self.server.bind((HOST, PORT))
-        self.users: Dict[str, Channel] = dict()
+        self.server.bind((HOST, port))
+        self.users: Dict[str, Outbox] = dict()
         self.worker_queue = Queue()
 
+        # when was something last heard from a user
+        self.last_seen: Dict[str, float] = dict()
+        self.heartbeat_interval = heartbeat_interval
+        self.heartbeat_timeout = heartbeat_timeout
+
+        self.handshake_timeout = handshake_timeout
+        self.handshakes = BoundedSemaphore(max_pending_handshakes)
+        self.login_lock = Lock()
+        self.sweep_interval = sweep_interval
+
+        # what to do with users that can't keep up: `drop`, `defer` or `disconnect`
+        # deferred users are later resumed from the id of the first message they missed
+        self.slow_policy = slow_policy
+        self.deferred: Dict[str, int] = dict()
+        # the outboxes being sent what their users missed
+        self.catching_up: Set[Outbox] = set()
+        # the messages a deferred user gets after the catch-up, the store doesn't have them
+        self.held: Dict[str, Deque[Message]] = dict()
+        self.deferred_lock = Lock()
+
         # READS THE OFFLINE DATA PRESENT
         try:
             os.mkdir(os.path.join(HOME, ".config", "gupshup"))
         except FileExistsError:
             pass
 
+        # every node of a cluster keeps its own data
+        suffix = f".{node}" if node else ""
+        self.ids_file = IDS_DATA + suffix
+
+        # the texts sent to a room are kept once in the room's log,
+        # the inboxes only have the ones meant for a single user
+        self.storage = self._open_storage(storage, suffix)
+        self.history = self.storage.history
+        self.inboxes = self.storage.inboxes
+        # the files shared in the chats, the texts only have their digests
+        self.attachments = AttachmentStore(ATTACHMENTS_FOLDER + suffix)
+
+        # NOTE: only the metadata (houses and users) is read upfront, the
+        # messages are read when first needed and the search index is
+        # read in the background so the startup doesn't grow with them
+        houses, self.user_db, self.retention = self.storage.load()
+        # who blocked whom in the direct chats, kept along with the user records
+        self.blocks = BlockIndex(self.user_db.values())
+        # the rooms of every house, the catch-ups read only their logs
+        self.rooms: Dict[str, FrozenSet[str]] = {
+            name: frozenset(house.rooms) for name, house in houses.items()
+        }
+
+        self._search: Optional[SearchIndex] = None
+        self.search_ready = Event()
+        # the messages to index once it's loaded, the broadcasts never wait for it
+        self.unindexed: List[Tuple[str, Message]] = []
+        Thread(target=self._load_search, daemon=True).start()
+
+        # ids are reserved a block at a time so that none is given twice
+        # even if the server goes down without saving
         try:
-            with open(SERVER_DATA, "rb") as f:
-                (
-                    self.houses,
-                    self.user_messages,
-                    self.user_db,
-                ) = load(f)
-
+            with open(self.ids_file) as f:
+                self.next_id = int(f.read())
         except FileNotFoundError:
-            self.houses: Dict[str, House] = dict()
-            self.user_messages: Dict[str, List[Message]] = dict()
-            self.user_db: Dict[str, User] = dict()
-            # self.save_data()
+            self.next_id = 1 + max(self.history.last_id(), self.inboxes.last_id())
+        self._reserve_ids()
+
+        # the bots of the houses run apart, they never hold up a house
+        self.bots = Bots(self, bots, houses)
+
+        # the houses either live in this process or are partitioned
+        # across `shards` worker processes
+        store = self.storage.put_house if self.storage.write_through else None
+        if shards:
+            self.router = ShardedHouses(
+                houses,
+                shards,
+                self.deliver,
+                store,
+                reserved=self.user_db,
+                bots=self.bots.bots,
+            )
+            info(f"houses are sharded across {shards} processes")
+        else:
+            self.router = LocalHouses(
+                houses, self.deliver, store, reserved=self.user_db, bots=self.bots.bots
+            )
+
+        # ..and in a cluster the houses owned by other nodes are forwarded to them
+        self.cluster: Optional[Cluster] = None
+        if pubsub is not None:
+            self.router = self.cluster = Cluster(
+                self, node, nodes or [node], pubsub, self.router
+            )
+            info(f"node {node} joined the cluster {nodes}")
+
+        self.presence = Presence(self)
 
         Thread(target=self._execute_queue, daemon=True).start()
+        Thread(target=self._heartbeat, daemon=True).start()
+        Thread(target=self._sweeper, daemon=True).start()
+
+    def _open_storage(self, storage: str, suffix: str) -> Storage:
+        files = FileStorage(
+            SERVER_DATA + suffix,
+            SEARCH_FOLDER + suffix,
+            ROOMS_FOLDER + suffix,
+            INBOXES_FOLDER + suffix,
+        )
+        if storage == "file":
+            return files
+
+        database = SqliteStorage(SQLITE_DATA + suffix)
+        if database.is_empty() and not files.is_empty():
+            info("moving the data files into the database")
+            database.import_from(files)
+        files.close()
+
+        return database
+
+    def _load_search(self) -> None:
+        search = self.storage.load_search()
+        # NOTE: the broadcasts queue the messages under the same lock
+        with self.deferred_lock:
+            for key, message in self.unindexed:
+                search.add(key, message)
+            self.unindexed.clear()
+            self._search = search
+            self.search_ready.set()
+
+    @property
+    def search(self) -> SearchIndex:
+        self.search_ready.wait()
+        return self._search
+
+    def _reserve_ids(self) -> None:
+        self.reserved_id = self.next_id + ID_BLOCK
+        with open(self.ids_file, "w") as f:
+            f.write(str(self.reserved_id))
+            f.flush()
+            os.fsync(f.fileno())
 
     def _execute_queue(self) -> None:
         while True:
-            while not self.worker_queue.empty():
-                self.broadcast(*self.worker_queue.get())
+            self.broadcast(*self.worker_queue.get())
+
+    def _heartbeat(self) -> None:
+        """
+        Pings the users and drops the ones that went silent
+        so that half-open connections don't linger around
+        """
+
+        while True:
+            sleep(self.heartbeat_interval)
+            now = monotonic()
+            for user, outbox in list(self.users.items()):
+                if now - self.last_seen.get(user, now) > self.heartbeat_timeout:
+                    warn(f"{user} timed out")
+                    outbox.close()
+                else:
+                    outbox.push(Message(action="ping"), force=True)
+
+    def _sweeper(self) -> None:
+        # NOTE: right away too, the expired messages only hidden are back after a restart
+        while True:
+            try:
+                self.sweep()
+            except Exception as e:
+                err(e)
+            sleep(self.sweep_interval)
+
+    def sweep(self, now: Optional[float] = None) -> int:
+        """
+        Drops the messages outside the retention policies of their houses
+        (and the old texts of the inboxes), returns how many were dropped
+        """
+
+        now = time() if now is None else now
+        with self.deferred_lock:
+            retention = {house: dict(rooms) for house, rooms in self.retention.items()}
+
+        dropped: List[int] = []
+        # NOTE: every log of the house, the ones not opened since the start too
+        for house, rooms in retention.items():
+            for key in self.history.rooms(house_key("", house)):
+                policy = room_policy(rooms, key_room(key))
+                log = self.history.get(key)
+                if not policy or log is None:
+                    continue
+
+                gone = log.expire(policy, now)
+                if gone:
+                    self.search.forget(key, gone)
+                dropped += gone
+
+        for _, log in self.inboxes.opened():
+            dropped += log.expire(
+                INBOX_RETENTION, now, keep=lambda m: m.action != "push_text"
+            )
+
+        if dropped:
+            debug(f"swept {len(dropped)} expired messages")
+
+        uploads = self.attachments.sweep(now)
+        if uploads:
+            debug(f"swept {len(uploads)} abandoned uploads")
+
+        return len(dropped)
+
+    def _disconnect(self, user: str, outbox: Outbox) -> None:
+        """
+        Cleans up the state of a user whose connection is gone
+        """
+
+        outbox.close()
+        # NOTE: along with the logins, a user logging in again is never left offline
+        with self.login_lock:
+            with self.deferred_lock:
+                # a reconnected user already has a new outbox
+                if self.users.get(user) is not outbox:
+                    return
+
+                del self.users[user]
+                self.deferred.pop(user, None)
+                self.held.pop(user, None)
+                self.last_seen.pop(user, None)
+
+            info(f"{user} disconnected")
+            if self.cluster:
+                self.cluster.offline(user)
+
+            self.presence.set_status(user, "offline")
+
+    def _push(
+        self,
+        user: str,
+        message: Message,
+        frames: Optional[Frames] = None,
+        replayed: bool = True,
+    ) -> None:
+        """
+        Pushes the message to the user's outbox applying the slow consumer policy
+        the ones a deferred user can't catch up on (not `replayed`) are held till then
+        """
+
+        if user not in self.users:
+            return
+
+        outbox = self.users[user]
+        if (
+            message.action == "presence"
+            and "presence" not in outbox.channel.capabilities
+        ):
+            return
+
+        if user in self.deferred:
+            if not replayed:
+                self._hold(user, message)
+            return
+
+        if outbox.push(message, frames=frames):
+            return
+
+        if outbox.closed:
+            return
+
+        match self.slow_policy:
+            case "drop":
+                outbox.dropped += 1
+            case "defer":
+                warn(f"{user} is lagging behind {outbox.stats()}, deferring")
+                self.deferred[user] = message.id
+                if not replayed:
+                    self._hold(user, message)
+            case "disconnect":
+                warn(f"{user} is lagging behind {outbox.stats()}, disconnecting")
+                outbox.close()
+
+    def _hold(self, user: str, message: Message) -> None:
+        held = self.held.get(user)
+        if held is None:
+            held = self.held[user] = deque(maxlen=HELD_SIZE)
+
+        held.append(message)
+
+    def _resume(self, user: str) -> None:
+        """
+        Starts the catch-up of a deferred user unless it's already going on
+        """
+
+        with self.deferred_lock:
+            outbox = self.users.get(user)
+            if (
+                user not in self.deferred
+                or outbox is None
+                or outbox in self.catching_up
+            ):
+                return
+
+            self.catching_up.add(outbox)
+
+        Thread(target=self._catch_up, args=(user, outbox), daemon=True).start()
+
+    def _catch_up(self, user: str, outbox: Outbox) -> None:
+        """
+        Sends the messages a deferred user missed from the offline store,
+        in batches of `CATCHUP_BATCH` straight to the user's outbox
+
+        The live messages keep going to the store meanwhile, only the last
+        few are sent holding the lock before the user is live again
+        """
+
+        try:
+            with self.deferred_lock:
+                last = self.deferred.get(user, 0) - 1
+
+            while True:
+                batch = list(islice(self._since(user, last), CATCHUP_BATCH))
+                if len(batch) < CATCHUP_BATCH:
+                    break
+
+                if not outbox.wait_for_room():
+                    return
+
+                outbox.push(
+                    Message(action="catch_up", data={"messages": batch}), force=True
+                )
+                last = batch[-1].id
+
+            with self.deferred_lock:
+                if self.users.get(user) is not outbox or user not in self.deferred:
+                    return
+
+                batch = list(self._since(user, last))
+                if batch:
+                    outbox.push(
+                        Message(action="catch_up", data={"messages": batch}),
+                        force=True,
+                    )
+                # the house changes and the pages sent meanwhile
+                for message in self.held.pop(user, ()):
+                    outbox.push(message, force=True)
+                outbox.push(Message(action="caught_up"), force=True)
+                del self.deferred[user]
+                # NOTE: along with it, a user deferred right after must be resumed again
+                self.catching_up.discard(outbox)
+
+        finally:
+            with self.deferred_lock:
+                self.catching_up.discard(outbox)
+
+    def _since(self, user: str, id: int) -> Iterator[Message]:
+        """
+        The messages for the user newer than the id, from the user's inbox
+        and the logs of the user's rooms merged in the order they were sent
+        """
+
+        inbox = self.inboxes.get(user)
+        sources = [inbox.after(id)] if inbox is not None else []
+
+        record = self.user_db[user]
+        keys = self.history.rooms(house_key(user, "HOME"))
+        for house in record.houses:
+            keys += [room_key(user, house, room) for room in self.rooms.get(house, ())]
+
+        for key in keys:
+            log = self.history.get(key)
+            if log is not None:
+                # NOTE: the rooms of a house are read from when the user joined it
+                start = max(id, record.cursors.get(key, 0))
+                sources.append(log.after(start))
+
+        return merge(*sources, key=lambda m: m.id)
+
+    def lag_stats(self) -> Dict[str, dict]:
+        """
+        Outbound buffer metrics for every connected user
+        """
+
+        return {user: outbox.stats() for user, outbox in list(self.users.items())}
+
+    def compression_stats(self) -> Dict[str, float]:
+        """
+        How much the compression saves over all the connected users
+        """
+
+        raw = compressed = 0
+        for outbox in list(self.users.values()):
+            stats = outbox.channel.compression_stats()
+            raw += stats["raw_bytes"]
+            compressed += stats["compressed_bytes"]
+
+        return {
+            "raw_bytes": raw,
+            "compressed_bytes": compressed,
+            "compression_ratio": raw / compressed if compressed else 1.0,
+        }
+
+    def deliver(self, message_list: List[Message]) -> None:
+        """
+        Queues the processed messages for broadcasting
+        """
+
+        for message in message_list:
+            recipients = message.take_recipients()
+            self.worker_queue.put((message, recipients))
+
+    def _track(self, message: Message, reciepents: List[str]) -> None:
+        """
+        Keeps the search index and the houses of the users
+        up to date with the messages going through
+        """
+
+        self.bots.track(message)
+        match message.action:
+            case "add_house":
+                house = message.data["house"]
+                self.rooms[house.name] = frozenset(house.rooms)
+                self.retention[house.name] = dict(house.retention)
+                self.storage.put_retention(house.name, house.retention)
+                for user in reciepents:
+                    if user in self.user_db:
+                        self.user_db[user].join(
+                            house.name,
+                            {
+                                room_key(user, house.name, room): message.id
+                                for room in house.rooms
+                            },
+                        )
+                        self.storage.put_user(self.user_db[user])
+            case "del_house":
+                for user in reciepents:
+                    if user in self.user_db:
+                        self.user_db[user].leave(message.house)
+                        self.storage.put_user(self.user_db[user])
+            case "add_room" if message.house != "HOME":
+                rooms = self.rooms.get(message.house, frozenset())
+                self.rooms[message.house] = rooms | {message.data["room"]}
+            case "del_room" if message.house != "HOME":
+                rooms = self.rooms.get(message.house, frozenset())
+                self.rooms[message.house] = rooms - {message.room}
+            case "change_room_name" if message.house != "HOME":
+                rooms = self.rooms.get(message.house, frozenset())
+                self.rooms[message.house] = (rooms - {message.room}) | {
+                    message.data["name"]
+                }
+            case "change_retention":
+                policies = self.retention.setdefault(message.house, dict())
+                if message.data["policy"]:
+                    policies[message.data["room"]] = message.data["policy"]
+                else:
+                    policies.pop(message.data["room"], None)
+                self.storage.put_retention(message.house, policies)
+            case "push_text" if reciepents:
+                if message.house != "HOME":
+                    keys = [room_key("", message.house, message.room)]
+                    keys = keys if message.room_wide else []
+                else:
+                    keys = [room_key(user, "HOME", message.room) for user in reciepents]
+
+                for key in keys:
+                    self.history.append(key, message)
+                    if self.search_ready.is_set():
+                        self._search.add(key, message)
+                    else:
+                        self.unindexed.append((key, message))
+
+    # +-------------------------------------+
+    # | Requests answered straight away     |
+    # | without going through the inbox     |
+    # +-------------------------------------+
+
+    # SYNTAX : request_<action>(message: Message) -> Optional[Message]
+    # the requests for a house are answered by the house when processed
+    def request_fetch_history(self, message: Message) -> Message:
+        """
+        A page of a room's history older than the message id `before`
+        """
+
+        before = int(message.data.get("before", -1))
+        limit = min(int(message.data.get("limit", PAGE_SIZE)), MAX_PAGE_SIZE)
+
+        user = self.user_db[message.sender]
+        log = self.history.get(room_key(user.username, message.house, message.room))
+        if log is None or (
+            message.house != "HOME" and not user.has_joined(message.house)
+        ):
+            messages, more = [], False
+        else:
+            messages, more = log.page(before, limit)
+
+        return message.convert(
+            action="history",
+            data={"messages": messages, "has_more": more},
+        )
+
+    def request_sync_house(self, message: Message) -> None:
+        """
+        The changes to a house since the version the user has
+        """
+
+        self.router.submit(message)
+
+    def request_fetch_members(self, message: Message) -> None:
+        """
+        A page of the members of a house's rank
+        """
+
+        self.router.submit(message)
+
+    def request_set_status(self, message: Message) -> None:
+        """
+        The user is `online` or `away`
+        """
+
+        status = message.data.get("status")
+        if status in STATUSES:
+            self.presence.set_status(message.sender, status)
+
+    def request_typing(self, message: Message) -> None:
+        """
+        The user is typing in a room, sent again every few seconds while typing
+        """
+
+        self.presence.typing(message.sender, message.house, message.room)
+
+    def request_fetch_presence(self, message: Message) -> Message:
+        """
+        The current status of the users, like the members of a page just fetched
+        """
+
+        users = list(message.data.get("users", []))
+        return message.convert(
+            action="presence",
+            data={"status": self.presence.of(users), "typing": {}},
+        )
+
+    def request_upload(self, message: Message) -> Message:
+        """
+        Starts (or resumes) the upload of a file, answered with the bytes
+        the server has already, all of them for a file it already has
+        """
+
+        digest = str(message.data.get("digest", ""))
+        try:
+            received = self.attachments.start(digest, int(message.data.get("size", -1)))
+        except (ValueError, TypeError, OSError) as e:
+            return message.convert(
+                action="upload", data={"digest": digest, "error": str(e)}
+            )
+
+        return message.convert(
+            action="upload",
+            data={
+                "digest": digest,
+                "received": received,
+                "done": self.attachments.has(digest),
+            },
+        )
+
+    def request_upload_chunk(self, message: Message) -> Message:
+        """
+        A chunk of an upload, answered like the upload itself
+        the client keeps a few of them in flight and goes on with
+        the next ones as the answers come
+        """
+
+        digest = str(message.data.get("digest", ""))
+        try:
+            received = self.attachments.write(
+                digest,
+                int(message.data.get("offset", -1)),
+                message.data.get("chunk"),
+            )
+        except (ValueError, TypeError, OSError) as e:
+            return message.convert(
+                action="upload", data={"digest": digest, "error": str(e)}
+            )
+
+        return message.convert(
+            action="upload",
+            data={
+                "digest": digest,
+                "received": received,
+                "done": self.attachments.has(digest),
+            },
+        )
+
+    def request_download(self, message: Message) -> Message:
+        """
+        A chunk of a file from the offset, the client asks for a few
+        of them at a time and for the next ones as they come
+        """
+
+        digest = str(message.data.get("digest", ""))
+        offset = message.data.get("offset", 0)
+        try:
+            size = self.attachments.size(digest)
+            chunk = self.attachments.read(digest, offset)
+        except (ValueError, OSError):
+            return message.convert(
+                action="download",
+                data={"digest": digest, "offset": offset, "error": "No such file"},
+            )
+
+        # NOTE: waits (reading nothing else from the user) while the user's
+        # connection is lagging, so a download goes as fast as it's read
+        outbox = self.users.get(message.sender)
+        if outbox is not None:
+            outbox.wait_for_room()
+
+        return message.convert(
+            action="download",
+            data={"digest": digest, "offset": offset, "size": size, "chunk": chunk},
+        )
+
+    def _attachment(self, message: Message) -> dict:
+        """
+        The data of a text sent by a user, only ever a file it uploaded
+        """
+
+        attachment = message.data.get("attachment")
+        if not isinstance(attachment, dict):
+            return {}
+
+        digest = str(attachment.get("digest", ""))
+        try:
+            size = self.attachments.size(digest)
+        except (ValueError, OSError):
+            return {}
+
+        name = os.path.basename(str(attachment.get("name", "")))[:MAX_FILE_NAME]
+        return {"attachment": {"digest": digest, "name": name or digest, "size": size}}
+
+    def search_history(self, message: Message) -> List[Message]:
+        """
+        Search the messages the user can see,
+        within the house or the direct chat the command was sent from
+        """
+
+        terms, _, page = message.text[8:].partition(" -p ")
+        if not terms.strip():
+            return [message.convert(text="What should be searched?")]
+
+        # the logs of the rooms the user can see
+        user = self.user_db[message.sender]
+        if message.house != "HOME":
+            houses = [message.house] if user.has_joined(message.house) else []
+            keys = []
+        elif message.room != "general":
+            houses, keys = [], [room_key(user.username, "HOME", message.room)]
+        else:
+            houses = list(user.houses)
+            keys = self.history.rooms(house_key(user.username, "HOME"))
+        for house in houses:
+            keys += [room_key("", house, room) for room in self.rooms.get(house, ())]
+
+        def read(key: str, id: int) -> Optional[Message]:
+            log = self.history.get(key)
+            return log.get(id) if log is not None else None
+
+        page = int(page) if page.strip().isdigit() else 1
+        if page > MAX_SEARCH_PAGES:
+            return [
+                message.convert(
+                    text=f"Only the first {MAX_SEARCH_PAGES} pages are shown, "
+                    + "narrow the search down"
+                )
+            ]
+
+        page = max(page, 1)
+        hits, more = self.search.search(terms, keys, read, page)
+        if not hits:
+            return [message.convert(text="No messages found")]
+
+        text = "\n".join(
+            f"[dim]{hit.house}/{hit.room}[/dim] {hit.styled_sender()}: {hit.text}"
+            for hit in hits
+        )
+        if more and page == MAX_SEARCH_PAGES:
+            text += "\n[dim]more results, narrow the search down[/dim]"
+        elif more:
+            text += f"\n[dim]more results: /search {terms.strip()} -p {page + 1}[/dim]"
+
+        return [message.convert(text=text)]
+
+    def is_online(self, user: str) -> bool:
+        if self.cluster:
+            return self.cluster.is_online(user)
+
+        return user in self.users
 
     def broadcast(
         self,
         message: Message,
         reciepents: List[str],
-        from_server: bool = False,
+        forward: bool = True,
     ) -> None:
         """
         Broadcasts the user message to the respective location
         """
 
-        if not from_server:
-            if message.house != "HOME" and message.sender != "SERVER":
-                house = self.houses[message.house]
-                color = house.ranks[house.member_rank[message.sender]].color
-            elif message.sender == "SERVER":
-                color = "red"
-            else:
-                color = "magenta"
-
-            message.sender = f"[{color}]{message.sender}[/{color}]"
+        message.id = self.next_id
+        message.time = time()
+        self.next_id += 1
+        if self.next_id >= self.reserved_id:
+            self._reserve_ids()
+
+        if forward and self.cluster:
+            # users connected to other nodes get it from there
+            reciepents = self.cluster.route(message, reciepents)
+
+        # Save it in DB for later sending and queue it if the user is online
+        # NOTE: this never blocks, each user has its own writer thread
+        with self.deferred_lock:
+            self._track(message, reciepents)
+            if forward:
+                self.bots.dispatch(message)
+            stored = self._stored(message)
+            # NOTE: the texts not in the inboxes are in the room logs
+            replayed = stored or message.action == "push_text"
+            # the same frames go to everyone
+            frames: Frames = dict()
+            for user in reciepents:
+                if stored:
+                    self.inboxes.append(user, message)
+                self._push(user, message, frames, replayed)
+
+    def _stored(self, message: Message) -> bool:
+        """
+        If the message goes to the inbox of its reciepents, the room texts
+        are in the room logs and the house state is caught up with `sync_house`
+        """
 
-        for user in reciepents:
-            # Send the data if possible and finally save it in DB for later sending
-            try:
-                self.users[user].send(message)
-            except BrokenPipeError:  # User closed the application on his/her side
-                pass
-            finally:
-                if not from_server:
-                    self.user_messages[user] = self.user_messages.get(user, []) + [
-                        message
-                    ]
+        if message.action == "push_text":
+            return message.house != "HOME" and not message.room_wide
 
-        # TODO: modify `Channel` class so that this sleep is not needed
-        sleep(0.01)
+        return (
+            message.action not in PAGES
+            and message.action not in LIVE
+            and message.action != "sync_house"
+            and "version" not in message.data
+        )
 
     # +-------------------------------+
     # | Methods to manage user data   |
@@ -109,11 +874,8 @@ class Server:
         Join a house
         """
 
-        house = message.text[6:].strip()
-        if house not in self.houses:
-            return [message.convert(text="No such house")]
-
-        return self.houses[house].process_message(message)
+        self.router.submit(message)
+        return []
 
     def general_add_room(self, message) -> List[Message]:
         """
@@ -137,7 +899,7 @@ class Server:
                 ),
             ]
         else:
-            if self.user_db[param].has_banned(message.sender):
+            if self.blocks.has_blocked(param, message.sender):
                 return [
                     message.convert(
                         text="This user has blocked you so you can't connect",
@@ -159,28 +921,8 @@ class Server:
         Create your brand new house
         """
 
-        param = message.text[11:].strip()
-        if not param:
-            return [
-                message.convert(
-                    text="The house must have a name",
-                )
-            ]
-        elif param in self.houses:
-            return [
-                message.convert(
-                    text="There is already a house with same name",
-                )
-            ]
-        else:
-            message.house = param
-            self.houses[param] = House(param, message.sender)
-            return [
-                message.convert(
-                    action="add_house",
-                    data={"house": self.houses[param]._generate_house_data()},
-                )
-            ]
+        self.router.submit(message)
+        return []
 
     def general_ban(self, message: Message) -> List[Message]:
         """
@@ -188,17 +930,21 @@ class Server:
         """
 
         param = message.text[5:].strip()
-        if param not in self.users:
+        if not self.is_online(param):
             return [
                 message.convert(
                     text="No user with such name!",
                 ),
             ]
-        elif self.user_db[message.sender].has_banned(param):
+        elif self.blocks.has_blocked(message.sender, param):
             return [message.convert(text="this user is already banned")]
         else:
             debug(f"{message.sender} banned {param}")
             self.user_db[message.sender].ban_user(param)
+            self.blocks.block(message.sender, param)
+            self.storage.put_user(self.user_db[message.sender])
+            if self.cluster:
+                self.cluster.publish_user(self.user_db[message.sender])
             return [
                 message.convert(
                     text=f"User `{param}` can't send you private texts now",
@@ -211,11 +957,15 @@ class Server:
         """
 
         param = message.text[7:].strip()
-        if not self.user_db[message.sender].has_banned(param):
+        if not self.blocks.has_blocked(message.sender, param):
             return [message.convert(text="this user is not banned by you")]
 
         else:
             self.user_db[message.sender].unban_user(param)
+            self.blocks.unblock(message.sender, param)
+            self.storage.put_user(self.user_db[message.sender])
+            if self.cluster:
+                self.cluster.publish_user(self.user_db[message.sender])
             return [
                 message.convert(
                     text=f"User `{param}` can send you private texts now",
@@ -319,7 +1069,7 @@ class Server:
                 ]
         else:
             if message.room == "general":
-                return [message.convert(sender="self")]
+                return [message.convert(sender="self", data=message.data)]
             else:
                 if message.text[0] == "/":
                     try:
@@ -335,7 +1085,8 @@ class Server:
                             )
                         ]
 
-                if self.user_db[message.sender].has_banned(message.room):
+                # NOTE: a couple of lookups in the index, the records aren't touched
+                if self.blocks.has_blocked(message.sender, message.room):
                     return [
                         message.convert(
                             text="You have banned this user "
@@ -343,7 +1094,7 @@ class Server:
                         )
                     ]
 
-                if self.user_db[message.room].has_banned(message.sender):
+                if self.blocks.has_blocked(message.room, message.sender):
                     x = []
                 else:
                     x = (
@@ -351,6 +1102,7 @@ class Server:
                             sender="self",
                             room=message.sender,
                             reciepents=[message.room],
+                            data=message.data,
                         ),
                     )
 
@@ -361,31 +1113,49 @@ class Server:
                         reciepents=[message.room],
                     ),
                     *x,
-                    message.convert(sender="self"),
+                    message.convert(sender="self", data=message.data),
                 ]
 
     def serve_user(self, user: str, start: int) -> None:
         if start != -1:
-            for message in self.user_messages.get(user, [])[start:]:
-                self.worker_queue.put((message, [user], True))
+            # the messages after the newest one the user has are replayed
+            # from the store in the background, as a deferred user (see `_login`)
+            self._resume(user)
 
+        outbox = self.users[user]
+        channel = outbox.channel
         while True:
             try:
-                message = self.users[user].recv()
-                if message.house == "HOME":
+                message = channel.recv(limit=MAX_FRAME_SIZE)
+                self.last_seen[user] = monotonic()
+                if message.action == "pong":
+                    continue
+
+                if not message.action:
+                    message.data = self._attachment(message)
+
+                if message.action:
+                    try:
+                        request = getattr(self, f"request_{message.action}")
+                    except AttributeError:
+                        warn(f"{user} sent an unknown request `{message.action}`")
+                        continue
+
+                    message.sender = user
+                    response = request(message)
+                    if response is not None:
+                        outbox.push(response, force=True)
+                elif message.text.split(" ", 1)[0] == "/search":
+                    self.deliver([decorate(m) for m in self.search_history(message)])
+                elif message.house == "HOME":
                     message_list = self.handle_user_message(message)
-                    for message in message_list:
-                        recipients = message.take_recipients()
-                        self.worker_queue.put((message, recipients))
+                    self.deliver([decorate(m) for m in message_list])
                 else:
-                    message_list = self.houses[message.house].process_message(message)
-                    for message in message_list:
-                        recipients = message.take_recipients()
-                        self.worker_queue.put((message, recipients))
+                    self.router.submit(message)
 
             except Exception as e:
                 err(e)
-                info(f"{user} disconnected")
+                self._disconnect(user, outbox)
                 return
 
     def save_data(self) -> None:
@@ -393,46 +1163,151 @@ class Server:
         Save the data when closing
         """
         debug("Saving chat data")
-        with open(SERVER_DATA, "wb") as f:
-            dump(
-                (
-                    self.houses,
-                    self.user_messages,
-                    self.user_db,
-                ),
-                f,
-            )
+        self._write_state(self.router.snapshot())
+
+    def _write_state(self, houses: Dict[str, House]) -> None:
+        with self.deferred_lock:
+            retention = {house: dict(rooms) for house, rooms in self.retention.items()}
+
+        # NOTE: no user logs in while the users are saved
+        with self.login_lock:
+            self.storage.save(houses, self.user_db, retention)
 
     def close_all_connections(self):
 
-        for conn in self.users.values():
+        for conn in list(self.users.values()):
             conn.close()
 
+        self.router.close()
+        self.storage.close()
+        # NOTE: the index is not read yet if the server went down right away
+        if self.search_ready.is_set():
+            self._search.close()
         self.server.close()
 
+    def _handshake(self, conn: socket.socket) -> None:
+        """
+        Reads the user's hello off the accept loop, the connection is
+        closed if it doesn't come within the handshake timeout
+        """
+
+        channel = Channel(conn)
+        # NOTE: a deadline for the whole hello, not for every byte of it
+        timer = Timer(self.handshake_timeout, channel.close)
+        timer.start()
+        try:
+            hello = channel.recv(limit=MAX_HELLO_SIZE)
+        except (EOFError, OSError, ValueError) as e:
+            debug(f"handshake failed: {e}")
+            channel.close()
+            return
+        finally:
+            timer.cancel()
+            self.handshakes.release()
+
+        # NOTE: all of it is checked before the user is logged in
+        try:
+            username, channel.capabilities, cursor = self._read_hello(hello)
+        except ValueError as e:
+            debug(f"rejected a hello: {e}")
+            channel.close()
+            return
+
+        self._login(username, channel, cursor)
+        self.serve_user(username, cursor)
+
+    def _read_hello(self, hello: Message) -> Tuple[str, Set[str], int]:
+        """
+        The user, the capabilities agreed on and the cursor of a hello
+        raises a `ValueError` for a malformed one or a name no user can have
+        """
+
+        if (
+            not isinstance(hello, Message)
+            or hello.action != "hello"
+            or not isinstance(hello.data, dict)
+        ):
+            raise ValueError("not a hello")
+
+        username = hello.sender
+        if (
+            not isinstance(username, str)
+            or not username
+            or username in ("SERVER", "self")
+            or username in self.bots.bots
+        ):
+            raise ValueError(f"no user can be named {username!r}")
+
+        capabilities = hello.data.get("capabilities", ())
+        if not isinstance(capabilities, (list, tuple, set, frozenset)) or not all(
+            isinstance(capability, str) for capability in capabilities
+        ):
+            raise ValueError(f"bad capabilities {capabilities!r}")
+
+        # the id of the newest message the user has, -1 for none to be replayed
+        cursor = hello.data.get("cursor", 0)
+        if not isinstance(cursor, int) or cursor < -1:
+            raise ValueError(f"bad cursor {cursor!r}")
+
+        return username, CAPABILITIES & set(capabilities), cursor
+
+    def _login(self, username: str, channel: Channel, cursor: int = -1) -> None:
+        """
+        Makes the user live, the messages after the `cursor` (unless it's -1)
+        are replayed first, no live message gets to the user before them
+        """
+
+        with self.login_lock:
+            previous = self.users.get(username)
+            if previous is None:
+                self.router.add_user(username)
+                # NOTE: the record may already be known (replicated from another node)
+                if username not in self.user_db:
+                    self.user_db[username] = User(username)
+                    self.storage.put_user(self.user_db[username])
+                    if self.cluster:
+                        self.cluster.publish_user(self.user_db[username])
+                info(f"{username} joined")
+            else:
+                previous.close()
+                info(f"{username} reconnected")
+
+            outbox = Outbox(
+                channel,
+                on_drain=lambda user=username: self._resume(user),
+            )
+            outbox.push(
+                Message(
+                    action="welcome",
+                    data={"capabilities": sorted(channel.capabilities)},
+                ),
+                force=True,
+            )
+            with self.deferred_lock:
+                # NOTE: deferred right as it's live, the catch-up sends what's pushed after
+                if cursor != -1:
+                    self.deferred[username] = cursor + 1
+                else:
+                    self.deferred.pop(username, None)
+                self.held.pop(username, None)
+                self.last_seen[username] = monotonic()
+                self.users[username] = outbox
+
+            # NOTE: under the lock, so the old connection's offline never comes after
+            if self.cluster:
+                self.cluster.online(username)
+
+            self.presence.set_status(username, "online")
+
     def start_connection(self) -> None:
-        self.server.listen()
+        self.server.listen(LISTEN_BACKLOG)
         info("server is up and running")
         while True:
             try:
+                # NOTE: past the cap the new connections wait in the listen backlog
+                self.handshakes.acquire()
                 conn, _ = self.server.accept()
-                username = conn.recv(512).decode()
-                if username not in self.users:
-                    self.houses[username] = House(username, username)
-                    self.user_db[username] = User(username)
-                    info(f"{username} joined")
-                else:
-                    self.users[username].close()
-                    info(f"{username} reconnected")
-
-                offline_load = int(conn.recv(512).decode())
-
-                self.users[username] = Channel(conn)
-                Thread(
-                    target=self.serve_user,
-                    args=(username, offline_load),
-                    daemon=True,
-                ).start()
+                Thread(target=self._handshake, args=(conn,), daemon=True).start()
 
             except KeyboardInterrupt:
                 err("SERVER SHUT DOWN")
@@ -0,0 +1,166 @@
+import signal
+from multiprocessing import get_context
+from multiprocessing.connection import Connection
+from queue import Queue
+from threading import Lock, Thread
+from typing import Dict, Iterable, List, Optional, Set
+
+from .houses import Deliver, LocalHouses, Store, target_house
+from .utils import House, HashRing, Message, err
+
+# NOTE: `fork` so that the workers don't re-run the cli parsing in `gupshup/__init__.py`
+context = get_context("fork")
+
+
+def shard_main(
+    index: int,
+    conn: Connection,
+    houses: Dict[str, House],
+    reserved: Set[str],
+    bots: Set[str],
+    store: bool,
+) -> None:
+    """
+    Entry point of a worker process owning a partition of the houses
+    """
+
+    # the front-end process decides when the workers go down
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    # the changed houses are written by the front-end
+    local = LocalHouses(
+        houses,
+        store=(lambda house: conn.send(("store", house))) if store else None,
+        reserved=reserved,
+        bots=bots,
+    )
+    while True:
+        try:
+            op, payload = conn.recv()
+        except EOFError:
+            return
+
+        match op:
+            case "process":
+                try:
+                    conn.send(("deliver", local.process(payload)))
+                except Exception as e:
+                    err(f"shard {index}: {e}")
+            case "add_user":
+                local.add_user(payload)
+            case "snapshot":
+                conn.send(("snapshot", local.snapshot()))
+            case "close":
+                conn.close()
+                return
+
+
+class Shard:
+    """
+    The front-end's handle to a worker process
+    """
+
+    def __init__(
+        self,
+        index: int,
+        houses: Dict[str, House],
+        reserved: Set[str],
+        bots: Set[str],
+        deliver: Deliver,
+        store: Optional[Store],
+    ):
+        self.index = index
+        self.deliver = deliver
+        self.store = store
+        self.conn, child_conn = context.Pipe()
+        self.lock = Lock()
+        self.snapshots: Queue = Queue()
+
+        self.process = context.Process(
+            target=shard_main,
+            args=(index, child_conn, houses, reserved, bots, store is not None),
+            daemon=True,
+        )
+        self.process.start()
+        child_conn.close()
+
+        Thread(target=self._listen, daemon=True).start()
+
+    def send(self, op: str, payload=None) -> None:
+        with self.lock:
+            self.conn.send((op, payload))
+
+    def _listen(self) -> None:
+        while True:
+            try:
+                op, payload = self.conn.recv()
+            except (EOFError, OSError):
+                return
+
+            if op == "deliver":
+                self.deliver(payload)
+            elif op == "store":
+                self.store(payload)
+            else:
+                self.snapshots.put(payload)
+
+
+class ShardedHouses:
+    """
+    Partitions the houses across worker processes by consistent hashing
+    of the house name. The front-end process keeps the client sockets, the direct
+    messages and `user_db` and only forwards the messages meant for houses
+    """
+
+    def __init__(
+        self,
+        houses: Dict[str, House],
+        shards: int,
+        deliver: Deliver,
+        store: Optional[Store] = None,
+        reserved: Iterable[str] = (),
+        bots: Iterable[str] = (),
+    ):
+        self.ring: HashRing[int] = HashRing(range(shards))
+
+        partitions: List[Dict[str, House]] = [dict() for _ in range(shards)]
+        for name, house in houses.items():
+            partitions[self.ring.get(name)][name] = house
+
+        names: List[Set[str]] = [set() for _ in range(shards)]
+        for name in reserved:
+            names[self.ring.get(name)].add(name)
+
+        self.shards = [
+            Shard(index, partition, names[index], set(bots), deliver, store)
+            for index, partition in enumerate(partitions)
+        ]
+
+    def _shard(self, house: str) -> Shard:
+        return self.shards[self.ring.get(house)]
+
+    def submit(self, message: Message) -> None:
+        """
+        Forwards the message to the worker owning its house
+        the results are delivered when the worker sends them back
+        """
+
+        self._shard(target_house(message)).send("process", message)
+
+    def add_user(self, username: str) -> None:
+        self._shard(username).send("add_user", username)
+
+    def snapshot(self) -> Dict[str, House]:
+        houses: Dict[str, House] = dict()
+        for shard in self.shards:
+            shard.send("snapshot")
+
+        for shard in self.shards:
+            houses.update(shard.snapshots.get())
+
+        return houses
+
+    def close(self) -> None:
+        for shard in self.shards:
+            shard.send("close")
+            shard.process.join()
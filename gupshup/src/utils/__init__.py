@@ -1,8 +1,14 @@
 from .house import House, HouseData
 from .message import Message
 from .channel import Channel
+from .outbox import Outbox
+from .hash_ring import HashRing
+from .pubsub import PubSub, LocalPubSub, SocketPubSub, PubSubBroker
+from .search import SearchIndex, plain
+from .history import History, RoomLog, house_key, room_key, key_room
+from .storage import Storage, FileStorage, SqliteStorage
 from .rank import Rank
-from .user import User
+from .user import User, BlockIndex
 from .custom_node import CustomNode
 from .logger import warn, info, debug, err
 from .parser import Parser
@@ -15,8 +21,25 @@ __all__ = [
     "HouseData",
     "Message",
     "Channel",
+    "Outbox",
+    "HashRing",
+    "PubSub",
+    "LocalPubSub",
+    "SocketPubSub",
+    "PubSubBroker",
+    "SearchIndex",
+    "plain",
+    "History",
+    "RoomLog",
+    "house_key",
+    "room_key",
+    "key_room",
+    "Storage",
+    "FileStorage",
+    "SqliteStorage",
     "Rank",
     "User",
+    "BlockIndex",
     "CustomNode",
     "Parser",
     "warn",
@@ -0,0 +1,185 @@
+import os
+import string
+from hashlib import sha256
+from threading import Lock
+from typing import Dict, List
+
+# bytes of a file sent in a single frame, small enough for the chat
+# frames of the same connection not to wait long behind one
+CHUNK_SIZE = 64 * 1024
+
+# the largest file that can be shared
+MAX_ATTACHMENT_SIZE = 64 * 1024**2
+
+# the uploads not finished yet are kept next to the files, to be resumed
+PARTIAL_SUFFIX = "%part"
+# ..for a day since the last chunk, then the sweep drops them
+PARTIAL_RETENTION = 24 * 60 * 60
+
+
+def file_digest(path: str) -> str:
+    """
+    The sha256 of the file's content, read a chunk at a time
+    """
+
+    digest = sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b""):
+            digest.update(chunk)
+
+    return digest.hexdigest()
+
+
+def describe_size(size: int) -> str:
+    for unit in ("B", "KB", "MB"):
+        if size < 1024:
+            break
+        size /= 1024
+
+    return f"{size:.0f} {unit}" if unit == "B" else f"{size:.1f} {unit}"
+
+
+class AttachmentStore:
+    """
+    The files shared in the chats stored by the sha256 of their content,
+    so the same file uploaded again (by anyone) is stored once and
+    its upload is done as soon as it starts
+
+    An upload is written to a partial file a chunk at a time, in order,
+    and becomes the file once its content matches the digest
+    """
+
+    def __init__(self, folder: str) -> None:
+        self.folder = folder
+        os.makedirs(folder, exist_ok=True)
+
+        # digest -> the size of the upload being written
+        self.uploads: Dict[str, int] = dict()
+        self.lock = Lock()
+
+    def path(self, digest: str) -> str:
+        """
+        raises a `ValueError` for anything that isn't a sha256 in hex
+        """
+
+        if len(digest) != 64 or not set(digest) <= set(string.hexdigits.lower()):
+            raise ValueError(f"not a digest: {digest[:80]!r}")
+
+        return os.path.join(self.folder, digest[:2], digest)
+
+    def has(self, digest: str) -> bool:
+        return os.path.exists(self.path(digest))
+
+    def size(self, digest: str) -> int:
+        return os.path.getsize(self.path(digest))
+
+    def start(self, digest: str, size: int) -> int:
+        """
+        Starts (or resumes) an upload, returns the bytes already received
+        """
+
+        if not 0 <= size <= MAX_ATTACHMENT_SIZE:
+            raise ValueError(
+                f"an attachment can be at most {MAX_ATTACHMENT_SIZE} bytes"
+            )
+
+        with self.lock:
+            if self.has(digest):
+                return self.size(digest)
+
+            partial = self.path(digest) + PARTIAL_SUFFIX
+            os.makedirs(os.path.dirname(partial), exist_ok=True)
+            if not os.path.exists(partial):
+                open(partial, "wb").close()
+
+            received = os.path.getsize(partial)
+            if received > size:
+                # a different size than the one started with, the digest is wrong
+                os.truncate(partial, 0)
+                received = 0
+
+            self.uploads[digest] = size
+            return self._finish(digest) if received == size else received
+
+    def write(self, digest: str, offset: int, chunk: bytes) -> int:
+        """
+        Writes a chunk of a started upload, returns the bytes received
+        the chunks not at the end of the ones received are ignored
+        (sent again after a reconnect), the sender goes on from the end
+
+        raises a `ValueError` for the uploads not started and the chunks
+        going past their size or not matching the digest at the end
+        """
+
+        if not isinstance(chunk, bytes) or len(chunk) > CHUNK_SIZE:
+            raise ValueError(f"a chunk is at most {CHUNK_SIZE} bytes")
+
+        with self.lock:
+            if self.has(digest):
+                return self.size(digest)
+            if digest not in self.uploads:
+                raise ValueError("the upload wasn't started")
+
+            partial = self.path(digest) + PARTIAL_SUFFIX
+            received = os.path.getsize(partial)
+            if offset != received:
+                return received
+            if received + len(chunk) > self.uploads[digest]:
+                raise ValueError("the chunk goes past the size of the upload")
+
+            with open(partial, "ab") as f:
+                f.write(chunk)
+            received += len(chunk)
+
+            return (
+                self._finish(digest) if received == self.uploads[digest] else received
+            )
+
+    def _finish(self, digest: str) -> int:
+        """
+        Makes the file of a fully received upload, returns its size
+        NOTE: called with the lock held
+        """
+
+        partial = self.path(digest) + PARTIAL_SUFFIX
+        del self.uploads[digest]
+        if file_digest(partial) != digest:
+            os.remove(partial)
+            raise ValueError("the content doesn't match the digest")
+
+        os.replace(partial, self.path(digest))
+        return self.size(digest)
+
+    def read(self, digest: str, offset: int, size: int = CHUNK_SIZE) -> bytes:
+        """
+        raises a `ValueError` for an offset that isn't in the file
+        """
+
+        if not isinstance(offset, int) or not 0 <= offset <= self.size(digest):
+            raise ValueError(f"no offset {offset!r} in the file")
+
+        with open(self.path(digest), "rb") as f:
+            f.seek(offset)
+            return f.read(min(size, CHUNK_SIZE))
+
+    def sweep(self, now: float) -> List[str]:
+        """
+        Drops the partial uploads nothing was written to for a while
+        returns their digests
+        """
+
+        gone = []
+        with self.lock:
+            for folder, _, files in os.walk(self.folder):
+                for name in files:
+                    path = os.path.join(folder, name)
+                    if (
+                        name.endswith(PARTIAL_SUFFIX)
+                        and os.path.getmtime(path) < now - PARTIAL_RETENTION
+                    ):
+                        os.remove(path)
+                        digest = name[: -len(PARTIAL_SUFFIX)]
+                        self.uploads.pop(digest, None)
+                        gone.append(digest)
+
+        return gone
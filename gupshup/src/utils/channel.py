@@ -1,9 +1,51 @@
-# from struct import pack, unpack
-# from sys import getsizeof as sizeof
-
-from socket import socket
+import sys
+import zlib
+from struct import pack, unpack, calcsize
+from socket import socket, SHUT_RDWR
 from pickle import dumps, loads
+from threading import Lock
+from typing import Dict, List, Optional, Set, Tuple
+
 from .message import Message
+from .names import NAMES, to_ids, from_ids
+
+# every frame is prefixed with the size of the pickled data
+# and the highest bit of the size marks a compressed frame
+HEADER = "!I"
+HEADER_SIZE = calcsize(HEADER)
+COMPRESSED = 1 << 31
+
+# below it the few bytes saved don't pay for the compression
+COMPRESS_MIN_SIZE = 128
+COMPRESS_LEVEL = 6
+
+# the largest a compressed frame can grow to when read with no limit
+MAX_DECOMPRESSED_SIZE = 64 * 1024**2
+
+# the most names the other side can announce on a connection
+MAX_PEER_NAMES = 1 << 18
+
+# (compressed, names as ids) -> the frame, the size before compression and the name ids
+Frames = Dict[Tuple[bool, bool], Tuple[bytes, int, List[int]]]
+
+# the chat frames are small and alike, a dictionary of what most of them
+# have in common lets even a single frame compress well
+# NOTE: both sides must have the very same one, a changed one needs a new capability
+ZDICT = b"".join(
+    (
+        b"src.utils.message\x94\x8c\x07Message\x94\x93\x94)\x81\x94}\x94(",
+        b"\x8c\x06action\x94\x8c\x06sender\x94\x8c\x05house\x94\x8c\x04room\x94",
+        b"\x8c\x04text\x94\x8c\nreciepents\x94]\x94\x8c\x04data\x94}\x94",
+        b"\x8c\x02id\x94\x8c\troom_wide\x94\x88\x89",
+        b"push_text\x94add_house\x94sync_house\x94presence\x94history\x94members\x94",
+        b"add_user_rank\x94del_user_rank\x94add_room\x94\x8c\x07version\x94",
+        b"\x8c\x06status\x94\x8c\x06typing\x94online\x94offline\x94away\x94",
+        b"\x8c\x08messages\x94\x8c\x08has_more\x94\x8c\x04rank\x94\x8c\x06prefix\x94",
+        b"\x8c\x04HOME\x94\x8c\x07general\x94\x8c\x04self\x94",
+        b"[red]SERVER[/red]\x94[magenta]\x94[/magenta]\x94[green]\x94[/green]\x94",
+        b"[blue]\x94[/blue]\x94[yellow]\x94[/yellow]\x94[cyan]\x94[/cyan]\x94[dim]",
+    )
+)
 
 
 class Channel:
@@ -15,31 +57,162 @@ class Channel:
 
     def __init__(self, conn: socket):
         self.conn = conn
+        # the optional features both sides agreed on
+        self.capabilities: Set[str] = set()
+
+        # the ids of `NAMES` this side announced and the ones the other side did
+        self.announced: Set[int] = set()
+        self.peer_names: Dict[int, str] = dict()
+
+        # metrics of the frames big enough to be compressed
+        self.raw_bytes = 0
+        self.compressed_bytes = 0
+        self.metrics_lock = Lock()
+
+    def encode(self, data: Message, frames: Optional[Frames] = None) -> bytes:
+        """
+        Encodes the data into a size-prefixed frame
+        compressed if the other side can read it and it's worth it
+        and with the names as ids if it can map them back
+
+        `frames` caches the encoded frames of a message being sent
+        to many channels so that it's encoded once for all of them
+
+        NOTE: the names not announced yet are announced in a frame of their own
+        put before it, so the frames must be sent in the order they are encoded
+        """
+
+        compress = "zlib" in self.capabilities
+        names = "names" in self.capabilities and isinstance(data, Message)
+        if frames is not None and (compress, names) in frames:
+            frame, size, ids = frames[(compress, names)]
+        else:
+            frame, size, ids = self._encode(data, compress, names)
+            if frames is not None:
+                frames[(compress, names)] = (frame, size, ids)
+
+        if compress and size >= COMPRESS_MIN_SIZE:
+            with self.metrics_lock:
+                self.raw_bytes += size
+                self.compressed_bytes += len(frame) - HEADER_SIZE
+
+        new = {id: NAMES.name(id) for id in ids if id not in self.announced}
+        if new:
+            self.announced.update(new)
+            announce = Message(action="names", data={"names": new})
+            frame = self._encode(announce, compress, False)[0] + frame
+
+        return frame
+
+    def _encode(
+        self, data: Message, compress: bool, names: bool
+    ) -> Tuple[bytes, int, List[int]]:
+        """
+        The frame, the size of the data before compression and the name ids in it
+        """
+
+        ids: List[int] = []
+        if names:
+            data, ids = to_ids(data)
+
+        data_encoded = dumps(data)
+        if compress and len(data_encoded) >= COMPRESS_MIN_SIZE:
+            compressor = zlib.compressobj(COMPRESS_LEVEL, zdict=ZDICT)
+            compressed = compressor.compress(data_encoded) + compressor.flush()
+            if len(compressed) < len(data_encoded):
+                frame = pack(HEADER, len(compressed) | COMPRESSED) + compressed
+                return frame, len(data_encoded), ids
+
+        frame = pack(HEADER, len(data_encoded)) + data_encoded
+        return frame, len(data_encoded), ids
+
+    def compression_stats(self) -> Dict[str, float]:
+        with self.metrics_lock:
+            raw, compressed = self.raw_bytes, self.compressed_bytes
+
+        return {
+            "raw_bytes": raw,
+            "compressed_bytes": compressed,
+            "compression_ratio": raw / compressed if compressed else 1.0,
+        }
+
+    def send_frame(self, frame: bytes) -> None:
+        """
+        Sends an already encoded frame
+        """
+
+        self.conn.sendall(frame)
 
     def send(self, data: Message):
         """
         First sends the size of the data using struct's pack()
         then the data itself
         """
-        self.conn.send(dumps(data))
 
-        # data_encoded = dumps(data)
-        # bufsize = pack("!i", sizeof(data_encoded))
-        # self.conn.send(bufsize)
-        # self.conn.send(data_encoded)
+        self.send_frame(self.encode(data))
+
+    def _recv_exact(self, size: int) -> bytes:
+        data = bytearray()
+        while len(data) < size:
+            chunk = self.conn.recv(size - len(data))
+            if not chunk:
+                raise EOFError("connection closed")
+            data += chunk
+
+        return bytes(data)
 
-    def recv(self) -> Message:
+    def recv(self, limit: Optional[int] = None) -> Message:
         """
         A recv_all type method that
         ensures that there is no data loss
+        a frame larger than `limit` raises a `ValueError` before being read
+        (or while decompressed, with no limit at `MAX_DECOMPRESSED_SIZE`)
+        the names the other side announces are kept for mapping its ids back
         """
 
-        return loads(self.conn.recv(2048))
-        # bufsize = unpack("!i", self.conn.recv(100))[
-        #     0
-        # ]  # 37 seems to be the size of a packed `int`
-        # data = loads(self.conn.recv(bufsize))
-        # return data
+        while True:
+            data = self._recv_frame(limit)
+            if not isinstance(data, Message):
+                return data
+
+            if data.action != "names":
+                return from_ids(data, self.peer_names)
+
+            names = data.data.get("names")
+            if (
+                not isinstance(names, dict)
+                or len(self.peer_names) + len(names) > MAX_PEER_NAMES
+            ):
+                raise ValueError("bad or too many names announced")
+            for id, name in names.items():
+                if not isinstance(id, int) or not isinstance(name, str):
+                    raise ValueError(f"bad name announced: {id!r} {name!r}")
+                self.peer_names[id] = sys.intern(name)
+
+    def _recv_frame(self, limit: Optional[int] = None):
+        (bufsize,) = unpack(HEADER, self._recv_exact(HEADER_SIZE))
+        compressed, bufsize = bufsize & COMPRESSED, bufsize & ~COMPRESSED
+        if limit is not None and bufsize > limit:
+            raise ValueError(f"frame of {bufsize} bytes is over the limit")
+
+        data = self._recv_exact(bufsize)
+        if compressed:
+            # NOTE: a few bytes can decompress to gigabytes, never more than the limit
+            max_size = MAX_DECOMPRESSED_SIZE if limit is None else limit
+            decompressor = zlib.decompressobj(zdict=ZDICT)
+            data = decompressor.decompress(data, max_size + 1)
+            if len(data) > max_size:
+                raise ValueError("decompressed frame is over the limit")
+            if not decompressor.eof or decompressor.unused_data:
+                raise ValueError("compressed frame is cut short or has data after it")
+
+        return loads(data)
 
     def close(self):
+        try:
+            # wakes up any thread still blocked on `recv`
+            self.conn.shutdown(SHUT_RDWR)
+        except OSError:
+            pass
+
         self.conn.close()
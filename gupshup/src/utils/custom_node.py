@@ -3,6 +3,8 @@ class CustomNode:
     A data class for Node information
     """
 
+    __slots__ = ("type", "icon", "pending", "silent", "color", "hidden")
+
     def __init__(self, type: str, icon: str, color="white") -> None:
         self.type = type
         self.icon = icon
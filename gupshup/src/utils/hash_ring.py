@@ -0,0 +1,45 @@
+from bisect import bisect, insort
+from hashlib import md5
+from typing import Generic, Hashable, Iterable, List, Tuple, TypeVar
+
+Node = TypeVar("Node", bound=Hashable)
+
+
+class HashRing(Generic[Node]):
+    """
+    A consistent hash ring for partitioning keys (like house names) across nodes
+    so that adding or removing a node only moves the keys of its neighbours
+    """
+
+    def __init__(self, nodes: Iterable[Node] = (), replicas: int = 100) -> None:
+        self.replicas = replicas
+        self.ring: List[Tuple[int, str, Node]] = []
+        for node in nodes:
+            self.add_node(node)
+
+    @staticmethod
+    def _hash(key: str) -> int:
+        return int.from_bytes(md5(key.encode()).digest()[:8], "big")
+
+    def add_node(self, node: Node) -> None:
+        for replica in range(self.replicas):
+            point = f"{node}#{replica}"
+            insort(self.ring, (self._hash(point), point, node))
+
+    def remove_node(self, node: Node) -> None:
+        self.ring = [point for point in self.ring if point[2] != node]
+
+    @property
+    def nodes(self) -> List[Node]:
+        return list(dict.fromkeys(node for *_, node in self.ring))
+
+    def get(self, key: str) -> Node:
+        """
+        Returns the node owning the key
+        """
+
+        if not self.ring:
+            raise LookupError("the hash ring has no nodes")
+
+        index = bisect(self.ring, (self._hash(key), ""))
+        return self.ring[index % len(self.ring)][2]
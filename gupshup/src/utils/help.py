@@ -71,6 +71,25 @@ home_cmds = [
         "You won't hear a notification bell if this user texts you",
         "/toggle_silent [ name ]",
     ],
+    [
+        "search",
+        "Searches the messages of your chats and houses, newest first"
+        + "\n"
+        + "      in a direct chat only that chat is searched",
+        "/search (text) [ -p page ]",
+    ],
+    [
+        "upload",
+        "Uploads a file (up to 64 MB) and sends it to the chat once it's done"
+        + "\n"
+        + "      an upload cut short goes on from where it stopped when sent again",
+        "/upload (path)",
+    ],
+    [
+        "download",
+        "Downloads a file sent to a chat into ~/Downloads, by the code shown with it",
+        "/download (code)",
+    ],
 ]
 
 
@@ -190,11 +209,45 @@ house_cmds = [
         "Change a command's power level",
         "/change_command_power (commad) (power)",
     ],
+    [
+        "set_retention",
+        "Limit how long the messages of a room (or * for every room) are kept"
+        + "\n"
+        + "      age (like 7d, 12h), count (messages) or bytes (like 10m), off removes a limit",
+        "/set_retention (room) (age|count|bytes) (value)",
+    ],
     [
         "destroy",
         "Destroys the house",
         "/destroy",
     ],
+    [
+        "search",
+        "Searches the messages of the house, newest first",
+        "/search (text) [ -p page ]",
+    ],
+    [
+        "upload",
+        "Uploads a file (up to 64 MB) and sends it to the room once it's done"
+        + "\n"
+        + "      an upload cut short goes on from where it stopped when sent again",
+        "/upload (path)",
+    ],
+    [
+        "download",
+        "Downloads a file sent to a room into ~/Downloads, by the code shown with it",
+        "/download (code)",
+    ],
+    [
+        "add_bot",
+        "Adds a bot the server runs to the house, it answers its commands in the rooms",
+        "/add_bot (name)",
+    ],
+    [
+        "del_bot",
+        "Removes a bot from the house",
+        "/del_bot (name)",
+    ],
     [
         "bye",
         "Leave the house",
@@ -0,0 +1,389 @@
+import os
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import deque
+from pickle import dumps, loads
+from struct import calcsize, pack, unpack
+from threading import Lock
+from typing import Callable, Deque, Dict, Iterator, List, Optional, Set, Tuple
+from urllib.parse import quote, unquote
+
+from .message import Message
+from .retention import Policy
+
+# messages sent for a single `fetch_history` request
+PAGE_SIZE = 50
+MAX_PAGE_SIZE = 200
+
+# the newest messages of every room are kept in memory, the rest are read from disk
+RING_SIZE = 256
+
+# every message on disk is prefixed with its id and the size of the pickled data
+HEADER = "!qI"
+HEADER_SIZE = calcsize(HEADER)
+
+# the expired messages are dropped by rewriting the log once they are this much
+# of it, so a policy holds within it but a big log isn't rewritten for a few
+COMPACT_SLACK = 0.1
+COPY_CHUNK = 1024 * 1024
+
+# the log being rewritten, a name `quote` never gives (see `History`)
+REWRITE_SUFFIX = "%tmp"
+
+
+def _escape(name: str) -> str:
+    # NOTE: only what splits a key is escaped, the keys of the other names don't change
+    return name.replace("%", "%25").replace("/", "%2F")
+
+
+def room_key(user: str, house: str, room: str) -> str:
+    """
+    The key of a room's log, the direct chats are seen differently
+    by the two users so every user has its own log of them
+
+    every part is escaped so that no name makes the key of another
+    room, the rooms of a house named `HOME/alice` aren't alice's direct chats
+    """
+
+    return f"{house_key(user, house)}/{_escape(room)}"
+
+
+def house_key(user: str, house: str) -> str:
+    if house == "HOME":
+        return f"HOME/{_escape(user)}"
+
+    return _escape(house)
+
+
+def key_room(key: str) -> str:
+    """
+    The name of the room of a key (see `room_key`)
+    """
+
+    return unquote(key.rpartition("/")[2])
+
+
+class RoomLog:
+    """
+    The ordered messages of a room indexed by their ids
+
+    Every message is appended to a file on disk and only the newest
+    ones stay in memory, the index keeps the position of every message
+    in the file so an older page is read without going through the rest
+
+    the expired messages are hidden from the reads right away, the file
+    is only rewritten without them once they are enough of it (see `expire`)
+    """
+
+    def __init__(self, path: str, ring_size: int = RING_SIZE) -> None:
+        self.path = path
+        self.ids = array("q")
+        self.offsets = array("q")
+        self.ring: Deque[Message] = deque(maxlen=ring_size)
+        self.size = 0
+        # the messages older than it are expired, left in the file till it's rewritten
+        self.floor = 0
+        self.lock = Lock()
+
+        self.file = open(path, "ab+")
+        self._scan()
+
+    def _scan(self) -> None:
+        """
+        Rebuilds the index from the file, a message cut short
+        by a crash while writing it is thrown away
+        """
+
+        # NOTE: only the headers are read, the messages are skipped over
+        end = self.file.seek(0, os.SEEK_END)
+        offset = 0
+        while offset + HEADER_SIZE <= end:
+            self.file.seek(offset)
+            id, size = unpack(HEADER, self.file.read(HEADER_SIZE))
+            if offset + HEADER_SIZE + size > end:
+                break
+
+            self.ids.append(id)
+            self.offsets.append(offset)
+            offset += HEADER_SIZE + size
+
+        self.file.truncate(offset)
+        self.size = offset
+        start = max(0, len(self.ids) - (self.ring.maxlen or 0))
+        self.ring.extend(self._read(index) for index in range(start, len(self.ids)))
+
+    def _first(self) -> int:
+        return bisect_left(self.ids, self.floor)
+
+    def __len__(self) -> int:
+        return len(self.ids) - self._first()
+
+    def last_id(self) -> int:
+        return self.ids[-1] if self.ids else 0
+
+    def append(self, message: Message) -> None:
+        data = dumps(message)
+        with self.lock:
+            # NOTE: the ids only increase so the log stays sorted
+            self.offsets.append(self.file.seek(0, os.SEEK_END))
+            self.file.write(pack(HEADER, message.id, len(data)) + data)
+            self.file.flush()
+            self.size += HEADER_SIZE + len(data)
+            self.ids.append(message.id)
+            self.ring.append(message)
+
+    def _read(self, index: int) -> Message:
+        self.file.seek(self.offsets[index])
+        _, size = unpack(HEADER, self.file.read(HEADER_SIZE))
+        return loads(self.file.read(size))
+
+    def _at(self, index: int) -> Message:
+        in_memory = len(self.ids) - len(self.ring)
+        if index >= in_memory:
+            return self.ring[index - in_memory]
+
+        return self._read(index)
+
+    def get(self, id: int) -> Optional[Message]:
+        """
+        The message with the id, `None` if the log doesn't have it
+        """
+
+        with self.lock:
+            index = bisect_left(self.ids, id)
+            if id >= self.floor and index < len(self.ids) and self.ids[index] == id:
+                return self._at(index)
+
+        return None
+
+    def page(
+        self, before: int = -1, limit: int = PAGE_SIZE
+    ) -> Tuple[List[Message], bool]:
+        """
+        Returns up to `limit` messages older than the id `before` (the newest
+        ones if it is -1), oldest first and if there are older messages left
+        """
+
+        with self.lock:
+            first = self._first()
+            end = len(self.ids) if before == -1 else bisect_left(self.ids, before)
+            start = max(first, end - limit)
+            return [self._at(index) for index in range(start, end)], start > first
+
+    def after(self, id: int) -> Iterator[Message]:
+        """
+        The messages newer than the id, oldest first
+        """
+
+        # NOTE: looked up by the id every time as the expired ones may be dropped meanwhile
+        while True:
+            with self.lock:
+                index = bisect_right(self.ids, max(id, self.floor - 1))
+                if index >= len(self.ids):
+                    return
+                message = self._at(index)
+
+            yield message
+            id = message.id
+
+    def cutoff(self, policy: Policy, now: float) -> int:
+        """
+        The index of the oldest message within the policy
+        """
+
+        with self.lock:
+            count = len(self.ids)
+            start = max(0, count - policy.get("count", count))
+            if "bytes" in policy:
+                start = max(
+                    start, bisect_left(self.offsets, self.size - policy["bytes"])
+                )
+
+            if "age" in policy:
+                # NOTE: the times increase along with the ids
+                low, high = start, count
+                while low < high:
+                    middle = (low + high) // 2
+                    if self._at(middle).time < now - policy["age"]:
+                        low = middle + 1
+                    else:
+                        high = middle
+                start = low
+
+            return start
+
+    def expire(
+        self,
+        policy: Policy,
+        now: float,
+        keep: Optional[Callable[[Message], bool]] = None,
+    ) -> List[int]:
+        """
+        Drops the messages outside the policy (but the ones to `keep`)
+        and returns their ids, the ones dropped before aren't returned again
+
+        The log is rewritten without them, the appends only wait
+        for the copy of the messages appended while rewriting it. Until
+        they are `COMPACT_SLACK` of it they are only hidden from the reads
+        (the ones to `keep` aside, those are left as they are)
+        """
+
+        end = self.cutoff(policy, now)
+        with self.lock:
+            # NOTE: the messages before `copied` are not touched while rewriting
+            ids = self.ids[:end]
+            offsets = self.offsets[: end + 1]
+            copied = self.size
+            floor = self.floor
+        if not ids:
+            return []
+        if len(offsets) == end:
+            offsets.append(copied)
+
+        with open(self.path, "rb") as source:
+            kept: List[int] = []
+            if keep is not None:
+                for index in range(end):
+                    source.seek(offsets[index] + HEADER_SIZE)
+                    size = offsets[index + 1] - offsets[index] - HEADER_SIZE
+                    if keep(loads(source.read(size))):
+                        kept.append(index)
+
+            dropped = offsets[end] - sum(offsets[i + 1] - offsets[i] for i in kept)
+            if len(kept) == end or dropped < COMPACT_SLACK * copied:
+                if keep is not None:
+                    return []
+
+                # NOTE: hidden till the log is rewritten, so the policy holds meanwhile
+                with self.lock:
+                    self.floor = max(self.floor, ids[-1] + 1)
+                return [id for id in ids if id >= floor]
+
+            rewrite = f"{self.path}{REWRITE_SUFFIX}"
+            with open(rewrite, "wb") as target:
+                kept_offsets = array("q")
+                for index in kept:
+                    kept_offsets.append(target.tell())
+                    source.seek(offsets[index])
+                    target.write(source.read(offsets[index + 1] - offsets[index]))
+
+                shift = target.tell() - offsets[end]
+                source.seek(offsets[end])
+                left = copied - offsets[end]
+                while left > 0:
+                    chunk = source.read(min(left, COPY_CHUNK))
+                    target.write(chunk)
+                    left -= len(chunk)
+
+                with self.lock:
+                    # the ones appended meanwhile
+                    source.seek(copied)
+                    target.write(source.read())
+                    target.flush()
+                    os.fsync(target.fileno())
+                    os.replace(rewrite, self.path)
+
+                    self.file.close()
+                    self.file = open(self.path, "ab+")
+                    self.size = target.tell()
+                    self.ids = array("q", (ids[i] for i in kept)) + self.ids[end:]
+                    self.offsets = kept_offsets + array(
+                        "q", (offset + shift for offset in self.offsets[end:])
+                    )
+
+                    gone = set(ids) - {ids[i] for i in kept}
+                    self.ring = deque(
+                        (message for message in self.ring if message.id not in gone),
+                        maxlen=self.ring.maxlen,
+                    )
+
+        return sorted(id for id in gone if id >= floor)
+
+    def close(self) -> None:
+        with self.lock:
+            self.file.close()
+
+
+class History:
+    """
+    The logs of all the rooms, kept in a folder with a file per room
+
+    A log is opened (and its index built) the first time it's needed,
+    so the startup only lists the folder however long the history is
+    """
+
+    def __init__(self, folder: str) -> None:
+        self.folder = folder
+        os.makedirs(folder, exist_ok=True)
+
+        # the logs opened so far
+        self.logs: Dict[str, RoomLog] = dict()
+        # the house (or a user's `HOME`) -> the keys of its rooms
+        self.houses: Dict[str, Set[str]] = dict()
+        self.lock = Lock()
+
+        for name in os.listdir(folder):
+            if name.endswith(REWRITE_SUFFIX):
+                # a rewrite cut short, the log itself is still whole
+                os.remove(os.path.join(folder, name))
+            else:
+                self._add_key(unquote(name))
+
+    def _add_key(self, key: str) -> None:
+        self.houses.setdefault(key.rpartition("/")[0], set()).add(key)
+
+    def _open(self, key: str) -> RoomLog:
+        log = self.logs.get(key)
+        if log is None:
+            path = os.path.join(self.folder, quote(key, safe=""))
+            log = self.logs[key] = RoomLog(path)
+            self._add_key(key)
+
+        return log
+
+    def get(self, key: str) -> Optional[RoomLog]:
+        with self.lock:
+            if key not in self.houses.get(key.rpartition("/")[0], ()):
+                return None
+
+            return self._open(key)
+
+    def append(self, key: str, message: Message) -> None:
+        with self.lock:
+            log = self._open(key)
+
+        log.append(message)
+
+    def rooms(self, house: str) -> List[str]:
+        """
+        The keys of the rooms of a house (see `house_key`)
+        """
+
+        with self.lock:
+            return list(self.houses.get(house, ()))
+
+    def keys(self) -> List[str]:
+        with self.lock:
+            return [key for keys in self.houses.values() for key in keys]
+
+    def opened(self) -> List[Tuple[str, RoomLog]]:
+        """
+        The logs opened so far, the rest didn't change since the start
+        """
+
+        with self.lock:
+            return list(self.logs.items())
+
+    def last_id(self) -> int:
+        """
+        The newest id of all the logs, opens every one of them
+        """
+
+        keys = self.keys()
+        with self.lock:
+            return max((self._open(key).last_id() for key in keys), default=0)
+
+    def close(self) -> None:
+        with self.lock:
+            for log in self.logs.values():
+                log.close()
@@ -1,12 +1,56 @@
-from typing import Dict, List
+from bisect import bisect_left, bisect_right, insort
+from collections import deque
+from typing import Deque, Dict, FrozenSet, List, Tuple, Union
 from .message import Message
 from .rank import Rank
+from .retention import EVERY_ROOM, Policy, describe, parse_limit
 from .message_templates import (
     welcome_message,
     kick_message,
     mute_message,
 )
 
+# the state changes a member can catch up on without a fresh snapshot
+DELTA_ACTIONS = {
+    "add_room",
+    "del_room",
+    "change_room_name",
+    "change_room_icon",
+    "add_rank",
+    "del_rank",
+    "change_rank_color",
+    "change_rank_icon",
+    "change_rank_name",
+    "add_user_rank",
+    "del_user_rank",
+    "change_retention",
+}
+# how many of the latest state changes are kept, older versions get a snapshot
+DELTA_LOG_SIZE = 512
+
+# members sent for a single `fetch_members` request
+MEMBERS_PAGE_SIZE = 100
+# sorts after every name starting with the same prefix
+MAX_CHAR = chr(0x10FFFF)
+
+# the name of the houses of the direct chats, taken by no house nor room
+RESERVED_NAME = "HOME"
+
+
+def is_valid_name(name: str) -> bool:
+    """
+    If a house or a room can have the name, a `/` would make the key of
+    another room's log out of it (see `room_key`) and `HOME` is the direct chats'
+    """
+
+    return bool(name) and "/" not in name and name != RESERVED_NAME
+
+
+# the containers nobody wrote to yet are the same (empty) object for all the
+# houses, the sets are replaced on a change and the deltas made on the first one
+NO_USERS: FrozenSet[str] = frozenset()
+NO_DELTAS: Tuple[Message, ...] = ()
+
 
 class HouseData:
     def __init__(
@@ -15,17 +59,37 @@ class HouseData:
         rooms: set[str],
         room_icons: dict[str, str],
         ranks: dict[str, Rank],
-        member_rank: dict[str, str],
+        rank_counts: dict[str, int],
+        version: int = 0,
+        retention: dict[str, Policy] = {},
+        bots: FrozenSet[str] = frozenset(),
     ):
         """
         A class to be passed through a `Message` class for house-data exchanges
+        the members themselves are fetched a page at a time with `fetch_members`
         """
 
         self.name = name
-        self.rooms = rooms
+        self.rooms = set(rooms)
         self.room_icons = dict(room_icons)
         self.ranks = dict(ranks)
-        self.member_rank = dict(member_rank)
+        self.rank_counts = dict(rank_counts)
+        self.version = version
+        self.retention = dict(retention)
+        self.bots = frozenset(bots)
+
+    def __setstate__(self, state: dict) -> None:
+        # NOTE: the older snapshots had the whole `member_rank`
+        member_rank = state.pop("member_rank", None)
+        self.__dict__.update(state)
+        if member_rank is not None:
+            self.rank_counts = dict()
+            for rank in member_rank.values():
+                self.rank_counts[rank] = self.rank_counts.get(rank, 0) + 1
+
+        self.__dict__.setdefault("version", 0)
+        self.__dict__.setdefault("retention", dict())
+        self.__dict__.setdefault("bots", frozenset())
 
 
 class House:
@@ -33,6 +97,27 @@ class House:
     A house class for maintaining the data about a house
     """
 
+    __slots__ = (
+        "type",
+        "name",
+        "king",
+        "rooms",
+        "room_icons",
+        "members",
+        "banned_users",
+        "muted_users",
+        "bot_binds",
+        "waiting_users",
+        "member_rank",
+        "ranks",
+        "required_power",
+        "retention",
+        "version",
+        "deltas",
+        "rank_members",
+        "sender_styles",
+    )
+
     def __init__(self, name: str, king: str) -> None:
         self.type = "open"
         self.name = name
@@ -40,10 +125,10 @@ class House:
         self.rooms = {"general"}
         self.room_icons = dict()
         self.members = set([king])
-        self.banned_users = set()
-        self.muted_users = set()
-        self.bot_binds = set()
-        self.waiting_users = set()
+        self.banned_users = NO_USERS
+        self.muted_users = NO_USERS
+        self.bot_binds = NO_USERS
+        self.waiting_users = NO_USERS
         self.member_rank: Dict[str, str] = {king: "king"}
         self.ranks: Dict[str, Rank] = {
             "king": Rank("king", "red", float("inf"), icon=""),
@@ -51,6 +136,45 @@ class House:
         }
         self.room_icons["general"] = "ﴘ"
         self.required_power: Dict[str, float] = dict()
+        # room (or `*` for all of them) -> how long its messages are kept
+        self.retention: Dict[str, Policy] = dict()
+
+        # every state change bumps the version, the latest ones are kept
+        # so that the members can catch up with just the changes they missed
+        self.version = 0
+        self.deltas: Union[Deque[Message], Tuple[Message, ...]] = NO_DELTAS
+        # rank -> its members, sorted for paging through them
+        self.rank_members: Dict[str, List[str]] = {"king": [king]}
+        # member -> the color and icon of its rank, forgotten when either changes
+        self.sender_styles: Dict[str, Tuple[str, str]] = dict()
+
+    def __getstate__(self) -> dict:
+        return {
+            slot: getattr(self, slot)
+            for slot in self.__slots__
+            if slot not in ("rank_members", "sender_styles")
+        }
+
+    def __setstate__(self, state: dict) -> None:
+        self.version = 0
+        self.deltas = NO_DELTAS
+        self.retention = dict()
+        for slot, value in state.items():
+            setattr(self, slot, value)
+
+        # NOTE: the older houses had sets of their own, empty or not
+        for slot in ("banned_users", "muted_users", "bot_binds", "waiting_users"):
+            setattr(self, slot, frozenset(getattr(self, slot)) or NO_USERS)
+        if not self.deltas:
+            self.deltas = NO_DELTAS
+
+        self.sender_styles = dict()
+
+        self.rank_members = dict()
+        for member, rank in self.member_rank.items():
+            self.rank_members.setdefault(rank, []).append(member)
+        for members in self.rank_members.values():
+            members.sort()
 
     def _is_allowed(self, action: str, user: str) -> bool:
         """
@@ -62,7 +186,7 @@ class House:
         )
 
     def add_to_waiting_list(self, user: str):
-        self.waiting_users.add(user)
+        self.waiting_users = self.waiting_users | {user}
 
     def add_room(self, name: str) -> None:
         self.rooms.add(name)
@@ -70,15 +194,16 @@ class House:
 
     def del_room(self, name: str) -> None:
         self.rooms.remove(name)
+        self.retention.pop(name, None)
 
     def ban_user(self, name: str) -> None:
         if name in self.members:
             self.members.remove(name)
 
-        self.banned_users.add(name)
+        self.banned_users = self.banned_users | {name}
 
     def unban_user(self, name: str) -> None:
-        self.banned_users.remove(name)
+        self.banned_users = self.banned_users - {name}
 
     def add_rank(self, rank: str):
         self.ranks[rank] = Rank(rank)
@@ -93,10 +218,10 @@ class House:
         self.members.remove(member)
 
     def mute_member(self, member: str):
-        self.muted_users.add(member)
+        self.muted_users = self.muted_users | {member}
 
     def unmute_member(self, member: str):
-        self.muted_users.remove(member)
+        self.muted_users = self.muted_users - {member}
 
     def toggle_type(self):
         self.type = "open" if self.type == "private" else "private"
@@ -108,9 +233,73 @@ class House:
             self.rooms,
             self.room_icons,
             self.ranks,
-            self.member_rank,
+            {rank: len(members) for rank, members in self.rank_members.items()},
+            self.version,
+            self.retention,
+            self.bot_binds,
         )
 
+    def sender_style(self, member: str) -> Tuple[str, str]:
+        """
+        The color and icon of the member's rank
+        """
+
+        style = self.sender_styles.get(member)
+        if style is None:
+            rank = self.ranks.get(self.member_rank.get(member, ""))
+            if rank is None:
+                return "magenta", ""
+
+            style = self.sender_styles[member] = (rank.color, rank.icon)
+
+        return style
+
+    def _track_changes(self, message_list: List[Message]) -> List[Message]:
+        """
+        Stamps the state changes with the next versions
+        and keeps them for the members catching up later
+        """
+
+        for message in message_list:
+            if message.action not in DELTA_ACTIONS or message.house != self.name:
+                continue
+
+            self.version += 1
+            message.data = {**message.data, "version": self.version}
+            if not isinstance(self.deltas, deque):
+                self.deltas = deque(maxlen=DELTA_LOG_SIZE)
+            self.deltas.append(
+                Message(
+                    house=self.name,
+                    room=message.room,
+                    action=message.action,
+                    data=message.data,
+                )
+            )
+
+            data = message.data
+            match message.action:
+                case "add_user_rank":
+                    insort(self.rank_members.setdefault(data["rank"], []), data["user"])
+                    self.sender_styles.pop(data["user"], None)
+                case "del_user_rank":
+                    members = self.rank_members.get(data["rank"], [])
+                    if data["user"] in members:
+                        members.remove(data["user"])
+                    self.sender_styles.pop(data["user"], None)
+                case "del_rank":
+                    self.rank_members.pop(data["rank"], None)
+                    self.sender_styles.clear()
+                case "change_rank_color" | "change_rank_icon":
+                    self.sender_styles.clear()
+                case "change_rank_name":
+                    members = self.rank_members.pop(data["rank"], [])
+                    self.rank_members[data["name"]] = members
+                    for member in members:
+                        self.member_rank[member] = data["name"]
+
+        return message_list
+
     def add_member(self, user: str) -> List[Message]:
         self.members.add(user)
         x = [
@@ -219,7 +408,7 @@ class House:
         for user in self.waiting_users:
             x.extend(self.add_member(user))
 
-        self.waiting_users = set()
+        self.waiting_users = NO_USERS
 
         return x + [
             Message(
@@ -263,6 +452,8 @@ class House:
             return [message.convert(text="the room must have a name")]
 
         room = params[0].strip()
+        if not is_valid_name(room):
+            return [message.convert(text=f"a room can't be named {room}")]
         if room in self.rooms:
             return [message.convert(text="There is already a room with same name!")]
 
@@ -299,7 +490,7 @@ class House:
                 ),
             ]
 
-        self.waiting_users.remove(user)
+        self.waiting_users = self.waiting_users - {user}
         return self.add_member(user)
 
     def action_reject(self, message: Message) -> List[Message]:
@@ -314,7 +505,7 @@ class House:
                 ),
             ]
 
-        self.waiting_users.remove(user)
+        self.waiting_users = self.waiting_users - {user}
         return [
             message.convert(
                 text=f"user {user} was rejected to join the group by {message.sender}"
@@ -332,8 +523,18 @@ class House:
         if user in self.banned_users:
             return [message.convert(text=f"user {user} is already banned")]
 
+        x = []
+        if user in self.member_rank:
+            x.append(
+                message.convert(
+                    action="del_user_rank",
+                    data={"rank": self.member_rank.pop(user), "user": user},
+                    reciepents=list(self.members - {user}),
+                )
+            )
+
         self.ban_user(user)
-        return [
+        return x + [
             message.convert(
                 text=f"user {user} was banned by {message.sender}",
                 reciepents=list(self.members),
@@ -370,7 +571,7 @@ class House:
         elif room not in self.rooms:
             return [message.convert(text=f"there is no room with the name {room}")]
 
-        self.rooms.remove(room)
+        self.del_room(room)
         del self.room_icons[room]
         return [
             message.convert(
@@ -559,10 +760,15 @@ class House:
         if message.room == "general":
             return [message.convert(text="You can't change this room's name")]
 
+        if not is_valid_name(name):
+            return [message.convert(text=f"a room can't be named {name}")]
+
         if name in self.rooms:
             return [message.convert(text="There is already a room with the same name")]
 
         self.room_icons[name] = self.room_icons[message.room]
+        if message.room in self.retention:
+            self.retention[name] = self.retention[message.room]
 
         self.add_room(name)
         self.del_room(message.room)
@@ -596,6 +802,91 @@ class House:
             )
         ]
 
+    def action_set_retention(self, message: Message) -> List[Message]:
+        room, limit, value = message.text[15:].split()
+        if room != EVERY_ROOM and room not in self.rooms:
+            return [message.convert(text=f"there is no room with the name {room}")]
+
+        policy = dict(self.retention.get(room, {}))
+        policy[limit] = parse_limit(limit, value)
+        if not policy[limit]:
+            del policy[limit]
+
+        if policy:
+            self.retention[room] = policy
+        else:
+            self.retention.pop(room, None)
+
+        rooms = "every room" if room == EVERY_ROOM else f"room {room}"
+        return [
+            message.convert(
+                action="change_retention",
+                data={"room": room, "policy": policy},
+                reciepents=list(self.members),
+            ),
+            message.convert(
+                text=f"retention of {rooms}: {describe(policy)} (set by {message.sender})",
+                reciepents=list(self.members),
+            ),
+        ]
+
+    def action_add_bot(self, message: Message) -> List[Message]:
+        bot = message.text[9:].strip()
+        if not bot:
+            raise ValueError("no bot given")
+        if bot in self.bot_binds:
+            return [message.convert(text=f"bot {bot} is already in the house")]
+        if bot in self.members or bot in self.banned_users:
+            return [message.convert(text=f"{bot} is a user, not a bot")]
+
+        self.bot_binds = self.bot_binds | {bot}
+        return [
+            self._bots_changed(),
+            message.convert(
+                text=f"bot {bot} was added to the house by {message.sender}",
+                reciepents=list(self.members),
+            ),
+        ]
+
+    def action_del_bot(self, message: Message) -> List[Message]:
+        bot = message.text[9:].strip()
+        if bot not in self.bot_binds:
+            return [message.convert(text=f"there is no bot with the name {bot}")]
+
+        self.bot_binds = self.bot_binds - {bot}
+        return [
+            self._bots_changed(),
+            message.convert(
+                text=f"bot {bot} was removed from the house by {message.sender}",
+                reciepents=list(self.members),
+            ),
+        ]
+
+    def _bots_changed(self) -> Message:
+        """
+        The bots of the house for the server's bot runtime, sent to no member
+        """
+
+        return Message(
+            action="change_bots",
+            house=self.name,
+            data={"bots": sorted(self.bot_binds)},
+        )
+
+    def _for_bots(self, message: Message) -> bool:
+        """
+        If a text starting with `/` is a bot's or a command for the bots
+        those are sent to the room like any other text
+        """
+
+        if not self.bot_binds:
+            return False
+
+        action, *_ = message.text[1:].split(" ", 1)
+        # NOTE: a member is never a bot, even if the house had one's name bound
+        is_bot = message.sender in self.bot_binds and message.sender not in self.members
+        return is_bot or not hasattr(self, f"action_{action}")
+
     def action_bye(self, message: Message) -> List[Message]:
         member = message.sender
         self.members.remove(member)
@@ -623,18 +914,112 @@ class House:
         """
         Process the messages sent to the house
         """
-        if message.text[0] == "/":
-            return self.process_special_message(message)
+        if message.text[0] == "/" and not self._for_bots(message):
+            return self._track_changes(self.process_special_message(message))
         else:
             if message.sender not in self.muted_users:
                 return [
                     message.convert(
                         sender="self",
                         reciepents=list(self.members),
+                        data=message.data,
                     )
                 ]
             return []
 
+    # +-------------------------------------------+
+    # | Requests of a member's client, answered   |
+    # | to the member only                        |
+    # +-------------------------------------------+
+
+    # SYNTAX : request_<action>(message: Message) -> List[Message]
+
+    def request_sync_house(self, message: Message) -> List[Message]:
+        """
+        The changes since the member's version of the house
+        or a fresh snapshot if they are not kept anymore
+        """
+
+        version = int(message.data.get("version", 0))
+        if version == self.version:
+            return []
+
+        oldest = self.deltas[0].data["version"] if self.deltas else self.version + 1
+        if oldest <= version + 1 <= self.version + 1:
+            return [
+                Message(
+                    house=self.name,
+                    room=delta.room,
+                    action=delta.action,
+                    data=delta.data,
+                    reciepents=[message.sender],
+                )
+                for delta in self.deltas
+                if delta.data["version"] > version
+            ]
+
+        return [
+            message.convert(
+                action="sync_house",
+                data={"house": self._generate_house_data()},
+            )
+        ]
+
+    def request_fetch_members(self, message: Message) -> List[Message]:
+        """
+        A page of a rank's members (sorted by name) after the name `after`
+        only the ones starting with `prefix` if given, with their count
+        """
+
+        rank = message.data["rank"]
+        prefix = message.data.get("prefix", "")
+        limit = int(message.data.get("limit", MEMBERS_PAGE_SIZE))
+        limit = min(max(limit, 1), MEMBERS_PAGE_SIZE)
+        members = self.rank_members.get(rank, [])
+
+        # NOTE: the sorted members are a prefix index of themselves
+        low = bisect_left(members, prefix)
+        high = bisect_left(members, prefix + MAX_CHAR) if prefix else len(members)
+        start = max(low, bisect_right(members, message.data.get("after", "")))
+        end = min(start + limit, high)
+
+        return [
+            message.convert(
+                action="members",
+                data={
+                    "rank": rank,
+                    "prefix": prefix,
+                    "members": members[start:end],
+                    "has_more": end < high,
+                    "count": high - low,
+                },
+            )
+        ]
+
+    def share_presence(self, message: Message) -> List[Message]:
+        """
+        Sends a batch of the members' presence changes to the whole house
+        """
+
+        return [
+            message.convert(
+                action="presence",
+                reciepents=list(self.members),
+                data=message.data,
+            )
+        ]
+
+    def process_request(self, message: Message) -> List[Message]:
+        if message.sender not in self.members:
+            return []
+
+        try:
+            request = getattr(self, f"request_{message.action}")
+        except AttributeError:
+            return []
+
+        return request(message)
+
     def process_special_message(self, message: Message) -> List[Message]:
         """
         Process special messages starting with `/`
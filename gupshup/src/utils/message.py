@@ -1,12 +1,33 @@
 from typing import List, Any
 from copy import deepcopy
 
+# answers with a page of data for a single connection, never kept for later
+PAGES = ("history", "members")
+
+# the state of the moment (like who is online), only for the ones connected
+LIVE = ("presence", "caught_up")
+
+# the optional features of the protocol, agreed on in the handshake
+# `zlib`: frames above a size are compressed (see `Channel`)
+# `names`: the names in the messages are sent as ids (see `NameTable`)
+CAPABILITIES = {"presence", "zlib", "names"}
+
 
 class Message:
     """
     A message class for tranferring data between server and client
     """
 
+    # assigned by the server when the message is broadcasted
+    id: int = -1
+    # when it was broadcasted (seconds since the epoch), 0 for the older ones
+    time: float = 0.0
+    # set by the house when the message is for everyone in the room
+    room_wide: bool = False
+    # how the sender's name is shown, the rank's color and icon inside a house
+    color: str = ""
+    icon: str = ""
+
     def __init__(
         self,
         sender: str = "SERVER",
@@ -25,6 +46,18 @@ class Message:
         self.reciepents = reciepents
         self.data = data
 
+    def styled_sender(self) -> str:
+        """
+        The sender's name with its color and icon markup
+        the older messages have the markup in the name itself
+        """
+
+        if not self.color:
+            return self.sender
+
+        icon = f"{self.icon} " if self.icon else ""
+        return f"[{self.color}]{icon}{self.sender}[/{self.color}]"
+
     def clone(self) -> "Message":
         return deepcopy(self)
 
@@ -0,0 +1,131 @@
+import sys
+from copy import copy
+from threading import Lock
+from typing import Dict, List, Optional, Tuple
+
+from .message import Message
+
+# the fields of a message that are names (of users, houses and rooms)
+NAMED_FIELDS = ("sender", "house", "room")
+
+# the keys of a message's data that may be names, `messages` are the
+# messages of a page or a catch-up, sent with their names as ids too
+NAMED_DATA = ("user", "rank", "messages")
+
+# the names given an id, the ones after it are sent as they are
+MAX_NAMES = 1 << 18
+
+
+class NameTable:
+    """
+    The names seen by the process, each one kept as a single string
+    object and given a small id that never changes
+
+    The ids are the same for every connection, each one announces
+    to the other side the ones it didn't send yet (see `Channel`)
+    """
+
+    def __init__(self, limit: int = MAX_NAMES) -> None:
+        self.limit = limit
+        self.ids: Dict[str, int] = dict()
+        self.names: List[str] = []
+        # NOTE: the names are only ever added so reading needs no lock
+        self.lock = Lock()
+
+    def __len__(self) -> int:
+        return len(self.names)
+
+    def id(self, name: str) -> Optional[int]:
+        """
+        The id of the name, `None` once the table is full
+        """
+
+        id = self.ids.get(name)
+        if id is not None:
+            return id
+
+        with self.lock:
+            id = self.ids.get(name)
+            if id is None and len(self.names) < self.limit:
+                id = len(self.names)
+                self.names.append(sys.intern(name))
+                self.ids[self.names[id]] = id
+
+        return id
+
+    def name(self, id: int) -> str:
+        return self.names[id]
+
+
+# the table of the whole process
+NAMES = NameTable()
+
+
+def to_ids(message: Message) -> Tuple[Message, List[int]]:
+    """
+    A copy of the message with the names as ids of `NAMES` and the ids used
+    the data's keys that were changed are listed in the copy's `named`
+    """
+
+    ids: List[int] = []
+
+    def as_id(name):
+        id = NAMES.id(name) if isinstance(name, str) and name else None
+        if id is None:
+            return name
+
+        ids.append(id)
+        return id
+
+    wire = copy(message)
+    for field in NAMED_FIELDS:
+        setattr(wire, field, as_id(getattr(message, field)))
+    if message.reciepents:
+        wire.reciepents = [as_id(name) for name in message.reciepents]
+
+    named = {}
+    for key in NAMED_DATA:
+        value = message.data.get(key)
+        if key == "messages" and isinstance(value, list):
+            named[key] = []
+            for nested in value:
+                nested, nested_ids = to_ids(nested)
+                named[key].append(nested)
+                ids.extend(nested_ids)
+        elif key != "messages" and isinstance(value, str):
+            named[key] = as_id(value)
+    if named:
+        wire.data = {**message.data, **named}
+        wire.named = tuple(named)
+
+    return wire, ids
+
+
+def from_ids(message: Message, names: Dict[int, str]) -> Message:
+    """
+    Puts back the names of a message whose ids are in `names`, in place
+    the names sent as they are are interned so that each one is kept once
+    raises a `ValueError` for an id that was never announced
+    """
+
+    def as_name(value):
+        if isinstance(value, str):
+            return sys.intern(value)
+        try:
+            return names[value]
+        except (KeyError, TypeError):
+            raise ValueError(f"unknown name id {value!r}") from None
+
+    for field in NAMED_FIELDS:
+        setattr(message, field, as_name(getattr(message, field)))
+    if message.reciepents:
+        message.reciepents = [as_name(name) for name in message.reciepents]
+
+    for key in message.__dict__.pop("named", ()):
+        if key == "messages":
+            for nested in message.data[key]:
+                from_ids(nested, names)
+        elif key in NAMED_DATA:
+            message.data[key] = as_name(message.data[key])
+
+    return message
@@ -0,0 +1,152 @@
+from collections import deque
+from threading import Condition, Thread
+from time import monotonic
+from typing import Callable, Deque, Optional, Tuple
+
+from .channel import Channel, Frames
+from .message import Message
+
+# sizes are in bytes of encoded frames
+HIGH_WATERMARK = 1024 * 1024
+LOW_WATERMARK = 256 * 1024
+
+# what to do with a connection that can't keep up
+POLICIES = ("drop", "defer", "disconnect")
+
+
+class Outbox:
+    """
+    A per-connection outbound buffer with its own writer thread
+    so that a slow reader only ever stalls its own connection
+    """
+
+    def __init__(
+        self,
+        channel: Channel,
+        high_watermark: int = HIGH_WATERMARK,
+        low_watermark: int = LOW_WATERMARK,
+        on_drain: Optional[Callable[[], None]] = None,
+    ) -> None:
+        self.channel = channel
+        self.high_watermark = high_watermark
+        self.low_watermark = low_watermark
+        self.on_drain = on_drain
+
+        self.frames: Deque[Tuple[float, bytes]] = deque()
+        self.queued_bytes = 0
+        self.lagging = False
+        self.closed = False
+
+        # metrics
+        self.sent = 0
+        self.dropped = 0
+        self.max_lag = 0.0
+
+        self.cond = Condition()
+        Thread(target=self._write_loop, daemon=True).start()
+
+    def push(
+        self,
+        message: Message,
+        force: bool = False,
+        frames: Optional[Frames] = None,
+    ) -> bool:
+        """
+        Queues the message for sending, returns `False` if the connection
+        is lagging behind (above the high watermark) and the message was not queued
+        `force` queues it regardless of the watermarks
+        `frames` shares the encoded message between the outboxes (see `Channel.encode`)
+        """
+
+        with self.cond:
+            if self.closed or (self.lagging and not force):
+                return False
+
+            # NOTE: encoded in the lock, the frames announcing the names
+            # must be queued before the ones using them
+            frame = self.channel.encode(message, frames)
+
+            self.frames.append((monotonic(), frame))
+            self.queued_bytes += len(frame)
+            if self.queued_bytes >= self.high_watermark:
+                self.lagging = True
+
+            self.cond.notify()
+
+        return True
+
+    def wait_for_room(self) -> bool:
+        """
+        Blocks while the connection is lagging behind
+        returns `False` if it got closed meanwhile
+        """
+
+        with self.cond:
+            while self.lagging and not self.closed:
+                self.cond.wait()
+
+            return not self.closed
+
+    def lag(self) -> float:
+        """
+        Seconds for which the oldest queued frame has been waiting
+        """
+
+        with self.cond:
+            if not self.frames:
+                return 0.0
+            return monotonic() - self.frames[0][0]
+
+    def stats(self) -> dict[str, float]:
+        return {
+            "queued": len(self.frames),
+            "queued_bytes": self.queued_bytes,
+            "lag": self.lag(),
+            "max_lag": self.max_lag,
+            "sent": self.sent,
+            "dropped": self.dropped,
+            **self.channel.compression_stats(),
+        }
+
+    def _write_loop(self) -> None:
+        while True:
+            with self.cond:
+                while not self.frames and not self.closed:
+                    self.cond.wait()
+
+                if self.closed:
+                    return
+
+                enqueued, frame = self.frames.popleft()
+
+            try:
+                self.channel.send_frame(frame)
+            except OSError:  # User closed the application on his/her side
+                self.close()
+                return
+
+            drained = False
+            with self.cond:
+                self.queued_bytes -= len(frame)
+                self.sent += 1
+                self.max_lag = max(self.max_lag, monotonic() - enqueued)
+                if self.lagging and self.queued_bytes <= self.low_watermark:
+                    self.lagging = False
+                    drained = True
+                    self.cond.notify_all()
+
+            # NOTE: called without holding the lock as the callback may push again
+            if drained and self.on_drain:
+                self.on_drain()
+
+    def close(self) -> None:
+        with self.cond:
+            if self.closed:
+                return
+
+            self.closed = True
+            self.frames.clear()
+            self.queued_bytes = 0
+            self.cond.notify_all()
+
+        self.channel.close()
@@ -0,0 +1,156 @@
+import socket
+from abc import ABC, abstractmethod
+from collections import defaultdict
+from pickle import dumps, loads
+from queue import Queue
+from threading import Lock, Thread
+from typing import Any, Callable, Dict, List, Set
+
+from .channel import Channel
+from .outbox import Outbox
+from .logger import info, warn
+
+Callback = Callable[[Any], None]
+
+# the nodes get a lot more room than users before the broker gives up on them
+NODE_WATERMARKS = {
+    "high_watermark": 64 * 1024 * 1024,
+    "low_watermark": 16 * 1024 * 1024,
+}
+
+
+class PubSub(ABC):
+    """
+    The interface of the backbone connecting the nodes of a cluster
+    every payload published on a topic reaches every subscriber of that topic
+    """
+
+    @abstractmethod
+    def publish(self, topic: str, payload: Any) -> None:
+        """
+        Sends the payload to every subscriber of the topic
+        """
+
+    @abstractmethod
+    def subscribe(self, topic: str, callback: Callback) -> None:
+        """
+        Calls the callback with every payload published on the topic
+        """
+
+    def close(self) -> None:
+        pass
+
+
+class LocalPubSub(PubSub):
+    """
+    An in-process reference implementation, the nodes sharing
+    an instance see each other's messages
+    """
+
+    def __init__(self) -> None:
+        self.subscribers: Dict[str, List[Callback]] = defaultdict(list)
+        self.queue: Queue = Queue()
+        Thread(target=self._dispatch, daemon=True).start()
+
+    def publish(self, topic: str, payload: Any) -> None:
+        # a copy like it went over the wire so that the nodes never share objects
+        self.queue.put((topic, dumps(payload)))
+
+    def subscribe(self, topic: str, callback: Callback) -> None:
+        self.subscribers[topic].append(callback)
+
+    def _dispatch(self) -> None:
+        while True:
+            topic, payload = self.queue.get()
+            for callback in list(self.subscribers[topic]):
+                callback(loads(payload))
+
+
+class SocketPubSub(PubSub):
+    """
+    A client of a `PubSubBroker` running on another process or machine
+    """
+
+    def __init__(self, host: str, port: int) -> None:
+        self.channel = Channel(socket.create_connection((host, port)))
+        self.subscribers: Dict[str, List[Callback]] = defaultdict(list)
+        self.lock = Lock()
+        Thread(target=self._listen, daemon=True).start()
+
+    def _send(self, data: tuple) -> None:
+        with self.lock:
+            self.channel.send(data)
+
+    def publish(self, topic: str, payload: Any) -> None:
+        self._send(("publish", topic, payload))
+
+    def subscribe(self, topic: str, callback: Callback) -> None:
+        self.subscribers[topic].append(callback)
+        self._send(("subscribe", topic))
+
+    def _listen(self) -> None:
+        while True:
+            try:
+                _, topic, payload = self.channel.recv()
+            except (EOFError, OSError):
+                warn("lost the connection to the pubsub broker")
+                return
+
+            for callback in list(self.subscribers[topic]):
+                callback(payload)
+
+    def close(self) -> None:
+        self.channel.close()
+
+
+class PubSubBroker:
+    """
+    A minimal broker fanning out the published payloads to the subscribed nodes
+    """
+
+    def __init__(self, host: str = "localhost", port: int = 5600) -> None:
+        self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.server.bind((host, port))
+        self.topics: Dict[str, Set[Outbox]] = defaultdict(set)
+        self.lock = Lock()
+
+    def serve_node(self, outbox: Outbox) -> None:
+        while True:
+            try:
+                op, topic, *payload = outbox.channel.recv()
+            except (EOFError, OSError):
+                break
+
+            with self.lock:
+                if op == "subscribe":
+                    self.topics[topic].add(outbox)
+                else:
+                    for subscriber in self.topics[topic]:
+                        if not subscriber.push(("message", topic, *payload)):
+                            warn(
+                                f"a node is lagging behind, dropped a message on {topic}"
+                            )
+
+        with self.lock:
+            for subscribers in self.topics.values():
+                subscribers.discard(outbox)
+
+        outbox.close()
+
+    def start(self) -> None:
+        self.server.listen()
+        info("pubsub broker is up and running")
+        while True:
+            try:
+                conn, _ = self.server.accept()
+                Thread(
+                    target=self.serve_node,
+                    args=(Outbox(Channel(conn), **NODE_WATERMARKS),),
+                    daemon=True,
+                ).start()
+
+            except KeyboardInterrupt:
+                break
+
+        self.server.close()
@@ -3,6 +3,8 @@ class Rank:
     A rank class for the ranking
     """
 
+    __slots__ = ("name", "color", "power", "desc", "icon")
+
     def __init__(
         self,
         name: str,
@@ -14,11 +16,23 @@ class Rank:
         self.color = color
         self.power = power
         self.desc = "This rank doesn't have an info yet!"
-        self.info = (
+        self.icon = icon
+
+    def __getstate__(self) -> dict:
+        return {slot: getattr(self, slot) for slot in self.__slots__}
+
+    def __setstate__(self, state: dict) -> None:
+        # NOTE: the older ranks had their info made upfront
+        state.pop("info", None)
+        for slot, value in state.items():
+            setattr(self, slot, value)
+
+    @property
+    def info(self) -> str:
+        return (
             f"name: {self.name}"
             + "\n"
             + f"power: {self.power}"
             + "\n"
             + f"desc: {self.desc}"
         )
-        self.icon = icon
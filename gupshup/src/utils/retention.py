@@ -0,0 +1,91 @@
+from math import isfinite
+from typing import Dict, Iterable, List
+
+from .message import Message
+
+# what a policy can limit, a limit not set is unlimited
+LIMITS = ("age", "count", "bytes")
+
+# the suffixes of the limits' values, `7d` or `10m` (megabytes for `bytes`)
+UNITS = {
+    "age": {"s": 1, "m": 60, "h": 60 * 60, "d": 24 * 60 * 60, "w": 7 * 24 * 60 * 60},
+    "count": {},
+    "bytes": {"b": 1, "k": 1024, "m": 1024**2, "g": 1024**3},
+}
+
+# the room of a house's policy, used for the rooms that don't have their own
+EVERY_ROOM = "*"
+
+Policy = Dict[str, int]
+
+
+def parse_limit(limit: str, value: str) -> int:
+    """
+    The limit's value in seconds, messages or bytes, `off` removes the limit (0)
+    raises a `ValueError` for the ones that can't be parsed or aren't positive
+    """
+
+    if limit not in LIMITS:
+        raise ValueError(f"no such limit `{limit}`")
+
+    value = value.strip().lower()
+    if value == "off":
+        return 0
+
+    units = UNITS[limit]
+    if value and value[-1] in units:
+        number = float(value[:-1]) * units[value[-1]]
+        # NOTE: `float` takes `inf` and `nan` too, `int` can't convert them
+        if not isfinite(number):
+            raise ValueError(f"the {limit} must be finite")
+        number = int(number)
+    else:
+        number = int(value)
+
+    if number <= 0:
+        raise ValueError(f"the {limit} must be positive")
+
+    return number
+
+
+def room_policy(retention: Dict[str, Policy], room: str) -> Policy:
+    """
+    The house's policy for every room overridden by the room's own
+    """
+
+    return {**retention.get(EVERY_ROOM, {}), **retention.get(room, {})}
+
+
+def describe(policy: Policy) -> str:
+    parts = []
+    if "age" in policy:
+        parts.append(f"kept for {policy['age']}s")
+    if "count" in policy:
+        parts.append(f"at most {policy['count']} messages")
+    if "bytes" in policy:
+        parts.append(f"at most {policy['bytes']} bytes")
+
+    return ", ".join(parts) or "kept forever"
+
+
+def expired(messages: Iterable[Message], policy: Policy, now: float) -> List[Message]:
+    """
+    The messages (of a single room, oldest first) outside the policy
+    the sizes are of the texts as the ones on the server are not known here
+    """
+
+    messages = list(messages)
+    kept = 0
+    size = 0
+    for index in range(len(messages) - 1, -1, -1):
+        message = messages[index]
+        size += len(message.text.encode())
+        kept += 1
+        if (
+            kept > policy.get("count", kept)
+            or size > policy.get("bytes", size)
+            or message.time < now - policy.get("age", now)
+        ):
+            return messages[: index + 1]
+
+    return []
@@ -0,0 +1,253 @@
+import os
+import re
+from array import array
+from bisect import bisect_left
+from heapq import merge
+from struct import calcsize, pack, unpack
+from threading import Lock
+from typing import BinaryIO, Callable, Dict, Iterator, List, Optional, Set, Tuple
+from urllib.parse import quote, unquote
+
+from .message import Message
+
+TOKEN = re.compile(r"\w+")
+MARKUP = re.compile(r"\[/?[a-zA-Z#@][^\[\]]*\]")
+PAGE_SIZE = 10
+# the hits are read from the logs up to the page asked for, so only so many pages
+MAX_PAGES = 10
+
+# every entry on disk is the message id and the size of its tokens,
+# an entry with no tokens drops the message (like an expired one)
+HEADER = "!qI"
+HEADER_SIZE = calcsize(HEADER)
+
+# the file being rewritten, a name `quote` never gives
+REWRITE_SUFFIX = "%tmp"
+
+# reads a message of a room's log by its id, `None` once it's gone
+Read = Callable[[str, int], Optional[Message]]
+
+# token -> the ids of the messages of a log containing it
+Postings = Dict[str, array]
+
+
+def plain(text: str) -> str:
+    """
+    Strips the rich markup (like the colors of a sender) from the text
+    """
+
+    return MARKUP.sub("", text)
+
+
+def tokenize(text: str) -> Set[str]:
+    return set(TOKEN.findall(plain(text).lower()))
+
+
+def _contains(postings: array, doc: int) -> bool:
+    index = bisect_left(postings, doc)
+    return index < len(postings) and postings[index] == doc
+
+
+class SearchIndex:
+    """
+    An inverted index over the chat history, kept apart for every room's log
+    (see `room_key`) so a search only goes through the rooms it can see
+
+    The postings of every token are the ids of the messages containing it
+    and as the ids only increase they are sorted by construction. A search
+    walks the shortest posting list from the newest message and checks the
+    other tokens with a binary search so it never scans the messages, the
+    hits are then read from the logs, the index only has their ids
+
+    The tokens of every message are appended to a file of its log's as it's
+    added, and a log's postings are read from it the first time it's searched
+    """
+
+    def __init__(self, folder: str) -> None:
+        self.folder = folder
+        os.makedirs(folder, exist_ok=True)
+
+        # the logs with a file and the postings of the ones read so far
+        self.keys: Set[str] = set()
+        self.postings: Dict[str, Postings] = dict()
+        # the newest id of the logs read so far
+        self.last_ids: Dict[str, int] = dict()
+        self.files: Dict[str, BinaryIO] = dict()
+        self.lock = Lock()
+
+        for name in os.listdir(folder):
+            if name.endswith(REWRITE_SUFFIX):
+                # a rewrite cut short, the file itself is still whole
+                os.remove(os.path.join(folder, name))
+            else:
+                self.keys.add(unquote(name))
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.folder, quote(key, safe=""))
+
+    def _write(self, key: str, data: bytes) -> None:
+        file = self.files.get(key)
+        if file is None:
+            file = self.files[key] = open(self._path(key), "ab")
+            self.keys.add(key)
+
+        file.write(data)
+        file.flush()
+
+    def _load(self, key: str) -> Postings:
+        """
+        The postings of a log, read from its file the first time
+        the file is rewritten without the dropped messages if it has any
+        """
+
+        postings = self.postings.get(key)
+        if postings is not None:
+            return postings
+
+        postings = self.postings[key] = dict()
+        self.last_ids[key] = 0
+        if key not in self.keys:
+            return postings
+
+        entries: Dict[int, bytes] = dict()
+        dropped = False
+        with open(self._path(key), "rb") as f:
+            data = f.read()
+
+        offset = 0
+        # NOTE: an entry cut short by a crash while writing it is thrown away
+        while offset + HEADER_SIZE <= len(data):
+            id, size = unpack(HEADER, data[offset : offset + HEADER_SIZE])
+            offset += HEADER_SIZE
+            if offset + size > len(data):
+                break
+
+            if size:
+                entries[id] = data[offset : offset + size]
+            else:
+                entries.pop(id, None)
+                dropped = True
+            offset += size
+
+        for id in sorted(entries):
+            for token in entries[id].decode().split():
+                postings.setdefault(token, array("q")).append(id)
+        self.last_ids[key] = max(entries, default=0)
+
+        if dropped or offset != len(data):
+            self._rewrite(key, entries)
+
+        return postings
+
+    def _rewrite(self, key: str, entries: Dict[int, bytes]) -> None:
+        file = self.files.pop(key, None)
+        if file is not None:
+            file.close()
+
+        path = self._path(key)
+        with open(f"{path}{REWRITE_SUFFIX}", "wb") as f:
+            for id in sorted(entries):
+                f.write(pack(HEADER, id, len(entries[id])) + entries[id])
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(f"{path}{REWRITE_SUFFIX}", path)
+
+    def add(self, key: str, message: Message) -> None:
+        """
+        Indexes a message of a room's log, the server's notices aren't
+        and a message older than the newest one of the log is already there
+        """
+
+        tokens = tokenize(message.text)
+        if not tokens or plain(message.sender) == "SERVER":
+            return
+
+        data = " ".join(tokens).encode()
+        with self.lock:
+            postings = self.postings.get(key)
+            if postings is not None:
+                if message.id <= self.last_ids[key]:
+                    return
+                for token in tokens:
+                    postings.setdefault(token, array("q")).append(message.id)
+                self.last_ids[key] = message.id
+
+            self._write(key, pack(HEADER, message.id, len(data)) + data)
+
+    def forget(self, key: str, ids: List[int]) -> None:
+        """
+        Drops the messages (like the expired ones) of a room's log from the index
+        """
+
+        with self.lock:
+            if key not in self.keys:
+                return
+
+            self._write(key, b"".join(pack(HEADER, id, 0) for id in ids))
+            postings = self.postings.get(key)
+            if postings is None:
+                return
+
+            gone = set(ids)
+            for token in list(postings):
+                kept = array("q", (doc for doc in postings[token] if doc not in gone))
+                if kept:
+                    postings[token] = kept
+                else:
+                    del postings[token]
+
+    def _matches(self, key: str, tokens: Set[str]) -> Iterator[Tuple[int, str]]:
+        """
+        The ids of a log's messages with all the tokens, newest first
+        """
+
+        with self.lock:
+            postings = self._load(key)
+            lists = sorted(
+                (postings.get(token, array("q")) for token in tokens), key=len
+            )
+
+        shortest, rest = lists[0], lists[1:]
+        # NOTE: the arrays are replaced on a change, never changed in place
+        # but for the appends, so the ones taken are safe to go through
+        for doc in reversed(shortest):
+            if all(_contains(other, doc) for other in rest):
+                yield doc, key
+
+    def search(
+        self,
+        text: str,
+        keys: List[str],
+        read: Read,
+        page: int = 1,
+        page_size: int = PAGE_SIZE,
+    ) -> Tuple[List[Message], bool]:
+        """
+        Returns the newest first hits of the page in the logs of `keys`
+        and if there are more pages after it, up to `MAX_PAGES` pages
+        """
+
+        page = min(max(page, 1), MAX_PAGES)
+        tokens = tokenize(text)
+        if not tokens:
+            return [], False
+
+        wanted = page * page_size + 1
+        hits: List[Message] = []
+        for doc, key in merge(
+            *(self._matches(key, tokens) for key in keys), reverse=True
+        ):
+            message = read(key, doc)
+            if message is not None:
+                hits.append(message)
+                if len(hits) == wanted:
+                    break
+
+        start = (page - 1) * page_size
+        return hits[start : start + page_size], len(hits) == wanted
+
+    def close(self) -> None:
+        with self.lock:
+            for file in self.files.values():
+                file.close()
+            self.files.clear()
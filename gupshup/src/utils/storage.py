@@ -0,0 +1,670 @@
+import os
+import shutil
+import sqlite3
+from abc import ABC, abstractmethod
+from pickle import dump, dumps, load, loads
+from threading import RLock, Thread
+from time import sleep
+from typing import (
+    Callable,
+    Dict,
+    FrozenSet,
+    Iterator,
+    List,
+    Optional,
+    Set,
+    Tuple,
+    Union,
+)
+
+from .history import PAGE_SIZE, History
+from .house import House
+from .message import Message
+from .retention import Policy
+from .search import SearchIndex
+from .user import User
+
+Houses = Dict[str, House]
+Users = Dict[str, User]
+Retention = Dict[str, Dict[str, Policy]]
+
+# the layout of the data file of `FileStorage`, the older ones had the messages
+# in it too and then didn't have the retention policies of the houses
+FILE_VERSION = 3
+
+# the messages appended are written in a single transaction every so often
+# (or once there are this many), the reads write the waiting ones first
+FLUSH_INTERVAL = 0.05
+FLUSH_BATCH = 512
+
+# messages read at a time when going through a log
+READ_CHUNK = 256
+
+# the parts of a house kept in the tables of their own, not in its pickled data
+HOUSE_TABLES = ("members", "member_rank", "banned_users")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS houses (
+    name TEXT PRIMARY KEY,
+    king TEXT NOT NULL,
+    type TEXT NOT NULL,
+    version INTEGER NOT NULL,
+    data BLOB NOT NULL
+);
+CREATE TABLE IF NOT EXISTS members (
+    house TEXT NOT NULL,
+    user TEXT NOT NULL,
+    rank TEXT NOT NULL,
+    PRIMARY KEY (house, user)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS members_by_user ON members (user);
+CREATE TABLE IF NOT EXISTS ranks (
+    house TEXT NOT NULL,
+    name TEXT NOT NULL,
+    color TEXT NOT NULL,
+    icon TEXT NOT NULL,
+    power REAL NOT NULL,
+    PRIMARY KEY (house, name)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS bans (
+    house TEXT NOT NULL,
+    user TEXT NOT NULL,
+    PRIMARY KEY (house, user)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS bans_by_user ON bans (user);
+CREATE TABLE IF NOT EXISTS users (
+    name TEXT PRIMARY KEY,
+    data BLOB NOT NULL
+);
+CREATE TABLE IF NOT EXISTS retention (
+    house TEXT NOT NULL,
+    room TEXT NOT NULL,
+    policy BLOB NOT NULL,
+    PRIMARY KEY (house, room)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS rooms (
+    store TEXT NOT NULL,
+    key TEXT NOT NULL,
+    PRIMARY KEY (store, key)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS messages (
+    store TEXT NOT NULL,
+    key TEXT NOT NULL,
+    id INTEGER NOT NULL,
+    time REAL NOT NULL,
+    size INTEGER NOT NULL,
+    data BLOB NOT NULL,
+    PRIMARY KEY (store, key, id)
+);
+-- the whole search index used to be kept in it, it's in a folder of its own now
+DROP TABLE IF EXISTS blobs;
+"""
+
+# NOTE: the statements are prepared once and then reused by the connection
+PUT_HOUSE = "INSERT OR REPLACE INTO houses VALUES (?, ?, ?, ?, ?)"
+PUT_MEMBER = "INSERT OR REPLACE INTO members VALUES (?, ?, ?)"
+DEL_MEMBER = "DELETE FROM members WHERE house = ? AND user = ?"
+DEL_MEMBERS = "DELETE FROM members WHERE house = ?"
+RENAME_RANK = "UPDATE members SET rank = ? WHERE house = ? AND rank = ?"
+DEL_RANKS = "DELETE FROM ranks WHERE house = ?"
+PUT_RANK = "INSERT INTO ranks VALUES (?, ?, ?, ?, ?)"
+DEL_BANS = "DELETE FROM bans WHERE house = ?"
+PUT_BAN = "INSERT OR IGNORE INTO bans VALUES (?, ?)"
+DEL_BAN = "DELETE FROM bans WHERE house = ? AND user = ?"
+PUT_USER = "INSERT OR REPLACE INTO users VALUES (?, ?)"
+DEL_RETENTION = "DELETE FROM retention WHERE house = ?"
+PUT_RETENTION = "INSERT INTO retention VALUES (?, ?, ?)"
+PUT_ROOM = "INSERT OR IGNORE INTO rooms VALUES (?, ?)"
+PUT_MESSAGE = "INSERT OR REPLACE INTO messages VALUES (?, ?, ?, ?, ?, ?)"
+PAGE = (
+    "SELECT data FROM messages WHERE store = ? AND key = ? AND id < ? "
+    + "ORDER BY id DESC LIMIT ?"
+)
+AFTER = (
+    "SELECT id, data FROM messages WHERE store = ? AND key = ? AND id > ? "
+    + "ORDER BY id LIMIT ?"
+)
+LAST_ID = "SELECT MAX(id) FROM messages WHERE store = ?"
+COUNT = "SELECT COUNT(*) FROM messages WHERE store = ? AND key = ?"
+# the newest message of the ones a policy doesn't keep, anything older goes too
+CUT_BY_COUNT = (
+    "SELECT id FROM messages WHERE store = ? AND key = ? "
+    + "ORDER BY id DESC LIMIT 1 OFFSET ?"
+)
+CUT_BY_AGE = "SELECT MAX(id) FROM messages WHERE store = ? AND key = ? AND time < ?"
+CUT_BY_BYTES = (
+    "SELECT id FROM (SELECT id, SUM(size) OVER (ORDER BY id DESC) AS total "
+    + "FROM messages WHERE store = ? AND key = ?) WHERE total > ? "
+    + "ORDER BY id DESC LIMIT 1"
+)
+EXPIRED = "SELECT id, data FROM messages WHERE store = ? AND key = ? AND id <= ?"
+DEL_MESSAGE = "DELETE FROM messages WHERE store = ? AND key = ? AND id = ?"
+GET_MESSAGE = "SELECT data FROM messages WHERE store = ? AND key = ? AND id = ?"
+
+
+class Storage(ABC):
+    """
+    The interface of where the server keeps its state
+
+    `history` and `inboxes` are the message stores (with the interface of
+    `History`), the houses and the users are read once when starting and then
+    written through as they change, by the backends that can do it cheaply
+
+    the search index of the room logs is kept in `search_folder` (see `SearchIndex`)
+    """
+
+    history: History
+    inboxes: History
+    search_folder: str
+    # if the houses and users are written as they change
+    write_through = False
+
+    @abstractmethod
+    def load(self) -> Tuple[Houses, Users, Retention]:
+        """
+        Reads the houses, the users and the retention policies, when starting
+        """
+
+    @abstractmethod
+    def save(self, houses: Houses, users: Users, retention: Retention) -> None:
+        """
+        Writes the whole state, when closing
+        """
+
+    def load_search(self) -> SearchIndex:
+        """
+        The search index, made from the room logs the first time
+        (like when moving over from the whole index the older versions kept)
+        """
+
+        if not os.path.exists(self.search_folder):
+            building = f"{self.search_folder}.tmp"
+            shutil.rmtree(building, ignore_errors=True)
+            index = SearchIndex(building)
+            for key in self.history.keys():
+                for message in self.history.get(key).after(0):
+                    index.add(key, message)
+            index.close()
+            os.replace(building, self.search_folder)
+
+        return SearchIndex(self.search_folder)
+
+    def put_house(self, house: House) -> None:
+        pass
+
+    def put_user(self, user: User) -> None:
+        pass
+
+    def put_retention(self, house: str, policies: Dict[str, Policy]) -> None:
+        pass
+
+    @abstractmethod
+    def is_empty(self) -> bool:
+        """
+        If it has no houses and no users yet
+        """
+
+    def import_from(self, other: "Storage") -> None:
+        """
+        Copies the state and the messages of another backend
+        """
+
+        # NOTE: the search index is made from the logs copied when first loaded
+        self.save(*other.load())
+        for target, source in (
+            (self.history, other.history),
+            (self.inboxes, other.inboxes),
+        ):
+            for key in source.keys():
+                for message in source.get(key).after(0):
+                    target.append(key, message)
+
+    def close(self) -> None:
+        self.history.close()
+        self.inboxes.close()
+
+
+class FileStorage(Storage):
+    """
+    The state pickled in a file, written whole when the server closes,
+    and the messages in a folder of logs (see `History`)
+    """
+
+    def __init__(
+        self,
+        data_file: str,
+        search_folder: str,
+        rooms_folder: str,
+        inboxes_folder: str,
+    ) -> None:
+        self.data_file = data_file
+        self.search_folder = search_folder
+        self.history = History(rooms_folder)
+        self.inboxes = History(inboxes_folder)
+
+    def load(self) -> Tuple[Houses, Users, Retention]:
+        try:
+            with open(self.data_file, "rb") as f:
+                houses, user_messages, users, *rest = load(f)
+        except FileNotFoundError:
+            return dict(), dict(), dict()
+
+        retention = (
+            rest[1]
+            if len(rest) > 1
+            else {name: dict(house.retention) for name, house in houses.items()}
+        )
+
+        if not rest:
+            # data from before the users tracked their houses
+            for house in houses.values():
+                for member in house.members:
+                    if member in users:
+                        users[member].join(house.name, dict())
+
+        if user_messages is not None:
+            # the inboxes used to be saved along with the rest (and the search
+            # index, made again), moved out once and saved so they're not moved again
+            for user, messages in user_messages.items():
+                for message in messages:
+                    self.inboxes.append(user, message)
+
+            self.save(houses, users, retention)
+
+        return houses, users, retention
+
+    def save(self, houses: Houses, users: Users, retention: Retention) -> None:
+        with open(f"{self.data_file}.tmp", "wb") as f:
+            dump((houses, None, users, FILE_VERSION, retention), f)
+        os.replace(f"{self.data_file}.tmp", self.data_file)
+
+    def is_empty(self) -> bool:
+        return not os.path.exists(self.data_file)
+
+
+class SqliteLog:
+    """
+    The messages of a room in the `messages` table, with the interface of `RoomLog`
+    """
+
+    def __init__(self, messages: "SqliteMessages", key: str) -> None:
+        self.messages = messages
+        self.storage = messages.storage
+        self.args = (messages.store, key)
+
+    def __len__(self) -> int:
+        with self.storage.lock:
+            self.storage.flush()
+            return self.storage.db.execute(COUNT, self.args).fetchone()[0]
+
+    def get(self, id: int) -> Optional[Message]:
+        with self.storage.lock:
+            self.storage.flush()
+            row = self.storage.db.execute(GET_MESSAGE, (*self.args, id)).fetchone()
+
+        return loads(row[0]) if row else None
+
+    def page(
+        self, before: int = -1, limit: int = PAGE_SIZE
+    ) -> Tuple[List[Message], bool]:
+        before = before if before != -1 else 1 << 62
+        with self.storage.lock:
+            self.storage.flush()
+            rows = self.storage.db.execute(
+                PAGE, (*self.args, before, limit + 1)
+            ).fetchall()
+
+        messages = [loads(data) for data, in rows[:limit]]
+        return messages[::-1], len(rows) > limit
+
+    def after(self, id: int) -> Iterator[Message]:
+        while True:
+            with self.storage.lock:
+                self.storage.flush()
+                rows = self.storage.db.execute(
+                    AFTER, (*self.args, id, READ_CHUNK)
+                ).fetchall()
+
+            for id, data in rows:
+                yield loads(data)
+
+            if len(rows) < READ_CHUNK:
+                return
+
+    def _cutoff(self, policy: Policy, now: float) -> int:
+        """
+        The id of the newest message the policy doesn't keep, 0 if it keeps them all
+        """
+
+        queries = []
+        if "count" in policy:
+            queries.append((CUT_BY_COUNT, policy["count"]))
+        if "age" in policy:
+            queries.append((CUT_BY_AGE, now - policy["age"]))
+        if "bytes" in policy:
+            queries.append((CUT_BY_BYTES, policy["bytes"]))
+
+        cut = 0
+        for query, limit in queries:
+            row = self.storage.db.execute(query, (*self.args, limit)).fetchone()
+            if row and row[0]:
+                cut = max(cut, row[0])
+
+        return cut
+
+    def expire(
+        self,
+        policy: Policy,
+        now: float,
+        keep: Optional[Callable[[Message], bool]] = None,
+    ) -> List[int]:
+        """
+        Drops the messages outside the policy (but the ones to `keep`)
+        and returns their ids
+        """
+
+        with self.storage.lock:
+            self.storage.flush()
+            cut = self._cutoff(policy, now)
+            if not cut:
+                return []
+
+            rows = self.storage.db.execute(EXPIRED, (*self.args, cut)).fetchall()
+            gone = [id for id, data in rows if keep is None or not keep(loads(data))]
+            with self.storage.db:
+                self.storage.db.execute("BEGIN")
+                self.storage.db.executemany(
+                    DEL_MESSAGE, ((*self.args, id) for id in gone)
+                )
+
+        return gone
+
+    def close(self) -> None:
+        pass
+
+
+class SqliteMessages:
+    """
+    A message store in the `messages` table, with the interface of `History`
+    """
+
+    def __init__(self, storage: "SqliteStorage", store: str) -> None:
+        self.storage = storage
+        self.store = store
+
+        # the house (or a user's `HOME`) -> the keys of its rooms
+        self.houses: Dict[str, Set[str]] = dict()
+        for (key,) in storage.db.execute(
+            "SELECT key FROM rooms WHERE store = ?", (store,)
+        ):
+            self._add_key(key)
+
+    def _add_key(self, key: str) -> None:
+        self.houses.setdefault(key.rpartition("/")[0], set()).add(key)
+
+    def append(self, key: str, message: Message) -> None:
+        data = dumps(message)
+        with self.storage.lock:
+            if key not in self.houses.get(key.rpartition("/")[0], ()):
+                self._add_key(key)
+                self.storage.pending_rooms.append((self.store, key))
+
+            self.storage.pending.append(
+                (self.store, key, message.id, message.time, len(data), data)
+            )
+            if len(self.storage.pending) >= FLUSH_BATCH:
+                self.storage.flush()
+
+    def get(self, key: str) -> Optional[SqliteLog]:
+        with self.storage.lock:
+            if key not in self.houses.get(key.rpartition("/")[0], ()):
+                return None
+
+        return SqliteLog(self, key)
+
+    def rooms(self, house: str) -> List[str]:
+        with self.storage.lock:
+            return list(self.houses.get(house, ()))
+
+    def keys(self) -> List[str]:
+        with self.storage.lock:
+            return [key for keys in self.houses.values() for key in keys]
+
+    def opened(self) -> List[Tuple[str, SqliteLog]]:
+        """
+        Every log, they are all equally cheap to go through
+        """
+
+        return [(key, SqliteLog(self, key)) for key in self.keys()]
+
+    def last_id(self) -> int:
+        with self.storage.lock:
+            self.storage.flush()
+            return self.storage.db.execute(LAST_ID, (self.store,)).fetchone()[0] or 0
+
+    def close(self) -> None:
+        self.storage.close_db()
+
+
+class SqliteStorage(Storage):
+    """
+    The state in an SQLite database, in WAL mode so the reads don't wait for
+    the writes, with a table for every part of it (indexed for the lookups of
+    a user's houses and bans) along with a copy of every house and user
+
+    The houses and the users are written as they change, the messages
+    appended are written in batches, a transaction for a batch
+
+    only the rows of the members that changed are written, going through
+    the house's changes (see `House.deltas`) since the version written last
+    """
+
+    write_through = True
+
+    def __init__(self, path: str, flush_interval: float = FLUSH_INTERVAL) -> None:
+        self.path = path
+        self.search_folder = f"{path}.search"
+        self.flush_interval = flush_interval
+        # NOTE: the transactions are begun by hand, see `flush`
+        self.db = sqlite3.connect(
+            path, check_same_thread=False, isolation_level=None, cached_statements=256
+        )
+        self.db.execute("PRAGMA journal_mode = WAL")
+        self.db.execute("PRAGMA synchronous = NORMAL")
+        self.db.executescript(SCHEMA)
+        self.lock = RLock()
+        self.closed = False
+
+        # house -> the version and the bans it was written with last
+        self.written: Dict[str, Tuple[int, FrozenSet[str]]] = dict()
+
+        # the messages (and the new rooms) waiting to be written
+        self.pending: List[tuple] = []
+        self.pending_rooms: List[Tuple[str, str]] = []
+
+        self.history = SqliteMessages(self, "rooms")
+        self.inboxes = SqliteMessages(self, "inboxes")
+
+        Thread(target=self._flush_loop, daemon=True).start()
+
+    def _flush_loop(self) -> None:
+        while not self.closed:
+            sleep(self.flush_interval)
+            with self.lock:
+                if not self.closed:
+                    self.flush()
+
+    def flush(self) -> None:
+        """
+        Writes the messages waiting, in a single transaction
+        """
+
+        with self.lock:
+            if not self.pending:
+                return
+
+            with self.db:
+                self.db.execute("BEGIN")
+                self.db.executemany(PUT_ROOM, self.pending_rooms)
+                self.db.executemany(PUT_MESSAGE, self.pending)
+
+            self.pending.clear()
+            self.pending_rooms.clear()
+
+    def load(self) -> Tuple[Houses, Users, Retention]:
+        with self.lock:
+            member_ranks: Dict[str, Dict[str, str]] = dict()
+            for house, user, rank in self.db.execute("SELECT * FROM members"):
+                member_ranks.setdefault(house, dict())[user] = rank
+            bans: Dict[str, Set[str]] = dict()
+            for house, user in self.db.execute("SELECT * FROM bans"):
+                bans.setdefault(house, set()).add(user)
+
+            houses = dict()
+            for name, data in self.db.execute("SELECT name, data FROM houses"):
+                state = loads(data)
+                house = houses[name] = self._load_house(
+                    state, member_ranks.get(name, {}), bans.get(name, set())
+                )
+                # the rows of the ones pickled whole are written whole the first time
+                if not isinstance(state, House):
+                    self.written[name] = (house.version, house.banned_users)
+
+            users = {
+                name: loads(data)
+                for name, data in self.db.execute("SELECT name, data FROM users")
+            }
+            retention: Retention = dict()
+            for house, room, policy in self.db.execute("SELECT * FROM retention"):
+                retention.setdefault(house, dict())[room] = loads(policy)
+
+        return houses, users, retention
+
+    def save(self, houses: Houses, users: Users, retention: Retention) -> None:
+        with self.lock, self.db:
+            self.db.execute("BEGIN")
+            for house in houses.values():
+                self._put_house(house)
+            for user in users.values():
+                self.db.execute(PUT_USER, (user.username, dumps(user)))
+            for house, policies in retention.items():
+                self._put_retention(house, policies)
+
+    @staticmethod
+    def _load_house(
+        state: Union[House, dict], member_rank: Dict[str, str], bans: Set[str]
+    ) -> House:
+        # NOTE: the older databases had the whole house pickled
+        if isinstance(state, House):
+            return state
+
+        house = House.__new__(House)
+        house.__setstate__(
+            {
+                **state,
+                "members": set(member_rank),
+                "member_rank": member_rank,
+                "banned_users": frozenset(bans),
+            }
+        )
+        return house
+
+    def _put_house(self, house: House) -> None:
+        state = house.__getstate__()
+        for slot in HOUSE_TABLES:
+            del state[slot]
+        self.db.execute(
+            PUT_HOUSE, (house.name, house.king, house.type, house.version, dumps(state))
+        )
+
+        version, bans = self.written.get(house.name, (-1, None))
+        changes = [delta for delta in house.deltas if delta.data["version"] > version]
+        # NOTE: every change bumps the version, so they are all kept if they add up
+        if version >= 0 and version + len(changes) == house.version:
+            self._put_changes(house.name, changes)
+        else:
+            # the changes since the last write aren't all kept, written whole
+            self.db.execute(DEL_MEMBERS, (house.name,))
+            self.db.executemany(
+                PUT_MEMBER,
+                ((house.name, user, rank) for user, rank in house.member_rank.items()),
+            )
+            bans = None
+
+        # the bans are replaced on a change, the same set didn't change
+        if bans is None:
+            self.db.execute(DEL_BANS, (house.name,))
+            self.db.executemany(
+                PUT_BAN, ((house.name, user) for user in house.banned_users)
+            )
+        elif bans is not house.banned_users:
+            self.db.executemany(
+                PUT_BAN, ((house.name, user) for user in house.banned_users - bans)
+            )
+            self.db.executemany(
+                DEL_BAN, ((house.name, user) for user in bans - house.banned_users)
+            )
+
+        self.db.execute(DEL_RANKS, (house.name,))
+        self.db.executemany(
+            PUT_RANK,
+            (
+                (house.name, rank.name, rank.color, rank.icon, rank.power)
+                for rank in house.ranks.values()
+            ),
+        )
+        self.written[house.name] = (house.version, house.banned_users)
+
+    def _put_changes(self, house: str, changes: List[Message]) -> None:
+        """
+        Writes the members changed by the house's changes, in order
+        """
+
+        for delta in changes:
+            data = delta.data
+            match delta.action:
+                case "add_user_rank":
+                    self.db.execute(PUT_MEMBER, (house, data["user"], data["rank"]))
+                case "del_user_rank":
+                    self.db.execute(DEL_MEMBER, (house, data["user"]))
+                case "change_rank_name":
+                    self.db.execute(RENAME_RANK, (data["name"], house, data["rank"]))
+
+    def put_house(self, house: House) -> None:
+        with self.lock, self.db:
+            self.db.execute("BEGIN")
+            self._put_house(house)
+
+    def put_user(self, user: User) -> None:
+        with self.lock, self.db:
+            self.db.execute(PUT_USER, (user.username, dumps(user)))
+
+    def _put_retention(self, house: str, policies: Dict[str, Policy]) -> None:
+        self.db.execute(DEL_RETENTION, (house,))
+        self.db.executemany(
+            PUT_RETENTION,
+            ((house, room, dumps(policy)) for room, policy in policies.items()),
+        )
+
+    def put_retention(self, house: str, policies: Dict[str, Policy]) -> None:
+        with self.lock, self.db:
+            self.db.execute("BEGIN")
+            self._put_retention(house, policies)
+
+    def is_empty(self) -> bool:
+        with self.lock:
+            return not self.db.execute(
+                "SELECT EXISTS (SELECT 1 FROM houses UNION ALL SELECT 1 FROM users)"
+            ).fetchone()[0]
+
+    def close_db(self) -> None:
+        with self.lock:
+            if self.closed:
+                return
+
+            self.flush()
+            self.closed = True
+            self.db.close()
+
+    def close(self) -> None:
+        self.close_db()
@@ -1,27 +1,94 @@
-from .house import House
+from typing import Dict, FrozenSet, Iterable, Set, Tuple
 
 
 class User:
     """
     A user class to make interaction with user data a bit less messy
+
+    There is a record for every user that ever logged in, so it only has
+    what the server needs: the houses with their cursors and the users it
+    blocked or silenced in the direct chats
     """
 
+    __slots__ = ("username", "houses", "cursors", "banned", "silent")
+
     def __init__(self, username: str):
         self.username = username
-        self.home = House("HOME", self.username)
-        self.houses = set()
+        # NOTE: the houses and cursors are read by other threads (like the
+        # catch-up of the user) while the broadcasting one changes them so
+        # they are replaced instead of changed in place, see `join` and `leave`
+        self.houses: FrozenSet[str] = frozenset()
+        # room key -> the id from which the room's log is read for the user
+        # (set on joining a house so the backlog is not sent on the next sync)
+        self.cursors: Dict[str, int] = dict()
+        # replaced too, the empty ones are all the same object
+        self.banned: FrozenSet[str] = frozenset()
+        self.silent: FrozenSet[str] = frozenset()
+
+    def __getstate__(self) -> dict:
+        return {slot: getattr(self, slot) for slot in self.__slots__}
+
+    def __setstate__(self, state: dict) -> None:
+        # NOTE: the older records had a whole `House` for the direct chats
+        home = state.pop("home", None)
+        self.username = state["username"]
+        self.houses = frozenset(state.get("houses", ()))
+        self.cursors = state.get("cursors", dict())
+        self.banned = frozenset(state.get("banned", home.banned_users if home else ()))
+        self.silent = frozenset(state.get("silent", home.muted_users if home else ()))
 
     def has_banned(self, user):
-        return user in self.home.banned_users
+        return user in self.banned
 
     def has_joined(self, house: str):
         return house in self.houses
 
+    def join(self, house: str, cursors: Dict[str, int]) -> None:
+        # the cursors go first, a reader seeing the house sees its cursors too
+        self.cursors = {**self.cursors, **cursors}
+        self.houses = self.houses | {house}
+
+    def leave(self, house: str) -> None:
+        # NOTE: the cursors are kept, joining again replaces them
+        self.houses = self.houses - {house}
+
     def has_silent(self, user):
-        return user in self.home.muted_users
+        return user in self.silent
 
     def ban_user(self, user: str):
-        self.home.ban_user(user)
+        self.banned = self.banned | {user}
 
     def unban_user(self, user: str):
-        self.home.banned_users.remove(user)
+        self.banned = self.banned - {user}
+
+
+class BlockIndex:
+    """
+    Who blocked whom over all the users, so checking a direct
+    message both ways is a lookup for each way
+    """
+
+    def __init__(self, users: Iterable[User] = ()) -> None:
+        # (blocker, blocked)
+        self.pairs: Set[Tuple[str, str]] = set()
+        for user in users:
+            self.replace(user.username, frozenset(), user.banned)
+
+    def has_blocked(self, blocker: str, blocked: str) -> bool:
+        return (blocker, blocked) in self.pairs
+
+    def block(self, blocker: str, blocked: str) -> None:
+        self.pairs.add((blocker, blocked))
+
+    def unblock(self, blocker: str, blocked: str) -> None:
+        self.pairs.discard((blocker, blocked))
+
+    def replace(self, blocker: str, old: FrozenSet[str], new: FrozenSet[str]) -> None:
+        """
+        Updates the users blocked by a user whose record was replaced
+        """
+
+        for blocked in old - new:
+            self.unblock(blocker, blocked)
+        for blocked in new - old:
+            self.block(blocker, blocked)
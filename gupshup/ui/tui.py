@@ -2,6 +2,7 @@ import os
 import asyncio
 from collections import defaultdict
 from queue import Queue
+from time import monotonic
 
 from rich.align import Align
 from rich.text import Text
@@ -9,12 +10,15 @@ from rich.text import Text
 from textual import events
 from textual.app import App
 from textual.layouts.dock import DockLayout
+from textual.views import DockView
 from textual.widgets import ScrollView, TreeClick, Static
 from textual_extras.widgets import TextInput
 
 from .widgets import (
     Headbar,
     ChatScreen,
+    ChatScroll,
+    ScrolledToTop,
     HouseTree,
     MemberList,
     Banner,
@@ -22,6 +26,12 @@ from .widgets import (
 from ..src import Client
 from ..src.utils import Message, HouseData, HELP_TEXT, notify
 
+# seconds between the typing notices sent while typing
+TYPING_INTERVAL = 3
+
+# seconds without a key press after which the user is shown away
+AWAY_AFTER = 300
+
 
 def percent(percent, total):
     return int(percent * total / 100)
@@ -36,23 +46,34 @@ class Tui(App):
         self,
         user: str,
         quiet: bool = False,
+        port: int = 5500,
+        heartbeat_timeout: float = 30,
     ) -> None:
         super().__init__()
         self.user = user
         self.quiet = quiet
+        self.port = port
+        self.heartbeat_timeout = heartbeat_timeout
 
     @classmethod
     def run(
         cls,
         user: str,
         quiet: bool,
+        port: int = 5500,
+        heartbeat_timeout: float = 30,
     ) -> None:
         """
         Run the app.
         """
 
         async def run_app() -> None:
-            app = cls(user=user, quiet=quiet)
+            app = cls(
+                user=user,
+                quiet=quiet,
+                port=port,
+                heartbeat_timeout=heartbeat_timeout,
+            )
             await app.process_messages()
 
         asyncio.run(run_app())
@@ -61,7 +82,7 @@ class Tui(App):
 
         # client related
         self.queue = Queue()
-        self.client = Client(self.user, self.queue)
+        self.client = Client(self.user, self.queue, self.port, self.heartbeat_timeout)
 
         # sets up default screen
         self.current_house = "HOME"
@@ -69,6 +90,11 @@ class Tui(App):
         self.current_screen = f"{self.current_house}/{self.current_room}"
         self.help_menu_loaded = False
 
+        # presence
+        self.last_activity = monotonic()
+        self.last_typing = 0.0
+        self.connected = False
+
         self.member_lists: dict[str, MemberList] = defaultdict(MemberList)
         self.member_scrolls: dict[str, ScrollView] = defaultdict(ScrollView)
 
@@ -153,6 +179,10 @@ class Tui(App):
         await self.view.dock(self.help_scroll)
 
     async def on_key(self, event: events.Key):
+        self.last_activity = monotonic()
+        if self.client.status == "away":
+            self.client.set_status("online")
+
         if event.key == "ctrl+p":
             if self.help_menu_loaded:
                 await self.refresh_screen()
@@ -176,7 +206,41 @@ class Tui(App):
             return
 
         if event.key == "enter":
-            await self.action_send_message()
+            if self.focused is self.member_filter:
+                await self.action_filter_members()
+            else:
+                await self.action_send_message()
+        elif self.focused is self.input_box:
+            self.notify_typing()
+
+    def notify_typing(self) -> None:
+        """
+        Lets the room know the user is typing, at most once every few seconds
+        """
+
+        # NOTE: the commands of `HOME/general` are for the server only
+        if self.current_screen == "HOME/general":
+            return
+
+        now = monotonic()
+        if now - self.last_typing >= TYPING_INTERVAL:
+            self.last_typing = now
+            self.client.typing(self.current_house, self.current_room)
+
+    async def tick_presence(self) -> None:
+        """
+        Clears the stale typing indicators and shows the user away when idle
+        """
+
+        self.house_tree.expire_typing()
+        for members in self.member_lists.values():
+            members.expire_typing()
+
+        if (
+            self.client.status == "online"
+            and monotonic() - self.last_activity > AWAY_AFTER
+        ):
+            self.client.set_status("away")
 
     async def action_send_message(self):
         """
@@ -187,6 +251,22 @@ class Tui(App):
         if not value:
             return
 
+        # the files are sent and fetched by the app, the server only sees their chunks
+        command, _, param = value.partition(" ")
+        if command in ("/upload", "/download") and param.strip():
+            if command == "/upload":
+                self.client.upload(
+                    os.path.expanduser(param.strip()),
+                    self.current_house,
+                    self.current_room,
+                )
+            else:
+                self.client.download(
+                    param.strip(), self.current_house, self.current_room
+                )
+            self.input_box.clear()
+            return
+
         self.client.send(
             Message(
                 sender=self.user,
@@ -228,8 +308,80 @@ class Tui(App):
             self.member_lists[house.name].change_data_parent(name, "color", rank.color)
             self.member_lists[house.name].change_data_parent(name, "icon", rank.icon)
 
-        for name, rank in house.member_rank.items():
-            await self.member_lists[house.name].add_user_to_rank(rank, name)
+        # the members are not a part of the snapshot, they are fetched
+        # a page at a time when a rank is expanded
+        for name, count in house.rank_counts.items():
+            self.member_lists[house.name].set_count(name, count)
+
+    async def perform_sync_house(self, message: Message) -> None:
+        """
+        Replaces a house with a fresh snapshot of it
+        """
+
+        house: HouseData = message.data["house"]
+        self.house_tree.del_house(house.name)
+        self.member_lists.pop(house.name, None)
+        self.member_scrolls.pop(house.name, None)
+        await self.perform_add_house(message)
+
+        if self.current_house == house.name:
+            await self.refresh_screen()
+
+    async def perform_members(self, message: Message) -> None:
+        """
+        Adds a page of a rank's members to the member list
+        """
+
+        members = self.member_lists[message.house]
+        if message.data["prefix"] != members.prefix:
+            return  # asked for before the filter was changed
+
+        await members.add_page(
+            message.data["rank"],
+            message.data["members"],
+            message.data["has_more"],
+            message.data["count"],
+        )
+
+        if message.data["members"]:
+            self.client.fetch_presence(message.house, message.data["members"])
+
+    async def perform_presence(self, message: Message) -> None:
+        """
+        Shows the changes to the status of the users and who is typing
+        """
+
+        tree = (
+            self.house_tree
+            if message.house == "HOME"
+            else self.member_lists[message.house]
+        )
+        tree.set_status(message.data["status"])
+        tree.set_typing(
+            user
+            for users in message.data["typing"].values()
+            for user in users
+            if user != self.user
+        )
+
+    async def fetch_members(self, rank: str) -> None:
+        """
+        Asks for the next page of a rank of the current house's member list
+        """
+
+        members = self.member_lists[self.current_house]
+        self.client.fetch_members(
+            self.current_house, rank, members.next_after(rank), members.prefix
+        )
+
+    async def action_filter_members(self) -> None:
+        """
+        Shows only the members starting with the text in the filter box
+        """
+
+        members = self.member_lists[self.current_house]
+        for rank in members.set_filter(self.member_filter.value.strip()):
+            await self.fetch_members(rank)
 
     async def perform_connection_disable(self, *_) -> None:
         self.headbar.status = "ﮡ Can't connect"
@@ -237,6 +389,14 @@ class Tui(App):
     async def perform_connection_enable(self, *_) -> None:
         self.headbar.status = " Online"
 
+    async def perform_caught_up(self, _: Message) -> None:
+        """
+        All the messages missed while offline are in
+        """
+
+        await self.chat_scroll[self.current_screen].key_end()
+        self.chat_screen[self.current_screen].refresh(layout=True)
+
     async def perform_push_text(self, message: Message, local=False) -> None:
         """
         Performs adding all the text messages to their respective locations
@@ -258,8 +418,21 @@ class Tui(App):
 
                 self.house_tree.increase_pending(message.house, message.room)
 
+    async def perform_history(self, message: Message) -> None:
+        """
+        Shows a page of older messages fetched from the server
+        """
+
+        screen = self.chat_screen[f"{message.house}/{message.room}"]
+        await screen.prepend(message.data["messages"])
+        screen.has_more = message.data["has_more"]
+        screen.fetching = False
+
     async def perform_add_room(self, message: Message) -> None:
         await self.house_tree.add_room(message.house, message.data["room"])
+        # NOTE: the rooms of the offline data are added before connecting
+        if message.house == "HOME" and self.connected:
+            self.client.fetch_presence("HOME", [message.data["room"]])
 
     async def perform_clear_chat(self, message: Message) -> None:
         screen = f"{message.house}/{message.room}"
@@ -335,6 +508,24 @@ class Tui(App):
             message.data["icon"],
         )
 
+    async def perform_change_retention(self, message: Message) -> None:
+        """
+        Shows the house's chats as pruned by the client to the new policy
+        """
+
+        # NOTE: the offline data is pruned when read, before it's shown
+        if not self.connected:
+            return
+
+        for name, screen in self.chat_screen.items():
+            if name.startswith(f"{message.house}/"):
+                await screen.clear_chat()
+                screen.oldest, screen.has_more = -1, True
+
+        for chat in list(self.client.chats):
+            if chat.action == "push_text" and chat.house == message.house:
+                await self.perform_push_text(chat, local=True)
+
     async def perform_toggle_silent(self, message: Message) -> None:
         self.house_tree.toggle_silent(message.house, message.room)
 
@@ -367,6 +558,9 @@ class Tui(App):
         self.input_box = TextInput(
             placeholder=Text("Say something here...", style="dim white")
         )
+        self.member_filter = TextInput(
+            placeholder=Text("Filter members...", style="dim white")
+        )
 
         self.banner = Banner()
         self.help_scroll = ScrollView(Align.center(HELP_TEXT))
@@ -402,7 +596,10 @@ class Tui(App):
                 await eval(f"self.perform_{message.action}(message)")
 
         self.client.start_connection()
+        self.connected = True
+        self.client.fetch_presence("HOME", self.house_tree.contacts())
         self.set_interval(0.1, self.server_listen)
+        self.set_interval(1, self.tick_presence)
 
         self.title = "Gupshup (Press ctrl+p for help)"
         self.refresh()
@@ -436,7 +633,7 @@ class Tui(App):
         x, y = os.get_terminal_size()
 
         if self.current_screen not in self.chat_scroll:
-            self.chat_scroll[self.current_screen] = ScrollView(
+            self.chat_scroll[self.current_screen] = ChatScroll(
                 self.chat_screen[self.current_screen],
                 gutter=(0, 1),
             )
@@ -461,8 +658,11 @@ class Tui(App):
         # RIGHT WIDGETS
         if self.current_house != "HOME":
             # There is *NO* member list for `HOME`
+            member_pane = DockView()
+            await member_pane.dock(self.member_filter, size=3)
+            await member_pane.dock(self.member_scrolls[self.current_house])
             await self.view.dock(
-                self.member_scrolls[self.current_house],
+                member_pane,
                 edge="right",
                 size=int(0.15 * x),
                 name="member_list",
@@ -529,6 +729,24 @@ class Tui(App):
         await self.house_tree.expand_house(self.current_house)
         await self.refresh_screen()
 
+        if not self.chat_screen[self.current_screen].root.children:
+            await self.fetch_older()
+
+    async def fetch_older(self) -> None:
+        """
+        Asks the server for the messages older than the ones on the screen
+        """
+
+        screen = self.chat_screen[self.current_screen]
+        if screen.fetching or not screen.has_more:
+            return
+
+        screen.fetching = True
+        self.client.fetch_history(self.current_house, self.current_room, screen.oldest)
+
+    async def handle_scrolled_to_top(self, _: ScrolledToTop) -> None:
+        await self.fetch_older()
+
     async def handle_tree_click(self, click: TreeClick) -> None:
         """
         Handles various clicks
@@ -543,10 +761,22 @@ class Tui(App):
                         house,
                         room,
                     )
-            case "house" | "rank":
+            case "house":
                 await node.toggle()
                 self.refresh(layout=True)
 
+            case "rank":
+                await node.toggle()
+                rank = str(node.label)
+                members = self.member_lists[self.current_house]
+                if node.expanded and not members.is_loaded(rank):
+                    await self.fetch_members(rank)
+                self.refresh(layout=True)
+
+            case "more":
+                if node.parent:
+                    await self.fetch_members(str(node.parent.label))
+
             case "member":
                 name = str(node.label)
                 if name == self.user:
@@ -1,4 +1,4 @@
-from .chat_screen import ChatScreen
+from .chat_screen import ChatScreen, ChatScroll, ScrolledToTop
 from .header import Headbar
 from .house_tree import HouseTree
 from .member_list import MemberList
@@ -7,6 +7,8 @@ from .banner import Banner
 
 __all__ = [
     "ChatScreen",
+    "ChatScroll",
+    "ScrolledToTop",
     "Headbar",
     "HouseTree",
     "MemberList",
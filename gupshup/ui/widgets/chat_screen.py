@@ -1,10 +1,29 @@
-from textual.widgets import TreeControl, TreeNode
+from typing import List
+
+from textual.message import Message as Event
+from textual.widgets import ScrollView, TreeControl, TreeNode
 from rich.console import RenderableType
 from rich.text import Text
 
 from ...src.utils.custom_node import CustomNode
 from ...src.utils import Message
 
+# the messages are never changed so they all share the data of their nodes
+MESSAGE_NODE = CustomNode("message", "m")
+
+
+class ScrolledToTop(Event):
+    """
+    Sent when a chat is scrolled to the top, for fetching the older messages
+    """
+
+
+class ChatScroll(ScrollView):
+    async def watch_y(self, new_value: float) -> None:
+        await super().watch_y(new_value)
+        if new_value == 0:
+            await self.emit(ScrolledToTop(self))
+
 
 class ChatScreen(TreeControl):
     """
@@ -16,6 +35,11 @@ class ChatScreen(TreeControl):
         self.chats = ""
         self._tree.hide_root = True
 
+        # the id of the oldest message shown, older ones are fetched on demand
+        self.oldest = -1
+        self.has_more = True
+        self.fetching = False
+
     def render_node(self, node: TreeNode) -> RenderableType:
         meta = {
             "@click": f"click_label({node.id})",
@@ -37,11 +61,39 @@ class ChatScreen(TreeControl):
         self.root.tree.children.clear()
         self.refresh()
 
+    def _track(self, message: Message) -> None:
+        if message.id != -1 and (self.oldest == -1 or message.id < self.oldest):
+            self.oldest = message.id
+
     async def push_text(self, message: Message) -> None:
         if not self.root.expanded:
             await self.root.expand()
 
-        msg = f"{message.sender}: {message.text}"
-        self.chats += f"\n{message.sender}: {message.text}"
-        await self.root.add(msg, CustomNode("message", "m"))
+        msg = f"{message.styled_sender()}: {message.text}"
+        self.chats += f"\n{msg}"
+        await self.root.add(msg, MESSAGE_NODE)
+        self._track(message)
         self.refresh()
+
+    async def prepend(self, messages: List[Message]) -> None:
+        """
+        Adds a page of older messages above the ones shown
+        """
+
+        if not self.root.expanded:
+            await self.root.expand()
+
+        for message in reversed(messages):
+            if self.oldest != -1 and message.id >= self.oldest:
+                continue
+
+            await self.root.add(
+                f"{message.styled_sender()}: {message.text}",
+                MESSAGE_NODE,
+            )
+            # the nodes are always added at the bottom, move it to the top
+            self.root.children.insert(0, self.root.children.pop())
+            self.root.tree.children.insert(0, self.root.tree.children.pop())
+            self._track(message)
+
+        self.refresh(layout=True)
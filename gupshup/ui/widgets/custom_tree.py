@@ -1,4 +1,7 @@
-from rich.text import TextType
+from time import monotonic
+from typing import Dict, Iterable
+
+from rich.text import Text, TextType
 from textual.widgets import (
     TreeControl,
     NodeID,
@@ -7,6 +10,12 @@ from textual.widgets import (
 from textual.reactive import Reactive
 from ...src.utils import CustomNode, Parser
 
+# the dot before the users' names
+STATUS_STYLES = {"online": "green", "away": "yellow", "offline": "dim"}
+
+# seconds a typing indicator is shown for without hearing of it again
+TYPING_TIMEOUT = 5
+
 
 class CustomTree(TreeControl):
     """
@@ -20,6 +29,11 @@ class CustomTree(TreeControl):
         super().__init__(name, data)
         self.root._expanded = True
 
+        # the presence of the users shown in the tree
+        self.status: Dict[str, str] = dict()
+        # user -> when the typing indicator goes away
+        self.typing: Dict[str, float] = dict()
+
     def on_focus(self) -> None:
         self.has_focus = True
 
@@ -100,3 +114,39 @@ class CustomTree(TreeControl):
         node = parent_node.children[self.get_node_index(parent_node, name)]
         setattr(node, "label", data)
         self.refresh()
+
+    def set_status(self, status: Dict[str, str]) -> None:
+        self.status.update(status)
+        for user, state in status.items():
+            if state == "offline":
+                self.typing.pop(user, None)
+        self.refresh()
+
+    def set_typing(self, users: Iterable[str]) -> None:
+        deadline = monotonic() + TYPING_TIMEOUT
+        for user in users:
+            self.typing[user] = deadline
+        self.refresh()
+
+    def expire_typing(self) -> None:
+        now = monotonic()
+        expired = [user for user, deadline in self.typing.items() if deadline <= now]
+        for user in expired:
+            del self.typing[user]
+
+        if expired:
+            self.refresh()
+
+    def presence_label(self, user: str) -> Text:
+        """
+        The status dot of a user, empty if the status is not known
+        """
+
+        status = self.status.get(user)
+        if status is None:
+            return Text("")
+
+        return Text("● ", style=STATUS_STYLES[status])
+
+    def typing_label(self, user: str) -> Text:
+        return Text(" typing..." if user in self.typing else "", style="dim italic")
@@ -1,3 +1,5 @@
+from typing import List
+
 from rich.text import Text
 from rich.console import RenderableType
 from textual.widgets import TreeNode
@@ -67,6 +69,13 @@ class HouseTree(CustomTree):
         if node.data.type == "room":
             if node.data.pending != "0":
                 icon_label += f"({node.data.pending})"
+
+            # the direct chats are named after the user on the other side
+            if str(node.parent.label) == "HOME":
+                user = str(node.label)
+                icon_label = (
+                    self.presence_label(user) + icon_label + self.typing_label(user)
+                )
         elif node.data.type == "house":
             pending = sum(int(i.data.pending) for i in node.children)
             if pending:
@@ -98,6 +107,16 @@ class HouseTree(CustomTree):
 
         self.selected = [house, room]
 
+    def contacts(self) -> List[str]:
+        """
+        The users with a direct chat
+        """
+
+        home = self.root.children[self.get_node_index(self.root, "HOME")]
+        return [
+            str(node.label) for node in home.children if str(node.label) != "general"
+        ]
+
     def is_room_silent(self, house: str, room: str) -> bool:
         house_node = self.root.children[self.get_node_index(self.root, house)]
         room_node = house_node.children[self.get_node_index(house_node, room)]
@@ -1,3 +1,7 @@
+from bisect import bisect_left
+from collections import OrderedDict
+from typing import Dict, List, Optional
+
 from rich.text import Text
 from rich.console import RenderableType
 from textual.widgets import TreeNode
@@ -5,10 +9,17 @@ from textual.widgets import TreeNode
 from .custom_tree import CustomTree
 from ...src.utils import CustomNode, Parser
 
+# members kept in the tree of a house, the ranks expanded the longest ago go first
+MAX_CACHED_MEMBERS = 500
+MORE = "..."
+
 
 class MemberList(CustomTree):
     """
     A Class to show a tree-like structure of members of a group and their respective ranks
+
+    Only the member counts of the ranks are known upfront, the members
+    of a rank are fetched a page at a time when it is expanded
     """
 
     def __init__(self) -> None:
@@ -21,6 +32,13 @@ class MemberList(CustomTree):
             ),
         )
 
+        self.counts: Dict[str, int] = dict()
+        # rank -> the members in the tree, the most recently expanded rank last
+        self.loaded: OrderedDict[str, List[str]] = OrderedDict()
+        self.has_more: Dict[str, bool] = dict()
+        # only the members starting with it are shown
+        self.prefix = ""
+
     def render_node(self, node: TreeNode) -> RenderableType:
         """
         Custom rendering of node
@@ -45,8 +63,10 @@ class MemberList(CustomTree):
             "cursor": node.is_cursor,
         }
 
-        label = Text(node.label) if isinstance(node.label, str) else node.label
+        label = Text(node.label) if isinstance(node.label, str) else node.label.copy()
         label.stylize(node.data.color)
+        if node.data.type == "rank":
+            label.append(f" ({self.counts.get(str(node.label), 0)})", style="dim")
 
         if is_hover:
             label.stylize("bold red" if node.data.type == "member_root" else "magenta")
@@ -60,6 +80,11 @@ class MemberList(CustomTree):
             )
             + label
         )
+        if node.data.type == "member":
+            name = str(node.label)
+            icon_label = (
+                self.presence_label(name) + icon_label + self.typing_label(name)
+            )
         icon_label.apply_meta(meta)
 
         return icon_label
@@ -67,21 +92,140 @@ class MemberList(CustomTree):
     async def add_rank(self, name: str) -> None:
         await super().add_under_root(name, CustomNode(type="rank", icon=""))
 
+    def _rank_node(self, rank: str) -> Optional[TreeNode]:
+        index = self.get_node_index(self.root, rank)
+        return self.root.children[index] if index != -1 else None
+
+    async def _add_member(self, node: TreeNode, user: str, index: int) -> None:
+        await node.add(user, CustomNode(type="member", icon=""))
+        # the nodes are always added at the bottom, move it to its place
+        node.children.insert(index, node.children.pop())
+        node.tree.children.insert(index, node.tree.children.pop())
+
+    def _drop_members(self, rank: str) -> None:
+        node = self._rank_node(rank)
+        if node is not None:
+            node.children.clear()
+            node.tree.children.clear()
+
+        self.loaded.pop(rank, None)
+        self.has_more.pop(rank, None)
+
+    def set_count(self, rank: str, count: int) -> None:
+        self.counts[rank] = count
+        self.refresh()
+
+    def next_after(self, rank: str) -> str:
+        """
+        The name the next page of the rank starts after
+        """
+
+        members = self.loaded.get(rank)
+        return members[-1] if members else ""
+
+    def is_loaded(self, rank: str) -> bool:
+        return rank in self.loaded
+
+    async def add_page(
+        self, rank: str, members: List[str], has_more: bool, count: int
+    ) -> None:
+        """
+        Adds a page of members fetched for the rank
+        """
+
+        node = self._rank_node(rank)
+        if node is None:
+            return
+
+        if not self.prefix:
+            self.counts[rank] = count
+
+        loaded = self.loaded.setdefault(rank, [])
+        self.loaded.move_to_end(rank)
+        if node.children and str(node.children[-1].label) == MORE:
+            node.children.pop()
+            node.tree.children.pop()
+
+        for user in members:
+            await self._add_member(node, user, len(loaded))
+            loaded.append(user)
+
+        self.has_more[rank] = has_more
+        if has_more:
+            await node.add(MORE, CustomNode(type="more", icon=""))
+
+        if not node.expanded:
+            await node.expand()
+
+        self._evict()
+        self.refresh(layout=True)
+
+    def _evict(self) -> None:
+        """
+        Forgets the members of the ranks expanded the longest ago
+        """
+
+        while (
+            len(self.loaded) > 1
+            and sum(map(len, self.loaded.values())) > MAX_CACHED_MEMBERS
+        ):
+            rank = next(iter(self.loaded))
+            self._drop_members(rank)
+            node = self._rank_node(rank)
+            if node is not None:
+                node._expanded = False
+                node.tree.expanded = False
+
+    def set_filter(self, prefix: str) -> List[str]:
+        """
+        Shows only the members starting with the prefix
+        returns the ranks to be fetched again
+        """
+
+        self.prefix = prefix
+        ranks = [rank for rank, count in self.counts.items() if count]
+        for rank in list(self.loaded):
+            self._drop_members(rank)
+
+        self.refresh(layout=True)
+        return ranks
+
     async def add_user_to_rank(self, rank: str, user: str) -> None:
         """
         Assign the user a rank
         """
 
-        await self.add_under_child(rank, user, CustomNode(type="member", icon=""))
+        self.counts[rank] = self.counts.get(rank, 0) + 1
+        members = self.loaded.get(rank)
+        node = self._rank_node(rank)
+        if members is None or node is None or not user.startswith(self.prefix):
+            self.refresh()
+            return
+
+        # the members after the last loaded one come with the next page
+        index = bisect_left(members, user)
+        if index < len(members) or not self.has_more.get(rank):
+            members.insert(index, user)
+            await self._add_member(node, user, index)
+
+        self.refresh(layout=True)
 
     async def del_from_rank(self, rank: str, member: str) -> None:
         """
         Deletes the user from the rank
         """
 
-        super().del_under_child(rank, member)
+        self.counts[rank] = max(0, self.counts.get(rank, 0) - 1)
+        members = self.loaded.get(rank)
+        if members is not None and member in members:
+            members.remove(member)
+            super().del_under_child(rank, member)
+
+        self.refresh()
 
     async def del_rank(self, rank: str) -> None:
+        self._drop_members(rank)
+        self.counts.pop(rank, None)
         super().del_under_root(rank)
 
     async def change_rank_data(self, rank: str, param: str, value: str) -> None:
@@ -93,3 +237,7 @@ class MemberList(CustomTree):
 
     async def change_rank_name(self, rank: str, name: str) -> None:
         super().change_name_parent(rank, name)
+        self.counts[name] = self.counts.pop(rank, 0)
+        if rank in self.loaded:
+            self.loaded[name] = self.loaded.pop(rank)
+            self.has_more[name] = self.has_more.pop(rank)